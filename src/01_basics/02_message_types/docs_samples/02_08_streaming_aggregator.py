@@ -0,0 +1,346 @@
+"""
+ストリーミング集計 - メモリ上限のあるメッセージ集計
+
+collect_messages (02_05) はテキストとツール呼び出しをすべてリストに追加するため、
+長時間の実行ではメモリが際限なく増えます。
+ここでは query() のストリームを1回だけ読みながら、カウンターと上限付きの
+リングバッファだけを保持します。全文が必要な場合はディスクに書き出します。
+
+Usage:
+    python 02_08_streaming_aggregator.py --prompt "README.md を要約して"
+    python 02_08_streaming_aggregator.py --prompt "README.md を要約して" --spill transcript.jsonl
+    python 02_08_streaming_aggregator.py --benchmark
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import time
+import tracemalloc
+from array import array
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+from claude_agent_sdk import (
+    query,
+    ClaudeAgentOptions,
+    AssistantMessage,
+    UserMessage,
+    ResultMessage,
+    TextBlock,
+    ToolUseBlock,
+    ToolResultBlock
+)
+
+# ブロックの種類
+TEXT, TOOL_USE, TOOL_RESULT = 0, 1, 2
+KIND_NAMES = ("text", "tool_use", "tool_result")
+
+
+class TextRecord:
+    """テキストブロックの要約（先頭だけを保持）"""
+    __slots__ = ("message_index", "length", "preview")
+
+    def __init__(self, message_index: int, text: str, preview_chars: int):
+        self.message_index = message_index
+        self.length = len(text)
+        self.preview = text[:preview_chars]
+
+
+class ToolUseRecord:
+    """ツール呼び出しの要約"""
+    __slots__ = ("message_index", "name", "id", "input_keys")
+
+    def __init__(self, message_index: int, block: ToolUseBlock):
+        self.message_index = message_index
+        self.name = block.name
+        self.id = block.id
+        self.input_keys = tuple(block.input)
+
+
+class BlockRing:
+    """
+    ブロック単位のレコードを固定長の配列で保持するリングバッファ
+
+    1ブロックあたり 11 バイト（メッセージ番号 / 種類 / サイズ / ツール番号）で、
+    capacity を超えると古いものから上書きします。
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self.message_index = array("I", bytes(4 * capacity))
+        self.kind = array("B", bytes(capacity))
+        self.size = array("I", bytes(4 * capacity))
+        self.tool = array("H", bytes(2 * capacity))
+        self.written = 0
+
+    def append(self, message_index: int, kind: int, size: int, tool: int = 0):
+        i = self.written % self.capacity
+        self.message_index[i] = message_index
+        self.kind[i] = kind
+        self.size[i] = min(size, 0xFFFFFFFF)
+        self.tool[i] = tool
+        self.written += 1
+
+    def __len__(self) -> int:
+        return min(self.written, self.capacity)
+
+    def __iter__(self):
+        """古い順に (メッセージ番号, 種類, サイズ, ツール番号) を返す"""
+        start = max(0, self.written - self.capacity)
+        for n in range(start, self.written):
+            i = n % self.capacity
+            yield self.message_index[i], self.kind[i], self.size[i], self.tool[i]
+
+
+class StreamingAggregator:
+    """メッセージストリームをメモリ上限付きで集計する"""
+
+    def __init__(
+        self,
+        recent: int = 20,
+        block_capacity: int = 4096,
+        preview_chars: int = 200,
+        spill_path: Optional[str] = None
+    ):
+        self.preview_chars = preview_chars
+
+        # カウンター
+        self.message_counts: Counter[str] = Counter()
+        self.tool_counts: Counter[str] = Counter()
+        self.text_blocks = 0
+        self.text_chars = 0
+        self.tool_results = 0
+        self.tool_errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.total_cost = 0.0
+        self.result: Optional[ResultMessage] = None
+        # 1つの API 応答は同じ message_id の連続したメッセージに分かれて届くため、
+        # usage は id ごとに1回だけ数える（直前の id だけ覚えればメモリは一定）
+        self._last_usage_id: Optional[str] = None
+
+        # 上限付きバッファ
+        self.recent_texts: deque[TextRecord] = deque(maxlen=recent)
+        self.recent_tool_uses: deque[ToolUseRecord] = deque(maxlen=recent)
+        self.blocks = BlockRing(block_capacity)
+        self.tool_names: dict[str, int] = {}
+
+        # 全文の書き出し先
+        self._spill = open(spill_path, "a", encoding="utf-8") if spill_path else None
+        self._index = 0
+
+    def _tool_code(self, name: str) -> int:
+        """ツール名を番号に変換（ツール名は種類が少ないので辞書で十分）"""
+        return self.tool_names.setdefault(name, len(self.tool_names) + 1)
+
+    def add(self, message):
+        """1メッセージを集計"""
+        index = self._index
+        self._index += 1
+        self.message_counts[type(message).__name__] += 1
+
+        if isinstance(message, AssistantMessage):
+            for block in message.content:
+                if isinstance(block, TextBlock):
+                    self.text_blocks += 1
+                    self.text_chars += len(block.text)
+                    self.recent_texts.append(TextRecord(index, block.text, self.preview_chars))
+                    self.blocks.append(index, TEXT, len(block.text))
+                elif isinstance(block, ToolUseBlock):
+                    self.tool_counts[block.name] += 1
+                    self.recent_tool_uses.append(ToolUseRecord(index, block))
+                    self.blocks.append(index, TOOL_USE, len(block.input), self._tool_code(block.name))
+            if message.usage and not self._seen_usage(message.message_id):
+                self.input_tokens += message.usage.get("input_tokens", 0)
+                self.output_tokens += message.usage.get("output_tokens", 0)
+
+        elif isinstance(message, UserMessage) and isinstance(message.content, list):
+            for block in message.content:
+                if isinstance(block, ToolResultBlock):
+                    self.tool_results += 1
+                    self.tool_errors += bool(block.is_error)
+                    size = len(block.content) if isinstance(block.content, (str, list)) else 0
+                    self.blocks.append(index, TOOL_RESULT, size)
+
+        elif isinstance(message, ResultMessage):
+            self.result = message
+            self.total_cost = message.total_cost_usd or 0.0
+
+        if self._spill:
+            entry = {"type": type(message).__name__, "data": dataclasses.asdict(message)}
+            self._spill.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+    def _seen_usage(self, message_id: Optional[str]) -> bool:
+        if not message_id:
+            return False
+        if message_id == self._last_usage_id:
+            return True
+        self._last_usage_id = message_id
+        return False
+
+    async def consume(self, messages: AsyncIterator) -> "StreamingAggregator":
+        """イテレータを1回だけ読んで集計"""
+        try:
+            async for message in messages:
+                self.add(message)
+        finally:
+            self.close()
+        return self
+
+    def close(self):
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+
+    def print_summary(self):
+        print(f"メッセージ数: {sum(self.message_counts.values())} {dict(self.message_counts)}")
+        print(f"テキスト: {self.text_blocks}ブロック, {self.text_chars}文字")
+        print(f"ツール使用: {dict(self.tool_counts)} (結果 {self.tool_results}, エラー {self.tool_errors})")
+        print(f"トークン: 入力 {self.input_tokens}, 出力 {self.output_tokens}")
+        print(f"合計コスト: ${self.total_cost:.4f}")
+        if self.recent_texts:
+            print(f"最後のテキスト: {self.recent_texts[-1].preview[:80]}")
+
+
+async def aggregate_query(
+    prompt: str,
+    options: Optional[ClaudeAgentOptions] = None,
+    spill_path: Optional[str] = None
+) -> StreamingAggregator:
+    """query() の結果をストリーミング集計"""
+    aggregator = StreamingAggregator(spill_path=spill_path)
+    return await aggregator.consume(query(prompt=prompt, options=options))
+
+
+# =============================================================================
+# メモリベンチマーク
+# =============================================================================
+
+@dataclass
+class QueryResult:
+    """02_05 と同じ集計結果（比較用）"""
+    texts: list[str]
+    tool_uses: list[dict]
+    total_cost: float
+
+
+async def synthetic_stream(count: int, text_chars: int) -> AsyncIterator:
+    """長時間の実行を模したメッセージストリーム"""
+    text = "解析結果: " + "x" * text_chars
+    for i in range(count - 1):
+        if i % 2 == 0:
+            yield AssistantMessage(
+                content=[
+                    TextBlock(text=f"{i} {text}"),
+                    ToolUseBlock(id=f"toolu_{i}", name="Read", input={"file_path": f"src/file_{i}.py"})
+                ],
+                model="claude-sonnet-4-5",
+                usage={"input_tokens": 1200, "output_tokens": 150}
+            )
+        else:
+            yield UserMessage(content=[ToolResultBlock(tool_use_id=f"toolu_{i - 1}", content=text)])
+    yield ResultMessage(
+        subtype="success", duration_ms=0, duration_api_ms=0, is_error=False,
+        num_turns=count // 2, session_id="bench", total_cost_usd=0.002 * count
+    )
+
+
+async def collect_with_query_result(messages: AsyncIterator) -> QueryResult:
+    """02_05 の collect_messages と同じ集計"""
+    texts = []
+    tool_uses = []
+    total_cost = 0.0
+    async for message in messages:
+        if isinstance(message, AssistantMessage):
+            for block in message.content:
+                if isinstance(block, TextBlock):
+                    texts.append(block.text)
+                elif isinstance(block, ToolUseBlock):
+                    tool_uses.append({"name": block.name, "input": block.input, "id": block.id})
+        elif hasattr(message, "total_cost_usd"):
+            total_cost = message.total_cost_usd
+    return QueryResult(texts=texts, tool_uses=tool_uses, total_cost=total_cost)
+
+
+async def measure(collect, count: int, text_chars: int) -> tuple[float, float]:
+    """ピークメモリ (KiB) と処理時間 (ms) を計測"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = await collect(synthetic_stream(count, text_chars))
+    elapsed = (time.perf_counter() - start) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak / 1024, elapsed
+
+
+async def benchmark(args: argparse.Namespace):
+    print("=" * 60)
+    print("ストリーミング集計 メモリベンチマーク")
+    print("=" * 60)
+    print(f"テキストブロックの長さ: {args.text_chars}文字")
+    print("=" * 60)
+
+    collectors = [
+        ("QueryResult", collect_with_query_result),
+        ("Streaming", lambda messages: StreamingAggregator().consume(messages)),
+    ]
+
+    print(f"\n{'メッセージ数':>12} {'方式':<12} {'ピーク(KiB)':>12} {'時間(ms)':>10}")
+    print("-" * 50)
+    for count in args.sizes:
+        for name, collect in collectors:
+            peak, elapsed = await measure(collect, count, args.text_chars)
+            print(f"{count:>12} {name:<12} {peak:>12.0f} {elapsed:>10.0f}")
+    print("-" * 50)
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="メモリ上限のあるメッセージ集計"
+    )
+    parser.add_argument(
+        "-p", "--prompt",
+        default="README.md ファイルを探して内容を要約して",
+        help="実行するプロンプト"
+    )
+    parser.add_argument(
+        "--spill",
+        help="全メッセージを書き出す JSONL ファイル"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="QueryResult とメモリ使用量を比較"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="ベンチマークのメッセージ数 (default: 1000 10000 50000)"
+    )
+    parser.add_argument(
+        "--text-chars",
+        type=int,
+        default=500,
+        help="ベンチマークのテキストブロックの長さ (default: 500)"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.benchmark:
+        await benchmark(args)
+    else:
+        options = ClaudeAgentOptions(allowed_tools=["Read", "Glob"])
+        aggregator = await aggregate_query(args.prompt, options, spill_path=args.spill)
+        aggregator.print_summary()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
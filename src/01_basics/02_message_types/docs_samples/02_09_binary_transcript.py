@@ -0,0 +1,527 @@
+"""
+バイナリトランスクリプト - 長さプレフィックス付きの記録形式と mmap リーダー
+
+監査や分析のために実行ごとのメッセージを保存すると、print(message) の出力や
+JSONL は大きく、特定の実行やツールを探すにもすべての行を解析する必要があります。
+ここでは各メッセージを「固定長ヘッダー + (圧縮された) JSON」として追記し、
+ファイル末尾にオフセットのインデックスを書き込みます。
+リーダーはファイルを mmap し、ヘッダーだけを見て実行・メッセージ型・ツール名で
+絞り込んでから、必要なメッセージだけをデコードします。
+
+Usage:
+    python 02_09_binary_transcript.py --prompt "README.md を要約して" --output runs.cstr
+    python 02_09_binary_transcript.py --read runs.cstr --tool Read
+    python 02_09_binary_transcript.py --benchmark
+
+ファイル形式:
+    [マジック "CSTR" + バージョン]
+    [レコード] * N
+        ヘッダー (14 バイト): ペイロード長 u32 / 実行番号 u32 / メッセージ型 u8 / フラグ u8 / ツールのビットマスク u32
+        ペイロード: JSON (フラグの bit0 が立っていれば zlib 圧縮)
+    [オフセット表] u64 * N
+    [メタデータ] JSON (実行の一覧とツール名 → ビット番号の表)
+    [トレーラー (20 バイト)]: オフセット表の位置 u64 / メタデータの位置 u64 / マジック "CSTR"
+
+close() されずに終わったファイル (トレーラーがない) は、リーダーがレコードを先頭から
+たどって読み込みます。既存のファイルに書き込むときは append=True で実行を追加します。
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import typing
+import zlib
+from array import array
+from typing import AsyncIterator, Iterable, Iterator, Optional
+from claude_agent_sdk import (
+    query,
+    ClaudeAgentOptions,
+    AssistantMessage,
+    UserMessage,
+    SystemMessage,
+    ResultMessage,
+    StreamEvent,
+    ContentBlock,
+    TextBlock,
+    ServerToolUseBlock,
+    ToolUseBlock,
+    ToolResultBlock
+)
+
+MAGIC = b"CSTR"
+VERSION = 1
+HEADER = struct.Struct("<IIBBI")
+TRAILER = struct.Struct("<QQ4s")
+FLAG_COMPRESSED = 0x01
+
+# メッセージ型のコード（0 はその他）
+MESSAGE_TYPES = [None, UserMessage, AssistantMessage, SystemMessage, ResultMessage, StreamEvent]
+BY_NAME = {cls.__name__: cls for cls in MESSAGE_TYPES if cls is not None}
+# SDK のすべてのコンテンツブロック型（ContentBlock の Union から取得）
+BLOCK_TYPES = {cls.__name__: cls for cls in typing.get_args(ContentBlock)}
+# ツール名をビットマスクに記録するブロック（web_search などのサーバーツールを含む）
+TOOL_USE_BLOCKS = (ToolUseBlock, ServerToolUseBlock)
+
+# ビットマスクで表せるツール名の数（超えた分は最後のビットにまとめる）
+MAX_TOOL_BITS = 32
+
+
+def type_code(message) -> int:
+    for code, cls in enumerate(MESSAGE_TYPES):
+        if cls is not None and isinstance(message, cls):
+            return code
+    return 0
+
+
+# =============================================================================
+# エンコード / デコード
+# =============================================================================
+
+def _encode_block(block) -> dict:
+    if not dataclasses.is_dataclass(block):
+        return block
+    return {"_block": type(block).__name__, **dataclasses.asdict(block)}
+
+
+def encode_message(message) -> dict:
+    """メッセージを JSON にできる辞書に変換（コンテンツブロックの型を保持）"""
+    cls = MESSAGE_TYPES[type_code(message)]
+    if cls is None:
+        return {"repr": str(message)}
+    data = {f.name: getattr(message, f.name) for f in dataclasses.fields(cls)}
+    if isinstance(data.get("content"), list):
+        data["content"] = [_encode_block(block) for block in data["content"]]
+    return data
+
+
+def decode_message(code: int, data: dict):
+    """encode_message の逆変換"""
+    cls = MESSAGE_TYPES[code]
+    if cls is None:
+        return data
+    if isinstance(data.get("content"), list):
+        data["content"] = [_decode_block(block) for block in data["content"]]
+    return cls(**data)
+
+
+def _decode_block(block):
+    # 知らないブロック型（新しい SDK で書かれたものなど）は辞書のまま返す
+    cls = BLOCK_TYPES.get(block.get("_block")) if isinstance(block, dict) else None
+    if cls is None:
+        return block
+    block.pop("_block")
+    return cls(**block)
+
+
+# =============================================================================
+# ライター
+# =============================================================================
+
+class TranscriptWriter:
+    """メッセージをバイナリトランスクリプトに追記する"""
+
+    def __init__(self, path: str, compress: bool = True, compress_threshold: int = 256, append: bool = False):
+        """
+        append=False では既存のファイルを上書きせずに FileExistsError にします。
+        append=True では既存のファイルのレコードの後ろに実行を追加します。
+        """
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.offsets: list[int] = []
+        self.runs: list[dict] = []
+        self.tools: dict[str, int] = {}
+
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            with TranscriptReader(path) as reader:
+                self.offsets = list(reader.offsets)
+                self.runs = reader.runs
+                self.tools = reader.tools
+                records_end = reader.records_end
+            # 古いオフセット表・メタデータ・トレーラーは close() で書き直す
+            self.file = open(path, "r+b")
+            self.file.truncate(records_end)
+            self.file.seek(records_end)
+        else:
+            self.file = open(path, "xb")
+            self.file.write(MAGIC + bytes([VERSION]))
+
+    def __enter__(self) -> "TranscriptWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def begin_run(self, name: str = "", **metadata) -> int:
+        """新しい実行を開始し、実行番号を返す"""
+        self.runs.append({"name": name, "first": len(self.offsets), "count": 0, **metadata})
+        return len(self.runs) - 1
+
+    def _tool_mask(self, message) -> int:
+        if not isinstance(message, AssistantMessage):
+            return 0
+        mask = 0
+        for block in message.content:
+            if isinstance(block, TOOL_USE_BLOCKS):
+                bit = self.tools.setdefault(block.name, min(len(self.tools), MAX_TOOL_BITS - 1))
+                mask |= 1 << bit
+        return mask
+
+    def write(self, message):
+        """1メッセージを書き込む"""
+        if not self.runs:
+            self.begin_run()
+        payload = json.dumps(encode_message(message), ensure_ascii=False, default=str).encode("utf-8")
+        flags = 0
+        if self.compress and len(payload) >= self.compress_threshold:
+            payload = zlib.compress(payload, 1)
+            flags |= FLAG_COMPRESSED
+
+        self.offsets.append(self.file.tell())
+        self.file.write(HEADER.pack(len(payload), len(self.runs) - 1, type_code(message), flags, self._tool_mask(message)))
+        self.file.write(payload)
+        self.runs[-1]["count"] += 1
+
+    async def tee(self, messages: AsyncIterator, name: str = "", **metadata) -> AsyncIterator:
+        """
+        async for ループに挟んで、受信したメッセージを書き込みながらそのまま返す
+
+        async for message in writer.tee(query(prompt=prompt, options=options)):
+            ...
+        """
+        self.begin_run(name, **metadata)
+        async for message in messages:
+            self.write(message)
+            yield message
+
+    def close(self):
+        """オフセット表・メタデータ・トレーラーを書き込んで閉じる"""
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(struct.pack(f"<{len(self.offsets)}Q", *self.offsets))
+        meta_offset = self.file.tell()
+        meta = {"runs": self.runs, "tools": self.tools}
+        self.file.write(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        self.file.write(TRAILER.pack(index_offset, meta_offset, MAGIC))
+        self.file.close()
+
+
+# =============================================================================
+# リーダー
+# =============================================================================
+
+class TranscriptReader:
+    """mmap でバイナリトランスクリプトを読む"""
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != MAGIC:
+            raise ValueError(f"トランスクリプトではありません: {path}")
+
+        # close() されていないファイルにはトレーラーがないので、レコードをたどって復元する
+        self.recovered = not self._read_trailer()
+        if self.recovered:
+            self._scan_records()
+
+    def _read_trailer(self) -> bool:
+        size = len(self.map)
+        if size < len(MAGIC) + 1 + TRAILER.size:
+            return False
+        index_offset, meta_offset, magic = TRAILER.unpack_from(self.map, size - TRAILER.size)
+        if magic != MAGIC or not (len(MAGIC) + 1 <= index_offset <= meta_offset <= size - TRAILER.size):
+            return False
+        if (meta_offset - index_offset) % 8:
+            return False
+        # オフセット表はコピーせずに参照する
+        self.offsets = memoryview(self.map)[index_offset:meta_offset].cast("Q")
+        meta = json.loads(self.map[meta_offset:size - TRAILER.size])
+        self.runs: list[dict] = meta["runs"]
+        self.tools: dict[str, int] = meta["tools"]
+        self.records_end = index_offset
+        return True
+
+    def _scan_records(self):
+        """先頭からヘッダーをたどってオフセット・実行・ツールの表を作り直す"""
+        offsets = array("Q")
+        self.runs = []
+        self.tools = {}
+        position = len(MAGIC) + 1
+        size = len(self.map)
+        while position + HEADER.size <= size:
+            length, run, code, flags, mask = HEADER.unpack_from(self.map, position)
+            if position + HEADER.size + length > size:
+                break  # 書き込みの途中で終わったレコードは捨てる
+            while len(self.runs) <= run:
+                self.runs.append({"name": "", "first": len(offsets), "count": 0})
+            self.runs[run]["count"] += 1
+            offsets.append(position)
+            if mask:
+                # ツール名のビットは登場順に割り当てられているので、同じ順にたどれば再現できる
+                message = self._decode(position + HEADER.size, length, code, flags)
+                for block in message.content:
+                    if isinstance(block, TOOL_USE_BLOCKS):
+                        self.tools.setdefault(block.name, min(len(self.tools), MAX_TOOL_BITS - 1))
+            position += HEADER.size + length
+        self.offsets = memoryview(offsets)
+        self.records_end = position
+
+    def __enter__(self) -> "TranscriptReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def find_run(self, name: str) -> int:
+        for run_id, run in enumerate(self.runs):
+            if run["name"] == name:
+                return run_id
+        raise KeyError(name)
+
+    def headers(
+        self,
+        run: Optional[int] = None,
+        types: Optional[Iterable[type]] = None,
+        tool: Optional[str] = None
+    ) -> Iterator[tuple[int, int, int, int, int]]:
+        """
+        条件に合うレコードの (番号, ペイロード位置, 長さ, 型コード, フラグ) を返す
+
+        ヘッダーだけを読み、ペイロードはデコードしません。
+        """
+        if run is None:
+            start, stop = 0, len(self.offsets)
+        else:
+            start = self.runs[run]["first"]
+            stop = start + self.runs[run]["count"]
+
+        codes = None if types is None else {MESSAGE_TYPES.index(cls) for cls in types}
+        if tool is not None:
+            if tool not in self.tools:
+                return
+            tool_bit = 1 << self.tools[tool]
+            codes = {MESSAGE_TYPES.index(AssistantMessage)} if codes is None else codes
+
+        for i in range(start, stop):
+            offset = self.offsets[i]
+            length, _, code, flags, mask = HEADER.unpack_from(self.map, offset)
+            if codes is not None and code not in codes:
+                continue
+            if tool is not None and not mask & tool_bit:
+                continue
+            yield i, offset + HEADER.size, length, code, flags
+
+    def _decode(self, position: int, length: int, code: int, flags: int):
+        payload = self.map[position:position + length]
+        if flags & FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+        return decode_message(code, json.loads(payload))
+
+    def iter(self, run: Optional[int] = None, types: Optional[Iterable[type]] = None, tool: Optional[str] = None) -> Iterator:
+        """条件に合うメッセージをデコードして返す"""
+        for _, position, length, code, flags in self.headers(run, types, tool):
+            message = self._decode(position, length, code, flags)
+            # ビットマスクを共有するツール名がある場合は実際のブロックで確認
+            if tool is not None and self.tools[tool] == MAX_TOOL_BITS - 1:
+                if not any(isinstance(b, TOOL_USE_BLOCKS) and b.name == tool for b in message.content):
+                    continue
+            yield message
+
+    def __iter__(self) -> Iterator:
+        return self.iter()
+
+    def close(self):
+        self.offsets.release()
+        self.map.close()
+        self.file.close()
+
+
+# =============================================================================
+# ベンチマーク
+# =============================================================================
+
+TOOLS = ["Read", "Grep", "Glob", "Edit", "Bash"]
+
+
+def synthetic_run(run: int, messages: int) -> Iterator:
+    """1回の実行を模したメッセージ列"""
+    text = "ファイルを確認しました。" * 20
+    for i in range(messages - 1):
+        if i % 2 == 0:
+            tool = TOOLS[(run + i // 2) % len(TOOLS)]
+            yield AssistantMessage(
+                content=[
+                    TextBlock(text=text),
+                    ToolUseBlock(id=f"toolu_{run}_{i}", name=tool, input={"file_path": f"src/module_{i}.py"})
+                ],
+                model="claude-sonnet-4-5",
+                usage={"input_tokens": 1200, "output_tokens": 150}
+            )
+        else:
+            yield UserMessage(content=[ToolResultBlock(tool_use_id=f"toolu_{run}_{i - 1}", content="def main():\n    pass\n" * 30)])
+    yield ResultMessage(
+        subtype="success", duration_ms=1000, duration_api_ms=800, is_error=False,
+        num_turns=messages // 2, session_id=f"session-{run}", total_cost_usd=0.05
+    )
+
+
+def write_jsonl(path: str, runs: int, messages: int):
+    with open(path, "w", encoding="utf-8") as f:
+        for run in range(runs):
+            for message in synthetic_run(run, messages):
+                entry = {"run": run, "type": type(message).__name__, "data": encode_message(message)}
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+
+def write_binary(path: str, runs: int, messages: int, compress: bool):
+    with TranscriptWriter(path, compress=compress) as writer:
+        for run in range(runs):
+            writer.begin_run(f"run-{run}")
+            for message in synthetic_run(run, messages):
+                writer.write(message)
+
+
+def scan_jsonl(path: str, run: Optional[int], tool: Optional[str]) -> int:
+    """JSONL はすべての行を解析して絞り込む"""
+    count = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if run is not None and entry["run"] != run:
+                continue
+            if tool is not None:
+                if entry["type"] != "AssistantMessage":
+                    continue
+                if not any(b.get("name") == tool for b in entry["data"]["content"]):
+                    continue
+            decode_message(MESSAGE_TYPES.index(BY_NAME[entry["type"]]), entry["data"])
+            count += 1
+    return count
+
+
+def scan_binary(path: str, run: Optional[int], tool: Optional[str]) -> int:
+    with TranscriptReader(path) as reader:
+        return sum(1 for _ in reader.iter(run=run, tool=tool))
+
+
+def timed(func, *args) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark(args: argparse.Namespace):
+    total = args.runs * args.messages
+    print("=" * 60)
+    print("バイナリトランスクリプト ベンチマーク")
+    print("=" * 60)
+    print(f"実行数: {args.runs}, 1実行あたりのメッセージ数: {args.messages} (合計 {total})")
+    print("=" * 60)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        formats = [
+            ("jsonl", os.path.join(tmp, "runs.jsonl"), lambda p: write_jsonl(p, args.runs, args.messages), scan_jsonl),
+            ("binary", os.path.join(tmp, "runs.cstr"), lambda p: write_binary(p, args.runs, args.messages, False), scan_binary),
+            ("binary+zlib", os.path.join(tmp, "runs_z.cstr"), lambda p: write_binary(p, args.runs, args.messages, True), scan_binary),
+        ]
+
+        target_run = args.runs // 2
+        print(f"\n{'形式':<12} {'サイズ(MB)':>10} {'書込(msg/s)':>12} {'全件(msg/s)':>12} {'1実行(ms)':>10} {'1実行+Bash(ms)':>15}")
+        print("-" * 76)
+        for name, path, write, scan in formats:
+            write_time, _ = timed(write, path)
+            read_time, count = timed(scan, path, None, None)
+            assert count == total
+            run_time, _ = timed(scan, path, target_run, None)
+            tool_time, _ = timed(scan, path, target_run, "Bash")
+            size = os.path.getsize(path) / 1024 / 1024
+            print(
+                f"{name:<12} {size:>10.1f} {total / write_time:>12.0f} {total / read_time:>12.0f}"
+                f" {run_time * 1000:>10.1f} {tool_time * 1000:>15.1f}"
+            )
+        print("-" * 76)
+        print("全件: すべてのメッセージをデコード / 1実行: 実行番号で絞り込み / +Bash: さらにツール名で絞り込み")
+
+
+async def record_query(prompt: str, output: str):
+    options = ClaudeAgentOptions(allowed_tools=["Read", "Glob", "Grep"])
+    with TranscriptWriter(output, append=True) as writer:
+        async for message in writer.tee(query(prompt=prompt, options=options), name=prompt[:40]):
+            print(f"[{type(message).__name__}] recorded")
+    print(f"保存しました: {output}")
+
+
+def read_transcript(path: str, tool: Optional[str]):
+    with TranscriptReader(path) as reader:
+        if reader.recovered:
+            print("トレーラーがないため、レコードをたどって読み込みました（実行名は復元できません）")
+        print(f"メッセージ数: {len(reader)}, 実行数: {len(reader.runs)}, ツール: {list(reader.tools)}")
+        for message in reader.iter(tool=tool):
+            print(f"  {message}"[:200])
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="バイナリトランスクリプトの書き込みと読み込み"
+    )
+    parser.add_argument(
+        "-p", "--prompt",
+        default="README.md ファイルを探して内容を要約して",
+        help="実行するプロンプト"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default="transcript.cstr",
+        help="書き込むトランスクリプト。既にあれば実行を追加する (default: transcript.cstr)"
+    )
+    parser.add_argument(
+        "--read",
+        metavar="PATH",
+        help="トランスクリプトを読み込んで表示"
+    )
+    parser.add_argument(
+        "--tool",
+        help="--read で表示するツール名"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="JSONL と読み書きの速度を比較"
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=200,
+        help="ベンチマークの実行数 (default: 200)"
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=100,
+        help="ベンチマークの1実行あたりのメッセージ数 (default: 100)"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.benchmark:
+        benchmark(args)
+    elif args.read:
+        read_transcript(args.read, args.tool)
+    else:
+        await record_query(args.prompt, args.output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,566 @@
+"""
+リトライエンジン - ジッター、リトライ予算、サーキットブレーカー
+
+query_with_retry (03_03) は呼び出しごとに固定の指数バックオフでリトライするため、
+負荷がかかった状態でバックエンドが不調になると、全クライアントが同じ
+タイミングでリトライを繰り返す「リトライストーム」が発生します。
+
+Usage:
+    python 03_09_retry_engine.py --prompt "Hello, Claude!"
+    python 03_09_retry_engine.py --simulate
+    python 03_09_retry_engine.py --simulate --requests 500 --failure-rate 0.8
+
+Features:
+    - decorrelated jitter によるバックオフ
+    - プロセス全体で共有するリトライ予算（トークンバケット）
+    - エラー率がしきい値を超えたら即座に失敗させるサーキットブレーカー
+    - ErrorHandler (03_05) による再試行可否の判定
+    - メトリクス（試行回数、状態遷移）の収集
+    - 障害を注入するフェイクトランスポート
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional, TypeVar
+from claude_agent_sdk import (
+    query,
+    ClaudeAgentOptions,
+    ClaudeSDKError,
+    CLINotFoundError,
+    CLIConnectionError,
+    ProcessError,
+    Transport,
+    ResultMessage
+)
+
+T = TypeVar("T")
+
+
+# =============================================================================
+# エラー分類 (03_05_custom_error_handler.py と同じインターフェース)
+# =============================================================================
+
+class ErrorHandler(ABC):
+    @abstractmethod
+    async def handle(self, error: Exception) -> bool:
+        """エラーを処理し、リトライすべきかを返す"""
+        pass
+
+
+class TransientErrorHandler(ErrorHandler):
+    """一時的なエラー（接続断、プロセス異常終了）をリトライ可能と判定"""
+
+    async def handle(self, error: Exception) -> bool:
+        if isinstance(error, CLINotFoundError):
+            return False  # 何度試しても解決しない
+        return isinstance(error, (CLIConnectionError, ProcessError))
+
+
+# =============================================================================
+# リトライ予算とサーキットブレーカー
+# =============================================================================
+
+class RetryBudget:
+    """
+    プロセス全体で共有するリトライ予算
+
+    成功するたびに deposit_ratio 分のトークンが貯まり、リトライ1回で1トークン消費します。
+    deposit_ratio=0.1 なら、定常状態でリトライは成功数の約10%までに制限されます。
+    """
+
+    def __init__(self, max_tokens: float = 10.0, deposit_ratio: float = 0.1):
+        self.max_tokens = max_tokens
+        self.deposit_ratio = deposit_ratio
+        self.tokens = max_tokens
+
+    def on_success(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.deposit_ratio)
+
+    def try_acquire(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class CircuitOpenError(ClaudeSDKError):
+    """サーキットブレーカーが開いているため実行しなかった"""
+
+
+class CircuitBreaker:
+    """直近の呼び出し結果からエラー率を計算し、しきい値を超えたら遮断"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: float = 0.5,
+        window_size: int = 20,
+        min_calls: int = 10,
+        reset_timeout: float = 5.0,
+        half_open_max_calls: int = 1,
+        on_transition: Optional[Callable[[str, str], None]] = None
+    ):
+        self.failure_threshold = failure_threshold
+        self.window = deque(maxlen=window_size)
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.on_transition = on_transition
+
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+
+    @property
+    def failure_rate(self) -> float:
+        if not self.window:
+            return 0.0
+        return self.window.count(False) / len(self.window)
+
+    def allow(self) -> bool:
+        """この呼び出しを実行してよいか"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._transition(self.HALF_OPEN)
+
+        if self.state == self.HALF_OPEN:
+            if self.half_open_calls >= self.half_open_max_calls:
+                return False
+            self.half_open_calls += 1
+
+        return True
+
+    def record(self, success: bool):
+        if self.state == self.HALF_OPEN:
+            self.half_open_calls -= 1
+            self._transition(self.CLOSED if success else self.OPEN)
+            return
+
+        self.window.append(success)
+        if (
+            self.state == self.CLOSED
+            and len(self.window) >= self.min_calls
+            and self.failure_rate >= self.failure_threshold
+        ):
+            self._transition(self.OPEN)
+
+    def release(self):
+        """結果を記録せずに、allow() で確保した half-open の枠だけ返す (キャンセル時)"""
+        if self.state == self.HALF_OPEN and self.half_open_calls > 0:
+            self.half_open_calls -= 1
+
+    def _transition(self, new_state: str):
+        old_state, self.state = self.state, new_state
+        if new_state == self.OPEN:
+            self.opened_at = time.monotonic()
+        if new_state in (self.OPEN, self.CLOSED):
+            self.window.clear()
+            self.half_open_calls = 0
+        if self.on_transition:
+            self.on_transition(old_state, new_state)
+
+
+# =============================================================================
+# リトライエンジン
+# =============================================================================
+
+@dataclass
+class RetryMetrics:
+    """リトライエンジンのメトリクス"""
+    calls: int = 0
+    attempts: int = 0
+    successes: int = 0
+    failures: int = 0
+    retries: int = 0
+    budget_exhausted: int = 0
+    circuit_rejections: int = 0
+    transitions: Counter = field(default_factory=Counter)
+
+    def on_transition(self, old_state: str, new_state: str):
+        self.transitions[f"{old_state}->{new_state}"] += 1
+
+    def print_summary(self, title: str = "リトライメトリクス"):
+        print("\n" + "-" * 50)
+        print(title)
+        print("-" * 50)
+        print(f"  呼び出し:           {self.calls}")
+        print(f"  試行 (attempts):    {self.attempts} (x{self.attempts / max(1, self.calls):.2f})")
+        print(f"  成功 / 失敗:        {self.successes} / {self.failures}")
+        print(f"  リトライ:           {self.retries}")
+        print(f"  予算切れ:           {self.budget_exhausted}")
+        print(f"  ブレーカー遮断:     {self.circuit_rejections}")
+        for transition, count in sorted(self.transitions.items()):
+            print(f"  遷移 {transition:<20} {count}")
+
+
+class RetryEngine:
+    """ジッター・予算・ブレーカーを組み合わせたリトライ実行"""
+
+    def __init__(
+        self,
+        handlers: Optional[list[ErrorHandler]] = None,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        budget: Optional[RetryBudget] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        metrics: Optional[RetryMetrics] = None
+    ):
+        self.handlers = handlers or [TransientErrorHandler()]
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or DEFAULT_RETRY_BUDGET
+        self.metrics = metrics or RetryMetrics()
+        self.breaker = breaker or CircuitBreaker()
+        if self.breaker.on_transition is None:
+            self.breaker.on_transition = self.metrics.on_transition
+
+    def next_delay(self, previous: float) -> float:
+        """decorrelated jitter: base〜前回の3倍の間でランダムに選ぶ"""
+        return min(self.max_delay, random.uniform(self.base_delay, previous * 3))
+
+    async def should_retry(self, error: Exception) -> bool:
+        """いずれかのハンドラーがリトライ可能と判定したらリトライ"""
+        should_retry = False
+        for handler in self.handlers:
+            if await handler.handle(error):
+                should_retry = True
+        return should_retry
+
+    async def run(self, operation: Callable[[], Awaitable[T]]) -> T:
+        """operation をリトライ付きで実行"""
+        self.metrics.calls += 1
+        delay = self.base_delay
+
+        for attempt in range(1, self.max_attempts + 1):
+            if not self.breaker.allow():
+                self.metrics.circuit_rejections += 1
+                raise CircuitOpenError(
+                    f"サーキットブレーカーが開いています (エラー率 {self.breaker.failure_rate:.0%})"
+                )
+
+            self.metrics.attempts += 1
+            # 成功・失敗のどちらでもない抜け方 (キャンセルなど) でも、
+            # half-open の枠を返さないとブレーカーが開いたままになる
+            recorded = False
+            try:
+                result = await operation()
+            except ClaudeSDKError as e:
+                self.breaker.record(False)
+                recorded = True
+
+                if attempt == self.max_attempts or not await self.should_retry(e):
+                    self.metrics.failures += 1
+                    raise
+                if not self.budget.try_acquire():
+                    self.metrics.budget_exhausted += 1
+                    self.metrics.failures += 1
+                    raise
+
+                self.metrics.retries += 1
+                delay = self.next_delay(delay)
+                await asyncio.sleep(delay)
+            except Exception:
+                # タイムアウトや SDK 以外の例外も失敗として記録する (リトライはしない)
+                self.breaker.record(False)
+                recorded = True
+                self.metrics.failures += 1
+                raise
+            else:
+                self.breaker.record(True)
+                recorded = True
+                self.budget.on_success()
+                self.metrics.successes += 1
+                return result
+            finally:
+                if not recorded:
+                    self.breaker.release()
+
+        raise RuntimeError("unreachable")
+
+    async def query(
+        self,
+        prompt: str,
+        options: Optional[ClaudeAgentOptions] = None,
+        transport_factory: Optional[Callable[[], Transport]] = None
+    ) -> list:
+        """query() の結果をリトライ付きで取得"""
+
+        async def attempt():
+            transport = transport_factory() if transport_factory else None
+            results = []
+            async for message in query(prompt=prompt, options=options, transport=transport):
+                results.append(message)
+            return results
+
+        return await self.run(attempt)
+
+
+# プロセス全体で共有するリトライ予算
+DEFAULT_RETRY_BUDGET = RetryBudget()
+
+
+# =============================================================================
+# 障害注入用のフェイクトランスポート
+# =============================================================================
+
+class FaultInjectingTransport(Transport):
+    """
+    CLI を起動せずに stream-json プロトコルを模擬するトランスポート
+
+    fault_rate() が返す確率で、接続時またはストリームの途中で
+    CLIConnectionError を発生させます。
+    """
+
+    def __init__(
+        self,
+        fault_rate: Callable[[], float],
+        latency: float = 0.01,
+        rng: Optional[random.Random] = None
+    ):
+        self.fault_rate = fault_rate
+        self.latency = latency
+        self.rng = rng or random
+        self.session_id = str(uuid.uuid4())
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._ready = False
+
+    def _should_fail(self) -> bool:
+        return self.rng.random() < self.fault_rate()
+
+    async def connect(self) -> None:
+        await asyncio.sleep(self.latency)
+        if self._should_fail():
+            raise CLIConnectionError("injected: connection refused")
+        self._ready = True
+
+    async def write(self, data: str) -> None:
+        for line in data.splitlines():
+            message = json.loads(line)
+            if message.get("type") == "control_request":
+                self._queue.put_nowait({
+                    "type": "control_response",
+                    "response": {
+                        "subtype": "success",
+                        "request_id": message["request_id"],
+                        "response": {},
+                    },
+                })
+            elif message.get("type") == "user":
+                asyncio.get_running_loop().create_task(self._respond())
+
+    async def _respond(self):
+        await asyncio.sleep(self.latency)
+        if self._should_fail():
+            self._queue.put_nowait(CLIConnectionError("injected: stream reset"))
+            return
+        self._queue.put_nowait({
+            "type": "assistant",
+            "message": {
+                "model": "fake",
+                "content": [{"type": "text", "text": "ok"}],
+            },
+            "session_id": self.session_id,
+        })
+        self._queue.put_nowait({
+            "type": "result",
+            "subtype": "success",
+            "duration_ms": int(self.latency * 1000),
+            "duration_api_ms": int(self.latency * 1000),
+            "is_error": False,
+            "num_turns": 1,
+            "session_id": self.session_id,
+            "total_cost_usd": 0.001,
+            "result": "ok",
+        })
+        self._queue.put_nowait(None)
+
+    async def read_messages(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def close(self) -> None:
+        self._ready = False
+        self._queue.put_nowait(None)
+
+    def is_ready(self) -> bool:
+        return self._ready
+
+    async def end_input(self) -> None:
+        pass
+
+
+# =============================================================================
+# シミュレーション
+# =============================================================================
+
+async def naive_retry(prompt: str, transport_factory, metrics: RetryMetrics, max_retries: int = 3, base_delay: float = 0.05):
+    """03_03 と同じ固定の指数バックオフ（比較用）"""
+    metrics.calls += 1
+    for attempt in range(max_retries):
+        metrics.attempts += 1
+        try:
+            results = []
+            async for message in query(prompt=prompt, transport=transport_factory()):
+                results.append(message)
+            metrics.successes += 1
+            return results
+        except CLIConnectionError:
+            if attempt == max_retries - 1:
+                metrics.failures += 1
+                raise
+            metrics.retries += 1
+            await asyncio.sleep(base_delay * (2 ** attempt))
+
+
+async def simulate(
+    requests: int,
+    concurrency: int,
+    failure_rate: float,
+    outage_seconds: float,
+    duration: float
+):
+    """障害発生中に大量のリクエストを流し、試行回数の増幅を比較"""
+    # 注入したエラーが SDK のログに大量に出力されるのを抑える
+    logging.getLogger("claude_agent_sdk").setLevel(logging.CRITICAL)
+
+    print("=" * 60)
+    print("リトライストーム シミュレーション")
+    print("=" * 60)
+    print(f"リクエスト数: {requests} ({duration}秒間に均等に到着), 並列数: {concurrency}")
+    print(f"障害: 最初の {outage_seconds}秒間 失敗率 {failure_rate:.0%}, その後 2%")
+    print("=" * 60)
+
+    async def run_scenario(call_one) -> float:
+        started = time.monotonic()
+
+        def fault_rate() -> float:
+            return failure_rate if time.monotonic() - started < outage_seconds else 0.02
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i: int):
+            await asyncio.sleep(i * duration / requests)
+            async with semaphore:
+                try:
+                    await call_one(f"request {i}", lambda: FaultInjectingTransport(fault_rate))
+                except ClaudeSDKError:
+                    pass
+
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        return time.monotonic() - started
+
+    naive_metrics = RetryMetrics()
+    elapsed = await run_scenario(
+        lambda prompt, factory: naive_retry(prompt, factory, naive_metrics)
+    )
+    naive_metrics.print_summary(f"固定バックオフ (03_03 方式) - {elapsed:.2f}秒")
+
+    engine = RetryEngine(
+        base_delay=0.05,
+        max_delay=1.0,
+        budget=RetryBudget(max_tokens=10, deposit_ratio=0.1),
+        breaker=CircuitBreaker(failure_threshold=0.5, window_size=20, min_calls=10, reset_timeout=0.5)
+    )
+    elapsed = await run_scenario(
+        lambda prompt, factory: engine.query(prompt, transport_factory=factory)
+    )
+    engine.metrics.print_summary(f"RetryEngine - {elapsed:.2f}秒")
+
+
+async def main_query(prompt: str):
+    engine = RetryEngine()
+    try:
+        results = await engine.query(prompt)
+        for message in results:
+            if isinstance(message, ResultMessage):
+                print(f"結果: {message.result}")
+    except CircuitOpenError as e:
+        print(f"即時失敗: {e}")
+    except ClaudeSDKError as e:
+        print(f"最終的に失敗: {e}")
+    engine.metrics.print_summary()
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="ジッター・リトライ予算・サーキットブレーカー付きリトライ"
+    )
+    parser.add_argument(
+        "-p", "--prompt",
+        default="Hello, Claude!",
+        help="実行するプロンプト"
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="フェイクトランスポートで障害時の挙動を比較"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=300,
+        help="シミュレーションのリクエスト数 (default: 300)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="シミュレーションの並列数 (default: 32)"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.7,
+        help="障害中の失敗率 (default: 0.7)"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=3.0,
+        help="リクエストが到着する期間 (default: 3.0)"
+    )
+    parser.add_argument(
+        "--outage-seconds",
+        type=float,
+        default=1.0,
+        help="障害の継続時間 (default: 1.0)"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.simulate:
+        await simulate(
+            args.requests,
+            args.concurrency,
+            args.failure_rate,
+            args.outage_seconds,
+            args.duration
+        )
+    else:
+        await main_query(args.prompt)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,303 @@
+"""
+途中再開付きリトライ - 接続エラー時にセッションを再開する
+
+query_with_retry (03_03) はストリームの途中で CLIConnectionError が起きると
+それまでの結果を捨てて最初から実行し直すため、完了済みのターンやツール呼び出しを
+すべてやり直すことになります。
+ここではセッション ID と受信済みメッセージを記録し、同じセッションを resume して
+残りの作業だけを実行します。
+
+Usage:
+    python 03_10_resume_on_failure.py --prompt "src/ を分析して"
+    python 03_10_resume_on_failure.py --benchmark
+    python 03_10_resume_on_failure.py --benchmark --turns 60 --crash-rate 0.03
+"""
+import argparse
+import asyncio
+import dataclasses
+import logging
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from claude_agent_sdk import (
+    query,
+    ClaudeAgentOptions,
+    ClaudeSDKError,
+    CLIConnectionError,
+    ProcessError,
+    AssistantMessage,
+    ResultMessage,
+    SystemMessage
+)
+
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[4] / "test" / "fake_claude_cli.py"
+
+RESUME_PROMPT = (
+    "接続が切れたため作業が中断されました。"
+    "完了済みの作業は繰り返さず、中断したところから続けてください。"
+)
+
+
+@dataclass
+class PartialTranscript:
+    """中断したクエリの途中経過"""
+    prompt: str
+    session_id: Optional[str] = None
+    messages: list = field(default_factory=list)
+    turns_completed: int = 0
+    executed_turns: int = 0  # 中断した試行も含めて実行されたターン数
+    attempts: int = 0
+    resumes: int = 0
+    # 1つの API 応答は同じ message_id の複数の AssistantMessage に分かれるため、ターンは id ごとに数える
+    _seen_ids: set = field(default_factory=set, repr=False)
+
+    def record(self, message):
+        """受信したメッセージを記録し、セッション ID を取得"""
+        self.messages.append(message)
+
+        if isinstance(message, SystemMessage) and message.subtype == "init":
+            self.session_id = message.data.get("session_id", self.session_id)
+        elif isinstance(message, AssistantMessage):
+            if message.message_id:
+                if message.message_id in self._seen_ids:
+                    return
+                self._seen_ids.add(message.message_id)
+            self.turns_completed += 1
+            self.executed_turns += 1
+        elif isinstance(message, ResultMessage):
+            self.session_id = message.session_id
+
+    @property
+    def result(self) -> Optional[ResultMessage]:
+        if self.messages and isinstance(self.messages[-1], ResultMessage):
+            return self.messages[-1]
+        return None
+
+
+def resume_options(options: ClaudeAgentOptions, transcript: PartialTranscript) -> ClaudeAgentOptions:
+    """中断したセッションを再開するオプションを作成"""
+    changes = {"resume": transcript.session_id, "continue_conversation": False}
+    if options.max_turns is not None:
+        # 完了済みのターンは再開後の上限から差し引く
+        changes["max_turns"] = max(1, options.max_turns - transcript.turns_completed)
+    return dataclasses.replace(options, **changes)
+
+
+async def query_with_resume(
+    prompt: str,
+    options: Optional[ClaudeAgentOptions] = None,
+    max_retries: int = 3,
+    base_delay: float = 1.0,
+    transcript: Optional[PartialTranscript] = None,
+    verbose: bool = True
+) -> PartialTranscript:
+    """接続エラー時はセッションを再開してリトライ"""
+    options = options or ClaudeAgentOptions()
+    transcript = transcript or PartialTranscript(prompt=prompt)
+
+    for attempt in range(max_retries):
+        transcript.attempts += 1
+
+        if transcript.session_id:
+            # セッションが始まっていれば、続きから再開
+            transcript.resumes += 1
+            current_prompt = RESUME_PROMPT
+            current_options = resume_options(options, transcript)
+        else:
+            # セッション開始前に失敗した場合は最初から
+            current_prompt = prompt
+            current_options = options
+
+        try:
+            async for message in query(prompt=current_prompt, options=current_options):
+                transcript.record(message)
+            return transcript
+
+        except (CLIConnectionError, ProcessError) as e:
+            delay = base_delay * (2 ** attempt)
+            if verbose:
+                print(
+                    f"接続エラー (試行 {attempt + 1}/{max_retries}): {type(e).__name__}, "
+                    f"完了済み {transcript.turns_completed}ターン"
+                )
+            if attempt < max_retries - 1:
+                await asyncio.sleep(delay)
+            else:
+                raise
+
+        except ClaudeSDKError:
+            # その他のSDKエラーはリトライしない
+            raise
+
+    raise Exception("最大リトライ回数を超えました")
+
+
+async def query_with_restart(
+    prompt: str,
+    options: ClaudeAgentOptions,
+    max_retries: int,
+    base_delay: float,
+    transcript: Optional[PartialTranscript] = None,
+    verbose: bool = False
+) -> PartialTranscript:
+    """03_03 と同じく最初からやり直すリトライ（比較用）"""
+    transcript = transcript or PartialTranscript(prompt=prompt)
+
+    for attempt in range(max_retries):
+        transcript.attempts += 1
+        # それまでの結果は捨てて最初から実行
+        transcript.messages = []
+        transcript.turns_completed = 0
+        try:
+            async for message in query(prompt=prompt, options=options):
+                transcript.record(message)
+            return transcript
+        except (CLIConnectionError, ProcessError):
+            if attempt == max_retries - 1:
+                raise
+            await asyncio.sleep(base_delay * (2 ** attempt))
+
+    raise Exception("最大リトライ回数を超えました")
+
+
+async def benchmark(args: argparse.Namespace):
+    """スタンドイン CLI で「最初からやり直し」と「途中再開」を比較"""
+    # 異常終了した CLI のエラーログを抑える
+    logging.getLogger("claude_agent_sdk").setLevel(logging.CRITICAL)
+
+    print("=" * 60)
+    print("途中再開 ベンチマーク")
+    print("=" * 60)
+    print(f"タスク: {args.turns}ターン, 各ターンの異常終了率: {args.crash_rate:.0%}")
+    print(f"試行回数: {args.runs}回, 最大リトライ: {args.max_retries}")
+    print("=" * 60)
+
+    rows = []
+    for name, strategy in [("restart", query_with_restart), ("resume", query_with_resume)]:
+        executed_turns = 0
+        completed = 0
+        attempts = 0
+        start = time.perf_counter()
+
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as state_dir:
+                options = ClaudeAgentOptions(
+                    cli_path=str(args.cli_path),
+                    max_turns=args.turns + 10,
+                    env={
+                        "FAKE_CLI_STARTUP_MS": "50",
+                        "FAKE_CLI_TURN_MS": "2",
+                        "FAKE_CLI_TURNS": str(args.turns),
+                        "FAKE_CLI_CRASH_RATE": str(args.crash_rate),
+                        "FAKE_CLI_STATE_DIR": state_dir,
+                    }
+                )
+                prompt = "大規模な自動化タスクを実行して"
+                transcript = PartialTranscript(prompt=prompt)
+                try:
+                    await strategy(
+                        prompt,
+                        options,
+                        max_retries=args.max_retries,
+                        base_delay=0.01,
+                        transcript=transcript,
+                        verbose=False
+                    )
+                    completed += 1
+                except Exception:
+                    pass
+                # 中断した試行も含め、実行されたターンはすべて課金対象
+                executed_turns += transcript.executed_turns
+                attempts += transcript.attempts
+
+        elapsed = time.perf_counter() - start
+        rows.append((name, completed, executed_turns, attempts, elapsed))
+
+    print(f"\n{'方式':<10} {'完了':>8} {'実行ターン':>12} {'試行':>8} {'時間(s)':>10}")
+    print("-" * 52)
+    for name, completed, executed_turns, attempts, elapsed in rows:
+        print(f"{name:<10} {completed:>5}/{args.runs:<2} {executed_turns:>12} {attempts:>8} {elapsed:>10.2f}")
+    print("-" * 52)
+    ideal = args.turns * args.runs
+    print(f"障害なしの場合のターン数: {ideal}")
+
+
+async def main_query(prompt: str):
+    # 01_basic.py の AUTOMATION_OPTIONS 相当
+    options = ClaudeAgentOptions(
+        max_turns=100,
+        allowed_tools=["Read", "Write", "Edit", "Bash", "Glob", "Grep"]
+    )
+    try:
+        transcript = await query_with_resume(prompt, options)
+        result = transcript.result
+        print(f"試行回数: {transcript.attempts} (再開 {transcript.resumes}回)")
+        print(f"受信メッセージ数: {len(transcript.messages)}")
+        if result:
+            print(f"結果: {result.subtype}, コスト: ${result.total_cost_usd:.4f}")
+    except Exception as e:
+        print(f"最終的に失敗: {e}")
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="接続エラー時にセッションを再開するリトライ"
+    )
+    parser.add_argument(
+        "-p", "--prompt",
+        default="このディレクトリの Python ファイルを確認して要約してください",
+        help="実行するプロンプト"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="スタンドイン CLI で最初からやり直す方式と比較"
+    )
+    parser.add_argument(
+        "--turns",
+        type=int,
+        default=60,
+        help="ベンチマークのタスクのターン数 (default: 60)"
+    )
+    parser.add_argument(
+        "--crash-rate",
+        type=float,
+        default=0.03,
+        help="ベンチマークで各ターンに CLI が異常終了する確率 (default: 0.03)"
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=10,
+        help="ベンチマークの実行回数 (default: 10)"
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=10,
+        help="ベンチマークの最大リトライ回数 (default: 10)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="ベンチマークに使う CLI のパス"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.benchmark:
+        await benchmark(args)
+    else:
+        await main_query(args.prompt)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,399 @@
+"""
+ヘッジクエリ - テールレイテンシを抑える
+
+短い対話的なプロンプトでも、まれに p95 を大きく超えて応答が止まることがあります。
+query_with_timeout (03_04) のようにタイムアウトを待つのではなく、
+最初の応答が一定時間（過去の応答時間のパーセンタイル）を過ぎても届かなければ
+同じクエリをもう1本起動し、先に応答した方を採用してもう一方を中断します。
+
+Usage:
+    python 03_11_hedged_query.py --prompt "Pythonとは何ですか？"
+    python 03_11_hedged_query.py --benchmark
+    python 03_11_hedged_query.py --benchmark --percentile 90 --max-hedge-rate 0.05
+
+Features:
+    - 最初の応答までの時間 (TTFM) のローリング分布からヘッジ開始時間を決定
+    - ヘッジ率の上限によるコストの制限
+    - ヘッジの勝率と追加コストの記録
+"""
+import argparse
+import asyncio
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from claude_agent_sdk import (
+    query,
+    ClaudeAgentOptions,
+    ClaudeSDKClient,
+    AssistantMessage,
+    ResultMessage
+)
+
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[4] / "test" / "fake_claude_cli.py"
+
+
+@dataclass
+class HedgeStats:
+    """ヘッジの統計"""
+    requests: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    skipped_by_rate_limit: int = 0
+    added_cost_usd: float = 0.0
+    total_cost_usd: float = 0.0
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedges / self.requests if self.requests else 0.0
+
+    @property
+    def win_rate(self) -> float:
+        return self.hedge_wins / self.hedges if self.hedges else 0.0
+
+    def print_summary(self):
+        print(f"  リクエスト:     {self.requests}")
+        print(f"  ヘッジ:         {self.hedges} ({self.hedge_rate:.1%})")
+        print(f"  ヘッジ勝率:     {self.win_rate:.1%}")
+        print(f"  上限で見送り:   {self.skipped_by_rate_limit}")
+        print(f"  追加コスト:     ${self.added_cost_usd:.4f} (全体の {self.added_cost_usd / max(self.total_cost_usd, 1e-9):.1%})")
+
+
+@dataclass
+class HedgeRun:
+    """ヘッジで起動した1本のクエリ"""
+    started: float
+    task: Optional[asyncio.Task] = None
+    first_message: asyncio.Event = field(default_factory=asyncio.Event)
+    first_message_at: Optional[float] = None
+    messages: list = field(default_factory=list)
+    cost: Optional[float] = None
+    client: Optional[ClaudeSDKClient] = None
+    stopped: bool = False
+
+    def ttfm(self, since: float) -> float:
+        """since から最初の応答までの秒数"""
+        return (self.first_message_at or time.monotonic()) - since
+
+
+class HedgedQuery:
+    """最初の応答が遅いときに重複クエリを起動する"""
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        max_hedge_rate: float = 0.1,
+        window_size: int = 200,
+        min_samples: int = 20,
+        initial_delay: float = 5.0,
+        stop_timeout: float = 10.0
+    ):
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.samples: deque[float] = deque(maxlen=window_size)
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.stop_timeout = stop_timeout
+        self.stats = HedgeStats()
+
+    def hedge_delay(self) -> float:
+        """ヘッジを起動するまでの待ち時間（秒）"""
+        if len(self.samples) < self.min_samples:
+            return self.initial_delay
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    def can_hedge(self) -> bool:
+        """
+        ヘッジ率が上限を超えないか
+
+        最初の1本は常に許可します（リクエスト数が少ないうちは上限が1未満になり、
+        ヘッジを一度も起動できなくなるため）。
+        """
+        return self.stats.hedges < max(1.0, self.max_hedge_rate * self.stats.requests)
+
+    def _start(self, prompt: str, options) -> HedgeRun:
+        """1本のクエリを起動"""
+        run = HedgeRun(started=time.monotonic())
+        run.task = asyncio.create_task(self._consume(run, prompt, options))
+        return run
+
+    async def _consume(self, run: HedgeRun, prompt: str, options):
+        # query() のタスクをキャンセルすると CLI のプロセスの終了処理が途中で止まるため、
+        # ClaudeSDKClient で実行し、interrupt() で止めて切断する
+        async with ClaudeSDKClient(options) as client:
+            if run.stopped:
+                return
+            await client.query(prompt)
+            run.client = client
+            if run.stopped:
+                await client.interrupt()
+            async for message in client.receive_response():
+                run.messages.append(message)
+                if not run.first_message.is_set() and isinstance(message, (AssistantMessage, ResultMessage)):
+                    run.first_message_at = time.monotonic()
+                    run.first_message.set()
+                if isinstance(message, ResultMessage):
+                    run.cost = message.total_cost_usd
+
+    async def _stop(self, runs: list[HedgeRun]):
+        """
+        クエリを中断し、切断（CLI のプロセスの終了）まで待つ
+
+        stop_timeout 秒たっても終わらないクエリだけはキャンセルします。
+        """
+        runs = [run for run in runs if not run.task.done()]
+        for run in runs:
+            run.stopped = True
+            if run.client is not None:
+                try:
+                    await run.client.interrupt()
+                except Exception:
+                    pass
+        if not runs:
+            return
+        _, pending = await asyncio.wait([run.task for run in runs], timeout=self.stop_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*(run.task for run in runs), return_exceptions=True)
+
+    async def _wait_first(self, runs: list[HedgeRun], timeout: Optional[float]) -> bool:
+        """いずれかのクエリが最初の応答を返す（または終了する）まで待つ"""
+        waiters = [asyncio.create_task(run.first_message.wait()) for run in runs]
+        done, _ = await asyncio.wait(
+            waiters + [run.task for run in runs],
+            timeout=timeout,
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        for waiter in waiters:
+            waiter.cancel()
+        return bool(done)
+
+    async def query(
+        self,
+        prompt: str,
+        options: Optional[ClaudeAgentOptions] = None,
+        timeout_seconds: float = 30.0
+    ) -> Optional[list]:
+        """ヘッジ付きでクエリを実行（タイムアウト時は None）"""
+        self.stats.requests += 1
+        started = time.monotonic()
+        runs: list[HedgeRun] = []
+        winner = None
+
+        try:
+            async with asyncio.timeout(timeout_seconds):
+                runs.append(self._start(prompt, options))
+
+                # 遅れている場合だけでなく、応答前に失敗した場合もヘッジを起動する
+                await self._wait_first(runs, self.hedge_delay())
+                if not any(run.first_message.is_set() for run in runs):
+                    if self.can_hedge():
+                        self.stats.hedges += 1
+                        runs.append(self._start(prompt, options))
+                    else:
+                        self.stats.skipped_by_rate_limit += 1
+
+                # 最初の応答を返したクエリを採用する。応答せずに終わった (失敗した) クエリは
+                # 勝者にせず、残りのクエリを待ち続ける
+                while winner is None:
+                    responded = [run for run in runs if run.first_message.is_set()]
+                    pending = [run for run in runs if not run.task.done()]
+                    if responded:
+                        winner = responded[0]
+                    elif not pending:
+                        # すべて失敗した場合は最初のクエリの結果 (例外) を返す
+                        winner = runs[0]
+                    else:
+                        await self._wait_first(pending, None)
+
+                await self._stop([run for run in runs if run is not winner])
+                await winner.task
+
+        except asyncio.TimeoutError:
+            print(f"タイムアウト: {timeout_seconds}秒を超えました")
+            return None
+
+        finally:
+            await self._stop([run for run in runs if run is not winner])
+            await self._account(runs, winner)
+
+        if winner is not runs[0]:
+            self.stats.hedge_wins += 1
+        # ヘッジが勝った場合も、元の開始時刻からの時間を記録する
+        self.samples.append(winner.ttfm(started))
+        return winner.messages
+
+    async def _account(self, runs: list[HedgeRun], winner: Optional[HedgeRun]):
+        """ヘッジによる追加コストを集計"""
+        # 中断したクエリも ResultMessage でコストが分かる。結果が届かなかった
+        # クエリのコストは、完了したクエリの平均で見積もる
+        known = [run.cost for run in runs if run.cost is not None]
+        average = sum(known) / len(known) if known else 0.0
+        for run in runs:
+            cost = average if run.cost is None else run.cost
+            self.stats.total_cost_usd += cost
+            if run is not winner:
+                self.stats.added_cost_usd += cost
+
+
+# =============================================================================
+# ベンチマーク
+# =============================================================================
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+async def benchmark(args: argparse.Namespace):
+    """スタンドイン CLI でヘッジあり/なしのレイテンシを比較"""
+    # スタンドイン CLI にバージョン確認は不要。並列に起動すると確認用のプロセスが
+    # タイムアウトで終了させられ、"Unknown child process" の警告が出る
+    os.environ.setdefault("CLAUDE_AGENT_SDK_SKIP_VERSION_CHECK", "1")
+    options = ClaudeAgentOptions(
+        cli_path=str(args.cli_path),
+        max_turns=3,
+        env={
+            "FAKE_CLI_STARTUP_MS": "100",
+            "FAKE_CLI_TURN_MS": "30",
+            "FAKE_CLI_STALL_RATE": str(args.stall_rate),
+            "FAKE_CLI_STALL_MS": str(args.stall_ms),
+        }
+    )
+
+    print("=" * 60)
+    print("ヘッジクエリ ベンチマーク")
+    print("=" * 60)
+    print(f"リクエスト数: {args.requests}, 並列数: {args.concurrency}")
+    print(f"遅延発生率: {args.stall_rate:.0%}, 遅延: {args.stall_ms}ms")
+    print(f"ヘッジ: p{args.percentile:g} 経過後, 上限 {args.max_hedge_rate:.0%}")
+    print("=" * 60)
+
+    async def run(call_one) -> list[float]:
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def one(i: int):
+            async with semaphore:
+                start = time.perf_counter()
+                await call_one(f"質問 {i}")
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        return latencies
+
+    async def plain(prompt: str):
+        async for _ in query(prompt=prompt, options=options):
+            pass
+
+    hedged = HedgedQuery(
+        percentile=args.percentile,
+        max_hedge_rate=args.max_hedge_rate,
+        initial_delay=1.0
+    )
+
+    results = [
+        ("no hedge", await run(plain)),
+        ("hedged", await run(lambda prompt: hedged.query(prompt, options))),
+    ]
+
+    print(f"\n{'':<10} {'p50(ms)':>10} {'p95(ms)':>10} {'p99(ms)':>10} {'max(ms)':>10}")
+    print("-" * 54)
+    for name, latencies in results:
+        print(
+            f"{name:<10} {percentile(latencies, 50):>10.0f} {percentile(latencies, 95):>10.0f}"
+            f" {percentile(latencies, 99):>10.0f} {max(latencies):>10.0f}"
+        )
+    print("-" * 54)
+    print(f"ヘッジ開始時間 (最終): {hedged.hedge_delay() * 1000:.0f}ms")
+    hedged.stats.print_summary()
+
+
+async def main_query(prompt: str):
+    hedged = HedgedQuery(initial_delay=5.0)
+    result = await hedged.query(prompt, ClaudeAgentOptions(max_turns=1), timeout_seconds=60.0)
+
+    if result is None:
+        print("処理がタイムアウトしました。")
+    else:
+        print(f"正常完了: {len(result)} メッセージ")
+    hedged.stats.print_summary()
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="ヘッジクエリによるテールレイテンシの削減"
+    )
+    parser.add_argument(
+        "-p", "--prompt",
+        default="Pythonとは何ですか？一文で答えてください。",
+        help="実行するプロンプト"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="スタンドイン CLI でヘッジあり/なしを比較"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="ベンチマークのリクエスト数 (default: 200)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="ベンチマークの並列数 (default: 8)"
+    )
+    parser.add_argument(
+        "--stall-rate",
+        type=float,
+        default=0.05,
+        help="最初の応答が遅延する確率 (default: 0.05)"
+    )
+    parser.add_argument(
+        "--stall-ms",
+        type=int,
+        default=3000,
+        help="遅延したときの待ち時間 (default: 3000)"
+    )
+    parser.add_argument(
+        "--percentile",
+        type=float,
+        default=95.0,
+        help="ヘッジを起動するパーセンタイル (default: 95)"
+    )
+    parser.add_argument(
+        "--max-hedge-rate",
+        type=float,
+        default=0.1,
+        help="ヘッジ率の上限 (default: 0.1)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="ベンチマークに使う CLI のパス"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.benchmark:
+        await benchmark(args)
+    else:
+        await main_query(args.prompt)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,437 @@
+"""
+継続的ヘルスプローブ - レイテンシヒストグラムと TTL キャッシュ
+
+health_check (03_08) は `ping` クエリを1回送り、応答時間を1つ記録するだけです。
+本番環境では、バックグラウンドで定期的にプローブを実行してレイテンシの分布を保持し、
+劣化を検知して、その状態をアドミッション制御やロードバランサーに公開します。
+
+Usage:
+    python 03_12_health_prober.py
+    python 03_12_health_prober.py --demo
+    python 03_12_health_prober.py --demo --interval 0.5 --full-probe-every 5
+
+Features:
+    - CLI 起動時間 / 最初の応答までの時間 / 結果までの時間 のローリングヒストグラム
+      (HDR 形式の対数・線形バケット)
+    - 安いプローブ（接続 + スラッシュコマンド）と、N 回に1回のフルクエリ
+    - 実際のクエリの計測値を取り込む observe()
+    - 劣化の検知 (healthy / degraded / unhealthy)
+    - TTL 付きでキャッシュされた状態 (is_healthy() は無料で呼べる)
+"""
+import argparse
+import asyncio
+import math
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from claude_agent_sdk import (
+    ClaudeSDKClient,
+    ClaudeAgentOptions,
+    CLINotFoundError,
+    AssistantMessage,
+    ResultMessage
+)
+
+# デモ用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[4] / "test" / "fake_claude_cli.py"
+
+METRICS = ("spawn_ms", "first_message_ms", "result_ms")
+
+
+# =============================================================================
+# レイテンシヒストグラム
+# =============================================================================
+
+class LatencyHistogram:
+    """
+    HDR 形式のヒストグラム
+
+    2のべき乗ごとの区間を sub_buckets 個に等分したバケットに記録します。
+    メモリは固定で、相対誤差は約 1/sub_buckets に収まります。
+    """
+
+    def __init__(self, sub_buckets: int = 16, max_exponent: int = 24):
+        self.sub_buckets = sub_buckets
+        self.max_exponent = max_exponent
+        self.counts = [0] * (sub_buckets * (max_exponent + 1))
+        self.total = 0
+        self.max_value = 0.0
+
+    def _index(self, value: float) -> int:
+        if value < 1:
+            return 0
+        exponent = min(self.max_exponent, int(math.log2(value)))
+        base = 2 ** exponent
+        sub = min(self.sub_buckets - 1, int((value - base) / base * self.sub_buckets))
+        return exponent * self.sub_buckets + sub
+
+    def _upper_bound(self, index: int) -> float:
+        exponent, sub = divmod(index, self.sub_buckets)
+        base = 2 ** exponent
+        return base + base * (sub + 1) / self.sub_buckets
+
+    def record(self, value: float):
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.max_value = max(self.max_value, value)
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.max_value = max(self.max_value, other.max_value)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if self.total == 0:
+            return None
+        target = math.ceil(self.total * pct / 100)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= max(1, target):
+                return min(self._upper_bound(index), self.max_value)
+        return self.max_value
+
+
+class RollingHistogram:
+    """直近 window_seconds のヒストグラム（時間スライスのリング）"""
+
+    def __init__(self, window_seconds: float = 60.0, slices: int = 6):
+        self.slice_seconds = window_seconds / slices
+        self.slices: deque[tuple[int, LatencyHistogram]] = deque(maxlen=slices)
+
+    def _current(self) -> LatencyHistogram:
+        slot = int(time.monotonic() / self.slice_seconds)
+        if not self.slices or self.slices[-1][0] != slot:
+            self.slices.append((slot, LatencyHistogram()))
+        return self.slices[-1][1]
+
+    def record(self, value: float):
+        self._current().record(value)
+
+    def snapshot(self) -> LatencyHistogram:
+        """期限内のスライスをまとめたヒストグラム"""
+        oldest = int(time.monotonic() / self.slice_seconds) - self.slices.maxlen + 1
+        merged = LatencyHistogram()
+        for slot, histogram in self.slices:
+            if slot >= oldest:
+                merged.merge(histogram)
+        return merged
+
+
+# =============================================================================
+# ヘルスプローバー
+# =============================================================================
+
+@dataclass
+class HealthStatus:
+    """公開されるヘルス状態"""
+    state: str = "unknown"  # healthy / degraded / unhealthy / unknown
+    cli_available: bool = False
+    api_connection: bool = False
+    failure_rate: float = 0.0
+    percentiles: dict = field(default_factory=dict)  # metric -> {"p50": ms, "p95": ms}
+    reasons: list = field(default_factory=list)
+    checked_at: float = 0.0
+
+    @property
+    def admission_ratio(self) -> float:
+        """受け入れてよいリクエストの割合（アドミッション制御用）"""
+        return {"healthy": 1.0, "degraded": 0.5, "unknown": 1.0}.get(self.state, 0.0)
+
+
+class HealthProber:
+    """バックグラウンドでプローブを実行し、ヘルス状態を保持する"""
+
+    def __init__(
+        self,
+        options: Optional[ClaudeAgentOptions] = None,
+        interval: float = 30.0,
+        full_probe_every: int = 10,
+        cache_ttl: float = 5.0,
+        window_seconds: float = 300.0,
+        slo_ms: Optional[dict] = None,
+        degradation_factor: float = 2.0,
+        baseline_samples: int = 3,
+        probe_timeout: float = 60.0
+    ):
+        self.options = options or ClaudeAgentOptions(max_turns=1, allowed_tools=[])
+        self.interval = interval
+        self.full_probe_every = full_probe_every
+        self.cache_ttl = cache_ttl
+        self.slo_ms = slo_ms or {"spawn_ms": 5000, "first_message_ms": 10000, "result_ms": 20000}
+        self.degradation_factor = degradation_factor
+        self.baseline_samples = baseline_samples
+        self.probe_timeout = probe_timeout
+
+        self.histograms = {m: RollingHistogram(window_seconds) for m in METRICS}
+        self.baseline_p95: dict[str, float] = {}
+        self.outcomes: deque[bool] = deque(maxlen=20)
+        self.probes = {"cheap": 0, "full": 0, "observed": 0}
+        self.status_requests = 0
+        self.transitions: list[tuple[str, str]] = []
+
+        self._status = HealthStatus()
+        self._task: Optional[asyncio.Task] = None
+
+    # ------------------------------------------------------------------
+    # 公開 API
+    # ------------------------------------------------------------------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self) -> HealthStatus:
+        """キャッシュされた状態を返す（TTL 切れなら再計算）"""
+        self.status_requests += 1
+        if time.monotonic() - self._status.checked_at > self.cache_ttl:
+            self._refresh()
+        return self._status
+
+    def is_healthy(self) -> bool:
+        return self.status().state in ("healthy", "unknown")
+
+    def observe(self, success: bool, **latencies_ms: float):
+        """実際のクエリの計測値を取り込む（プローブの代わりになる）"""
+        self.probes["observed"] += 1
+        self._record(success, latencies_ms)
+
+    # ------------------------------------------------------------------
+    # プローブ
+    # ------------------------------------------------------------------
+
+    async def probe(self, full: bool) -> dict:
+        """
+        1回のプローブを実行
+
+        安いプローブは CLI の起動とスラッシュコマンドの往復だけを計測し、
+        モデルを呼び出しません。フルプローブは ping クエリまで実行します。
+        """
+        latencies = {}
+        start = time.perf_counter()
+        client = ClaudeSDKClient(self.options)
+        try:
+            async with asyncio.timeout(self.probe_timeout):
+                await client.connect()
+                latencies["spawn_ms"] = (time.perf_counter() - start) * 1000
+
+                sent = time.perf_counter()
+                await client.query("ping" if full else "/clear")
+                async for message in client.receive_response():
+                    if full and isinstance(message, AssistantMessage) and "first_message_ms" not in latencies:
+                        latencies["first_message_ms"] = (time.perf_counter() - sent) * 1000
+                    elif isinstance(message, ResultMessage):
+                        if full:
+                            latencies["result_ms"] = (time.perf_counter() - sent) * 1000
+                        if message.is_error:
+                            raise RuntimeError(f"probe failed: {message.subtype}")
+        finally:
+            await client.disconnect()
+        return latencies
+
+    async def _loop(self):
+        count = 0
+        while True:
+            full = count % self.full_probe_every == 0
+            count += 1
+            self.probes["full" if full else "cheap"] += 1
+            try:
+                latencies = await self.probe(full)
+                self._record(True, latencies, api_checked=full)
+            except CLINotFoundError:
+                self._status.cli_available = False
+                self._record(False, {})
+            except Exception:
+                self._record(False, {})
+            await asyncio.sleep(self.interval)
+
+    def _record(self, success: bool, latencies_ms: dict, api_checked: bool = True):
+        self.outcomes.append(success)
+        for metric, value in latencies_ms.items():
+            if metric in self.histograms:
+                self.histograms[metric].record(value)
+        if success:
+            self._status.cli_available = True
+            if api_checked:
+                self._status.api_connection = True
+        else:
+            # 軽量プローブの失敗でも、CLI を経由する API 呼び出しは通らない
+            self._status.api_connection = False
+        self._refresh()
+
+    # ------------------------------------------------------------------
+    # 劣化の検知
+    # ------------------------------------------------------------------
+
+    def _refresh(self):
+        status = HealthStatus(
+            cli_available=self._status.cli_available,
+            api_connection=self._status.api_connection,
+            checked_at=time.monotonic()
+        )
+        if self.outcomes:
+            status.failure_rate = self.outcomes.count(False) / len(self.outcomes)
+
+        for metric, rolling in self.histograms.items():
+            snapshot = rolling.snapshot()
+            p50, p95 = snapshot.percentile(50), snapshot.percentile(95)
+            if p50 is None:
+                continue
+            status.percentiles[metric] = {"p50": p50, "p95": p95, "count": snapshot.total}
+
+            # 最初にサンプルが集まった時点の p95 を基準にする
+            if metric not in self.baseline_p95 and snapshot.total >= self.baseline_samples:
+                self.baseline_p95[metric] = p95
+
+            if p95 > self.slo_ms[metric]:
+                status.reasons.append(f"{metric} p95 {p95:.0f}ms > SLO {self.slo_ms[metric]}ms")
+            baseline = self.baseline_p95.get(metric)
+            if baseline and p95 > baseline * self.degradation_factor:
+                status.reasons.append(f"{metric} p95 {p95:.0f}ms > 基準 {baseline:.0f}ms x{self.degradation_factor:g}")
+
+        recent_failures = list(self.outcomes)[-3:]
+        if not self.outcomes:
+            status.state = "unknown"
+        elif status.failure_rate >= 0.5 or (len(recent_failures) == 3 and not any(recent_failures)):
+            status.state = "unhealthy"
+            status.reasons.append(f"失敗率 {status.failure_rate:.0%}")
+        elif status.reasons or status.failure_rate >= 0.1:
+            status.state = "degraded"
+        else:
+            status.state = "healthy"
+
+        if status.state != self._status.state:
+            self.transitions.append((self._status.state, status.state))
+        self._status = status
+
+
+def print_status(status: HealthStatus):
+    print(f"\n状態: {status.state} (受け入れ率 {status.admission_ratio:.0%})")
+    print(f"CLI 利用可能: {status.cli_available}, API 接続: {status.api_connection}")
+    print(f"失敗率: {status.failure_rate:.0%}")
+    for metric, values in status.percentiles.items():
+        print(f"  {metric:<18} p50 {values['p50']:>8.0f}ms  p95 {values['p95']:>8.0f}ms  (n={values['count']})")
+    for reason in status.reasons:
+        print(f"  ! {reason}")
+
+
+async def demo(args: argparse.Namespace):
+    """スタンドイン CLI で劣化を発生させ、状態の変化を確認"""
+    def fake_options(turn_ms: int) -> ClaudeAgentOptions:
+        return ClaudeAgentOptions(
+            cli_path=str(args.cli_path),
+            max_turns=1,
+            env={"FAKE_CLI_STARTUP_MS": "100", "FAKE_CLI_TURN_MS": str(turn_ms)}
+        )
+
+    prober = HealthProber(
+        options=fake_options(30),
+        interval=args.interval,
+        full_probe_every=args.full_probe_every,
+        cache_ttl=1.0,
+        window_seconds=args.phase_seconds
+    )
+
+    async def callers(seconds: float):
+        """多数の呼び出し元が頻繁に状態を問い合わせる"""
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for _ in range(100):
+                prober.is_healthy()
+            await asyncio.sleep(0.01)
+
+    print("=" * 60)
+    print("ヘルスプローバー デモ")
+    print("=" * 60)
+
+    prober.start()
+    try:
+        print(f"\n[フェーズ1] 正常 ({args.phase_seconds}秒)")
+        await callers(args.phase_seconds)
+        print_status(prober.status())
+
+        print(f"\n[フェーズ2] 応答が遅くなる ({args.phase_seconds}秒)")
+        prober.options = fake_options(1500)
+        await callers(args.phase_seconds)
+        print_status(prober.status())
+    finally:
+        await prober.stop()
+
+    print("\n" + "-" * 60)
+    print(f"状態の問い合わせ: {prober.status_requests}回")
+    print(f"実行したプローブ: {prober.probes}")
+    print(f"状態遷移: {' -> '.join([prober.transitions[0][0]] + [t[1] for t in prober.transitions]) if prober.transitions else 'なし'}")
+
+
+async def main_probe():
+    prober = HealthProber(interval=1.0, full_probe_every=3)
+    print("ヘルスプローブ実行中...")
+    prober.start()
+    try:
+        await asyncio.sleep(5.0)
+    finally:
+        await prober.stop()
+    print_status(prober.status())
+    print(f"\n実行したプローブ: {prober.probes}")
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="継続的ヘルスプローブ"
+    )
+    parser.add_argument(
+        "--demo",
+        action="store_true",
+        help="スタンドイン CLI で劣化の検知を確認"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.3,
+        help="デモのプローブ間隔（秒） (default: 0.3)"
+    )
+    parser.add_argument(
+        "--full-probe-every",
+        type=int,
+        default=4,
+        help="デモで何回に1回フルプローブを実行するか (default: 4)"
+    )
+    parser.add_argument(
+        "--phase-seconds",
+        type=float,
+        default=6.0,
+        help="デモの各フェーズの長さ（秒） (default: 6.0)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="デモに使う CLI のパス"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.demo:
+        await demo(args)
+    else:
+        await main_probe()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,506 @@
+"""
+接続プール - 接続済みの ClaudeSDKClient を再利用する
+
+query() はプロンプトごとに CLI プロセスを起動・終了するため、短いクエリでは
+起動とハンドシェイクの時間がレイテンシの大半を占めます。
+接続済みのクライアントをプールしておき、チェックアウトして使い回します。
+
+Usage:
+    python 04_08_connection_pool.py --prompt "Pythonとは何ですか？"
+    python 04_08_connection_pool.py --benchmark --requests 50 --concurrency 4
+    python 04_08_connection_pool.py --benchmark --startup-ms 500 --turn-ms 30
+
+Features:
+    - min_size / max_size によるプールサイズの制御
+    - アイドル接続の回収 (idle_timeout)
+    - 長時間使われていない接続のヘルスチェック
+    - チェックアウトごとの permission_mode / model の上書き
+    - query() と置き換え可能な pooled_query()
+"""
+import argparse
+import asyncio
+import dataclasses
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+from claude_agent_sdk import (
+    ClaudeSDKClient,
+    ClaudeAgentOptions,
+    query,
+    AssistantMessage,
+    ResultMessage,
+    TextBlock
+)
+
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[4] / "test" / "fake_claude_cli.py"
+
+# 接続後に変更できるオプション（それ以外は CLI 起動時に固定される）
+RUNTIME_FIELDS = ("permission_mode", "model")
+
+
+class PooledClient:
+    """プール内の接続1つ分の状態"""
+
+    def __init__(self, client: ClaudeSDKClient, options: ClaudeAgentOptions):
+        self.client = client
+        self.permission_mode = options.permission_mode or "default"
+        self.model = options.model
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+
+
+class ClientPool:
+    """接続済みの ClaudeSDKClient を保持するプール"""
+
+    def __init__(
+        self,
+        options: Optional[ClaudeAgentOptions] = None,
+        min_size: int = 1,
+        max_size: int = 4,
+        idle_timeout: float = 300.0,
+        health_check_interval: float = 30.0,
+        health_check_timeout: float = 10.0,
+        max_uses: Optional[int] = None,
+        reset_command: str = "/clear"
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+
+        self.options = options or ClaudeAgentOptions()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.max_uses = max_uses
+        # 返却時に会話履歴を消去し、次の利用者にコンテキストを漏らさない
+        self.reset_command = reset_command
+
+        self._idle: list[PooledClient] = []
+        self._size = 0
+        self._cond = asyncio.Condition()
+        self._background: set[asyncio.Task] = set()
+        self._reaper: Optional[asyncio.Task] = None
+        self._closed = False
+
+        self.stats = {
+            "created": 0,
+            "reused": 0,
+            "reaped": 0,
+            "unhealthy": 0,
+            "discarded": 0,
+            "waits": 0,
+        }
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    async def start(self):
+        """min_size 個の接続を事前に作成し、回収タスクを開始"""
+        async with self._cond:
+            self._size += self.min_size
+        created = await asyncio.gather(
+            *(self._create() for _ in range(self.min_size)),
+            return_exceptions=True
+        )
+        async with self._cond:
+            for pooled in created:
+                if isinstance(pooled, PooledClient):
+                    self._idle.append(pooled)
+                else:
+                    self._size -= 1
+            self._cond.notify_all()
+
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def close(self):
+        """すべての接続を切断"""
+        self._closed = True
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+        async with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        await asyncio.gather(*(self._disconnect(p) for p in idle), return_exceptions=True)
+
+    @asynccontextmanager
+    async def acquire(self, permission_mode: Optional[str] = None, model: Optional[str] = None):
+        """
+        接続をチェックアウト
+
+        permission_mode / model を指定すると、このチェックアウトの間だけ上書きします。
+        指定しなければプールのオプションの値 (permission_mode は未設定なら "default") に戻すため、
+        前の利用者が上書きしたモードが残ることはありません。
+        受け取ったクライアントでは receive_response() を最後まで読み切ってください。
+        例外で抜けた場合、その接続は再利用せずに破棄されます。
+        """
+        pooled = await self._checkout()
+        healthy = False
+        try:
+            await self._apply_overrides(
+                pooled,
+                permission_mode or self.options.permission_mode or "default",
+                model or self.options.model
+            )
+            yield pooled.client
+            healthy = True
+        finally:
+            self._spawn(self._checkin(pooled, healthy))
+
+    # ------------------------------------------------------------------
+    # 内部処理
+    # ------------------------------------------------------------------
+
+    async def _create(self) -> PooledClient:
+        client = ClaudeSDKClient(self.options)
+        await client.connect()
+        self.stats["created"] += 1
+        return PooledClient(client, self.options)
+
+    async def _disconnect(self, pooled: PooledClient):
+        try:
+            await pooled.client.disconnect()
+        except Exception:
+            pass
+
+    async def _check_health(self, pooled: PooledClient) -> bool:
+        """リセットコマンドを送り、応答が返ってくるかを確認"""
+        try:
+            async with asyncio.timeout(self.health_check_timeout):
+                await pooled.client.query(self.reset_command)
+                async for message in pooled.client.receive_response():
+                    if isinstance(message, ResultMessage):
+                        return not message.is_error
+        except Exception:
+            pass
+        return False
+
+    async def _apply_overrides(self, pooled: PooledClient, permission_mode, model):
+        if permission_mode != pooled.permission_mode:
+            await pooled.client.set_permission_mode(permission_mode)
+            pooled.permission_mode = permission_mode
+        if model != pooled.model:
+            await pooled.client.set_model(model)
+            pooled.model = model
+
+    async def _checkout(self) -> PooledClient:
+        while True:
+            async with self._cond:
+                if self._closed:
+                    raise RuntimeError("ClientPool is closed")
+
+                while not self._idle and self._size >= self.max_size:
+                    self.stats["waits"] += 1
+                    await self._cond.wait()
+
+                if self._idle:
+                    pooled = self._idle.pop()  # LIFO: 直近に使った接続を優先
+                else:
+                    pooled = None
+                    self._size += 1
+
+            if pooled is None:
+                try:
+                    pooled = await self._create()
+                except BaseException:
+                    await self._release_slot()
+                    raise
+            else:
+                stale = time.monotonic() - pooled.last_used > self.health_check_interval
+                if stale and not await self._check_health(pooled):
+                    self.stats["unhealthy"] += 1
+                    await self._disconnect(pooled)
+                    await self._release_slot()
+                    continue
+                self.stats["reused"] += 1
+
+            pooled.uses += 1
+            return pooled
+
+    async def _checkin(self, pooled: PooledClient, healthy: bool):
+        exhausted = self.max_uses is not None and pooled.uses >= self.max_uses
+
+        if healthy and not exhausted and not self._closed:
+            healthy = await self._check_health(pooled)
+
+        if not healthy or exhausted or self._closed:
+            self.stats["discarded"] += 1
+            await self._disconnect(pooled)
+            await self._release_slot()
+            return
+
+        pooled.last_used = time.monotonic()
+        async with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    async def _release_slot(self):
+        async with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    async def _reap_loop(self):
+        """idle_timeout を超えたアイドル接続を min_size まで回収"""
+        interval = max(1.0, min(self.idle_timeout, self.health_check_interval) / 2)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            reaped = []
+            async with self._cond:
+                # 古いものから順に並んでいるので先頭から回収する
+                while (
+                    self._idle
+                    and self._size > self.min_size
+                    and now - self._idle[0].last_used > self.idle_timeout
+                ):
+                    reaped.append(self._idle.pop(0))
+                    self._size -= 1
+            for pooled in reaped:
+                self.stats["reaped"] += 1
+                await self._disconnect(pooled)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+
+# =============================================================================
+# query() 互換 API
+# =============================================================================
+
+_POOLS: dict[tuple, ClientPool] = {}
+
+
+def _pool_key(options: ClaudeAgentOptions) -> tuple:
+    """起動時に固定されるオプションからプールのキーを作る"""
+    return tuple(
+        (f.name, repr(getattr(options, f.name)))
+        for f in dataclasses.fields(options)
+        if f.name not in RUNTIME_FIELDS
+    )
+
+
+async def get_pool(options: Optional[ClaudeAgentOptions] = None, **pool_kwargs) -> ClientPool:
+    """オプションに対応するプールを取得（なければ作成）"""
+    options = options or ClaudeAgentOptions()
+    key = _pool_key(options)
+    pool = _POOLS.get(key)
+    if pool is None:
+        # permission_mode / model はキーに含めないため、プールの既定値にはしない
+        # （チェックアウトごとに pooled_query() が指定する）
+        pool = ClientPool(dataclasses.replace(options, permission_mode=None, model=None), **pool_kwargs)
+        _POOLS[key] = pool
+        await pool.start()
+    return pool
+
+
+async def close_all_pools():
+    """get_pool() で作成したすべてのプールを閉じる"""
+    pools = list(_POOLS.values())
+    _POOLS.clear()
+    await asyncio.gather(*(pool.close() for pool in pools), return_exceptions=True)
+
+
+async def pooled_query(
+    *,
+    prompt: str,
+    options: Optional[ClaudeAgentOptions] = None,
+    pool: Optional[ClientPool] = None
+):
+    """query() と同じ使い方でプール済みの接続を使うクエリ"""
+    options = options or ClaudeAgentOptions()
+    pool = pool or await get_pool(options)
+
+    async with pool.acquire(permission_mode=options.permission_mode, model=options.model) as client:
+        await client.query(prompt)
+        async for message in client.receive_response():
+            yield message
+
+
+# =============================================================================
+# ベンチマーク
+# =============================================================================
+
+def percentile(values: list[float], pct: float) -> float:
+    """最近傍法によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def measure(run_one, requests: int, concurrency: int) -> tuple[list[float], float]:
+    """run_one を requests 回実行し、各リクエストのレイテンシ(ms)と合計時間を返す"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await run_one(f"ベンチマーク {i}")
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(requests)))
+    return latencies, time.perf_counter() - start
+
+
+async def benchmark(args: argparse.Namespace):
+    """スタンドイン CLI に対してプールあり/なしのレイテンシを比較"""
+    options = ClaudeAgentOptions(
+        cli_path=str(args.cli_path),
+        max_turns=3,
+        env={
+            "FAKE_CLI_STARTUP_MS": str(args.startup_ms),
+            "FAKE_CLI_TURN_MS": str(args.turn_ms),
+        }
+    )
+
+    print("=" * 60)
+    print("接続プール ベンチマーク")
+    print("=" * 60)
+    print(f"CLI: {args.cli_path}")
+    print(f"リクエスト数: {args.requests}, 並列数: {args.concurrency}")
+    print(f"CLI 起動時間: {args.startup_ms}ms, ターン時間: {args.turn_ms}ms")
+    print("=" * 60)
+
+    async def unpooled(prompt: str):
+        async for _ in query(prompt=prompt, options=options):
+            pass
+
+    unpooled_latencies, unpooled_total = await measure(unpooled, args.requests, args.concurrency)
+
+    warmup_start = time.perf_counter()
+    pool = ClientPool(options, min_size=args.concurrency, max_size=args.concurrency)
+    await pool.start()
+    warmup_ms = (time.perf_counter() - warmup_start) * 1000
+
+    async def pooled(prompt: str):
+        async for _ in pooled_query(prompt=prompt, options=options, pool=pool):
+            pass
+
+    try:
+        pooled_latencies, pooled_total = await measure(pooled, args.requests, args.concurrency)
+    finally:
+        await pool.close()
+
+    print(f"\n{'':<10} {'p50(ms)':>10} {'p99(ms)':>10} {'mean(ms)':>10} {'req/s':>10}")
+    print("-" * 54)
+    for name, latencies, total in [
+        ("unpooled", unpooled_latencies, unpooled_total),
+        ("pooled", pooled_latencies, pooled_total),
+    ]:
+        mean = sum(latencies) / len(latencies)
+        print(
+            f"{name:<10} {percentile(latencies, 50):>10.1f} {percentile(latencies, 99):>10.1f}"
+            f" {mean:>10.1f} {len(latencies) / total:>10.1f}"
+        )
+    print("-" * 54)
+    print(f"プールのウォームアップ: {warmup_ms:.0f}ms (初回のみ)")
+    print(f"プール統計: {pool.stats}")
+
+
+async def pooled_demo(prompt: str):
+    """pooled_query() を query() の代わりに使う例"""
+    options = ClaudeAgentOptions(max_turns=3)
+
+    try:
+        for i in range(2):
+            print(f"\n=== クエリ {i + 1} ===")
+            start = time.perf_counter()
+            async for message in pooled_query(prompt=prompt, options=options):
+                if isinstance(message, AssistantMessage):
+                    for block in message.content:
+                        if isinstance(block, TextBlock):
+                            print(block.text)
+                elif isinstance(message, ResultMessage):
+                    elapsed = (time.perf_counter() - start) * 1000
+                    print(f"\n応答時間: {elapsed:.0f}ms, コスト: ${message.total_cost_usd:.4f}")
+    finally:
+        await close_all_pools()
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="ClaudeSDKClient の接続プール"
+    )
+    parser.add_argument(
+        "-p", "--prompt",
+        default="Pythonとは何ですか？一文で答えてください。",
+        help="実行するプロンプト"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="スタンドイン CLI でプールあり/なしのレイテンシを比較"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=40,
+        help="ベンチマークのリクエスト数 (default: 40)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="ベンチマークの並列数 (default: 4)"
+    )
+    parser.add_argument(
+        "--startup-ms",
+        type=int,
+        default=300,
+        help="スタンドイン CLI の起動時間 (default: 300)"
+    )
+    parser.add_argument(
+        "--turn-ms",
+        type=int,
+        default=20,
+        help="スタンドイン CLI のターン時間 (default: 20)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="ベンチマークに使う CLI のパス"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.benchmark:
+        await benchmark(args)
+    else:
+        await pooled_demo(args.prompt)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,19 +4,48 @@ plan モード（ドライラン）の使用例
 Usage:
     python 03_plan_mode.py --prompt "テストを実行して修正して"
     python 03_plan_mode.py --review --prompt "README.mdを更新して"
+    python 03_plan_mode.py --review --fresh --prompt "README.mdを更新して"
+    python 03_plan_mode.py --review --speculative --cwd . --prompt "README.mdを更新して"
+    python 03_plan_mode.py --best-of 3 --prompt "parse モジュールをリファクタして"
+    python 03_plan_mode.py --best-of 5 --plan-timeout 120 --plan-weights Edit=4 file=2 --prompt "API クライアントを整理して"
     python 03_plan_mode.py --compare --prompt "src/を分析して"
+    python 03_plan_mode.py --bench-speculative
+    python 03_plan_mode.py --bench-best-of
 
 Features:
-    --review  : プランニング後に確認し、承認後に実行
-    --compare : plan モードと acceptEdits モードの結果を比較
+    --review      : プランニング後に確認し、承認後に実行
+    --fresh       : --review の実行を新しい query() で最初からやり直す（従来の動作）
+    --speculative : --review で計画を確認している間に、作業ディレクトリのコピーで実行を始める（--cwd が必要）
+    --cwd         : 作業ディレクトリ
+    --best-of N   : N 個の計画を並列に立て、予測実行コストが最も低い計画だけを実行
+    --compare     : plan モードと acceptEdits モードの結果を比較（作業ディレクトリのコピーで並列に実行）
+    --bench-speculative : 逐次実行と投機実行の所要時間を比較
+    --bench-best-of     : 計画の数ごとのターン数・コスト・時間を比較
 
 plan モードでは、Claude は実行計画を立てますが、
 実際のツール実行は行いません。
 """
 import argparse
 import asyncio
+import contextlib
+import dataclasses
+import hashlib
+import importlib.util
+import io
+import os
+import re
+import shutil
+import statistics
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
 from claude_agent_sdk import (
     ClaudeAgentOptions,
+    ClaudeSDKClient,
+    HookMatcher,
     query,
     AssistantMessage,
     ResultMessage,
@@ -38,6 +67,63 @@ EXECUTE_OPTIONS = ClaudeAgentOptions(
     allowed_tools=["Read", "Write", "Edit", "Glob", "Grep"]
 )
 
+def plan_options(options: ClaudeAgentOptions) -> ClaudeAgentOptions:
+    """
+    実行時の設定から、計画の段階の設定を作る
+
+    cli_path / cwd / env などはそのままに plan モードにし、PLAN_OPTIONS の許可ツールのうち
+    options にないもの (Bash など) を加えます。同じセッションで acceptEdits に切り替えても
+    実行時の許可ツールが広がらないよう、加えたツールは plan モードの間だけ許可します。
+    """
+    allowed = list(options.allowed_tools)
+    added = [tool for tool in PLAN_OPTIONS.allowed_tools if allowed and tool not in allowed]
+    if not added:
+        return dataclasses.replace(options, permission_mode="plan")
+
+    async def plan_only(input_data, tool_use_id, context):
+        if input_data.get("tool_name") not in added or input_data.get("permission_mode") == "plan":
+            return {}
+        return {
+            "hookSpecificOutput": {
+                "hookEventName": "PreToolUse",
+                "permissionDecision": "deny",
+                "permissionDecisionReason": f"{input_data['tool_name']} は計画の段階でのみ許可されています",
+            }
+        }
+
+    hooks = dict(options.hooks or {})
+    hooks["PreToolUse"] = [*hooks.get("PreToolUse", []), HookMatcher(hooks=[plan_only])]
+    return dataclasses.replace(options, permission_mode="plan", allowed_tools=allowed + added, hooks=hooks)
+
+
+# 承認後、同じセッションで送るプロンプト
+EXECUTE_PROMPT = "承認された計画どおりに実行してください。"
+
+# best-of-N: 計画の予測実行コスト (手順の種類ごとの重みと、触るファイル1つあたりの重み)
+PLAN_WEIGHTS = {"Edit": 3.0, "Write": 3.0, "Bash": 2.0, "Read": 1.0, "file": 1.0}
+
+# 計画の手順の種類を判定するキーワード (上から順に最初に一致したもの)
+PLAN_ACTIONS = {
+    "Write": re.compile(r"作成|新規|追加|create|add|write", re.IGNORECASE),
+    "Bash": re.compile(r"実行|テスト|インストール|ビルド|run|test|install|build", re.IGNORECASE),
+    "Edit": re.compile(
+        r"編集|修正|変更|更新|削除|置き換|リファクタ|edit|fix|change|update|modify|remove|replace|refactor",
+        re.IGNORECASE,
+    ),
+    "Read": re.compile(r"確認|調査|読|check|read|inspect|review", re.IGNORECASE),
+}
+PLAN_STEP = re.compile(r"^\s*(?:\d+[.)]|[-*・])\s+(.+)$", re.MULTILINE)
+PLAN_FILE = re.compile(r"(?<![\w/.:-])(?:[\w-]+/)*[\w-]+\.[A-Za-z]{1,5}\b")
+
+# 投機実行で作業ディレクトリをコピーするときに除くもの
+SPECULATIVE_IGNORE = [".git", "__pycache__", ".venv", "node_modules"]
+# 投機実行でコピーする作業ディレクトリの上限（超えたら承認後に同じセッションで実行する）
+SPECULATIVE_MAX_FILES = 5000
+SPECULATIVE_MAX_BYTES = 100 * 1024 * 1024
+
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[3] / "test" / "fake_claude_cli.py"
+
 
 def parse_args() -> argparse.Namespace:
     """コマンドライン引数をパース"""
@@ -54,11 +140,122 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="プランニング後に確認し、承認後に実行"
     )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="--review の実行を新しい query() で最初からやり直す (従来の動作)"
+    )
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="--review で計画を確認している間に、作業ディレクトリのコピーで実行を始める (--cwd が必要)"
+    )
+    parser.add_argument(
+        "--cwd",
+        help="作業ディレクトリ (default: カレントディレクトリ)"
+    )
+    parser.add_argument(
+        "--bench-speculative",
+        action="store_true",
+        help="スタンドイン CLI で逐次実行と投機実行の所要時間を比較"
+    )
+    parser.add_argument(
+        "--review-sec",
+        type=float,
+        nargs="+",
+        default=[0.5, 1.5, 3.0],
+        help="--bench-speculative で計画の確認にかかる時間 (default: 0.5 1.5 3.0)"
+    )
+    parser.add_argument(
+        "--task-turns",
+        type=int,
+        default=16,
+        help="--bench-speculative のタスクに必要なターン数 (default: 16)"
+    )
+    parser.add_argument(
+        "--edit-steps",
+        type=int,
+        default=5,
+        help="--bench-speculative のうち編集のターン数 (default: 5)"
+    )
+    parser.add_argument(
+        "--turn-ms",
+        type=int,
+        default=200,
+        help="--bench-speculative の1ターンの応答時間 (default: 200)"
+    )
+    parser.add_argument(
+        "--startup-ms",
+        type=int,
+        default=300,
+        help="--bench-speculative の CLI 起動時間 (default: 300)"
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=500,
+        help="--bench-speculative の作業ディレクトリのファイル数 (default: 500)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="--bench-speculative に使う CLI のパス"
+    )
+    parser.add_argument(
+        "--best-of",
+        type=int,
+        default=0,
+        metavar="N",
+        help="N 個の計画を並列に立て、予測実行コストが最も低い計画を実行"
+    )
+    parser.add_argument(
+        "--plan-weights",
+        nargs="+",
+        default=[],
+        metavar="KEY=WEIGHT",
+        help=f"--best-of のスコアの重み (default: {' '.join(f'{k}={v:g}' for k, v in PLAN_WEIGHTS.items())})"
+    )
+    parser.add_argument(
+        "--plan-timeout",
+        type=float,
+        help="--best-of の計画の段階のタイムアウト秒 (default: なし)"
+    )
+    parser.add_argument(
+        "--bench-best-of",
+        action="store_true",
+        help="スタンドイン CLI で、計画の数ごとのターン数・コスト・時間を比較"
+    )
+    parser.add_argument(
+        "--bench-n",
+        type=int,
+        nargs="+",
+        default=[1, 3, 5],
+        help="--bench-best-of で比較する計画の数 (default: 1 3 5)"
+    )
+    parser.add_argument(
+        "--explore-turns",
+        type=int,
+        default=3,
+        help="--bench-best-of の計画前の調査ターン数 (default: 3)"
+    )
+    parser.add_argument(
+        "--max-edit-steps",
+        type=int,
+        default=30,
+        help="--bench-best-of の編集ターン数の上限 (--edit-steps〜この値, default: 30)"
+    )
     parser.add_argument(
         "--compare",
         action="store_true",
         help="plan モードと acceptEdits モードの結果を比較"
     )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=1,
+        help="--compare でモードごとに、--bench-best-of で計画の数ごとに繰り返す回数 (default: 1)"
+    )
     return parser.parse_args()
 
 
@@ -91,35 +288,245 @@ async def simple_plan(prompt: str):
             print(f"コスト: ${message.total_cost_usd:.4f}")
 
 
-async def review_and_execute(prompt: str):
-    """プランニング後に確認し、承認後に実行"""
-    print("=" * 60)
-    print("実行前レビューモード")
-    print("=" * 60)
-    print(f"プロンプト: {prompt}")
-    print("=" * 60)
+# =============================================================================
+# 投機実行
+# =============================================================================
 
-    # Step 1: プランニング
-    print("\n" + "=" * 60)
-    print("Step 1: プランニング (plan モード)")
-    print("=" * 60)
+def exceeds_limit(root: Path, max_files: int, max_bytes: int) -> Optional[str]:
+    """root 以下（SPECULATIVE_IGNORE は除く）が上限を超えていれば理由を返す"""
+    files = size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in SPECULATIVE_IGNORE]
+        for name in filenames:
+            files += 1
+            with contextlib.suppress(OSError):
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            if files > max_files:
+                return f"ファイル数が上限 ({max_files}) を超えています"
+            if size > max_bytes:
+                return f"サイズが上限 ({max_bytes // (1024 * 1024)}MB) を超えています"
+    return None
 
-    plan_text = []
-    async for message in query(prompt=prompt, options=PLAN_OPTIONS):
-        if isinstance(message, AssistantMessage):
-            for block in message.content:
-                if isinstance(block, TextBlock):
-                    plan_text.append(block.text)
-                    print(block.text)
-                elif isinstance(block, ToolUseBlock):
-                    tool_info = f"\n[ツール: {block.name}] {block.input}"
-                    plan_text.append(tool_info)
-                    print(tool_info)
 
-        elif isinstance(message, ResultMessage):
-            print(f"\n計画コスト: ${message.total_cost_usd:.4f}")
+def snapshot(root: Path) -> dict[str, str]:
+    """root 以下のファイルの相対パスとハッシュ（SPECULATIVE_IGNORE は除く）"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in SPECULATIVE_IGNORE]
+        for name in filenames:
+            path = Path(dirpath) / name
+            files[path.relative_to(root).as_posix()] = hashlib.sha256(path.read_bytes()).hexdigest()
+    return files
+
+
+@dataclass
+class ChangeSet:
+    """サンドボックスでの変更（作業ディレクトリからの相対パス）"""
+    written: dict[str, Path] = field(default_factory=dict)  # 追加・変更したファイル -> サンドボックス内のパス
+    deleted: list[str] = field(default_factory=list)
+    base: dict[str, str] = field(default_factory=dict)  # コピーした時点のハッシュ
+
+    def __len__(self) -> int:
+        return len(self.written) + len(self.deleted)
+
+    def conflicts(self, root: Path) -> list[str]:
+        """コピーしたあとに作業ディレクトリ側でも変わったファイル"""
+        conflicts = []
+        for rel in [*self.written, *self.deleted]:
+            target = root / rel
+            current = hashlib.sha256(target.read_bytes()).hexdigest() if target.is_file() else None
+            if current != self.base.get(rel):
+                conflicts.append(rel)
+        return conflicts
+
+    def apply(self, root: Path):
+        """
+        変更を作業ディレクトリにまとめて反映
+
+        新しい内容をすべて同じディレクトリの一時ファイルに書いてから os.replace() で置き換え、
+        途中で失敗したら元のファイルを戻します（一部だけが反映された状態を残さない）。
+        """
+        staged: list[tuple[Path, Path]] = []
+        backups: list[tuple[Path, Path]] = []
+        replaced: list[Path] = []
+        try:
+            for rel, source in self.written.items():
+                target = root / rel
+                target.parent.mkdir(parents=True, exist_ok=True)
+                tmp = target.with_name(f".{target.name}.speculative")
+                shutil.copy2(source, tmp)
+                staged.append((tmp, target))
+            for target in [t for _, t in staged] + [root / rel for rel in self.deleted]:
+                if target.exists():
+                    backup = target.with_name(f".{target.name}.backup")
+                    shutil.copy2(target, backup)
+                    backups.append((backup, target))
+            for tmp, target in staged:
+                os.replace(tmp, target)
+                replaced.append(target)
+            for rel in self.deleted:
+                (root / rel).unlink(missing_ok=True)
+                replaced.append(root / rel)
+        except BaseException:
+            restored = {target for _, target in backups}
+            for backup, target in backups:
+                os.replace(backup, target)
+            for target in replaced:
+                if target not in restored:
+                    target.unlink(missing_ok=True)
+            for tmp, _ in staged:
+                tmp.unlink(missing_ok=True)
+            raise
+        for backup, _ in backups:
+            backup.unlink()
+
+
+class SpeculativeRun:
+    """
+    計画の承認を待つ間に、作業ディレクトリのコピーで acceptEdits の実行を始める
+
+    start() で作業ディレクトリを一時ディレクトリにコピーし、別のセッションで実行を始めます。
+    承認されたら changes() で変更を集めて ChangeSet.apply() で反映し、
+    却下されたら discard() で中断してコピーごと捨てます。
+    作業ディレクトリが max_files / max_bytes を超える場合、start() はコピーせずに False を返します。
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        options: ClaudeAgentOptions,
+        max_files: int = SPECULATIVE_MAX_FILES,
+        max_bytes: int = SPECULATIVE_MAX_BYTES
+    ):
+        self.root = Path(root).resolve()
+        self.options = options
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.sandbox: Optional[Path] = None
+        self.base: dict[str, str] = {}
+        self.tools: list[str] = []
+        self.result: Optional[ResultMessage] = None
+        self.error: Optional[str] = None
+        self.started = 0.0
+        self.finished = 0.0
+        self._tmp: Optional[tempfile.TemporaryDirectory] = None
+        self._client: Optional[ClaudeSDKClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def prompt(prompt: str, plan_text: list) -> str:
+        """別のセッションで実行するためのプロンプト（計画を添える）"""
+        plan = "\n".join(plan_text)
+        return f"{prompt}\n\n以下の計画はすでに承認されています。計画どおりに実行してください。\n\n{plan}"
+
+    async def start(self, prompt: str) -> bool:
+        self.started = time.perf_counter()
+        self.error = await asyncio.to_thread(exceeds_limit, self.root, self.max_files, self.max_bytes)
+        if self.error is not None:
+            return False
+        self._tmp = tempfile.TemporaryDirectory(prefix="speculative-")
+        self.sandbox = Path(self._tmp.name) / self.root.name
+        await asyncio.to_thread(
+            shutil.copytree, self.root, self.sandbox, symlinks=True,
+            ignore=shutil.ignore_patterns(*SPECULATIVE_IGNORE)
+        )
+        self.base = await asyncio.to_thread(snapshot, self.sandbox)
+        self._task = asyncio.create_task(self._run(prompt))
+        return True
+
+    async def _run(self, prompt: str):
+        options = dataclasses.replace(self.options, cwd=str(self.sandbox), permission_mode="acceptEdits")
+        try:
+            async with ClaudeSDKClient(options) as client:
+                self._client = client
+                await client.query(prompt)
+                async for message in client.receive_response():
+                    if isinstance(message, AssistantMessage):
+                        self.tools.extend(b.name for b in message.content if isinstance(b, ToolUseBlock))
+                    elif isinstance(message, ResultMessage):
+                        self.result = message
+        except Exception as e:
+            # 投機実行の失敗は、同じセッションでの実行にフォールバックする
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            self.finished = time.perf_counter()
+
+    @property
+    def succeeded(self) -> bool:
+        """最後まで正常に実行できたか（途中で止まった変更は反映しない）"""
+        if self.error is not None or self.result is None:
+            return False
+        return not self.result.is_error
+
+    @property
+    def failure(self) -> str:
+        if self.error is not None:
+            return self.error
+        return self.result.subtype if self.result else "結果なし"
+
+    @property
+    def cost(self) -> float:
+        return (self.result.total_cost_usd or 0.0) if self.result else 0.0
+
+    async def changes(self) -> ChangeSet:
+        """実行の完了を待ち、コピーした時点からの変更を返す"""
+        await self._task
+        current = await asyncio.to_thread(snapshot, self.sandbox)
+        return ChangeSet(
+            written={rel: self.sandbox / rel for rel, digest in current.items() if self.base.get(rel) != digest},
+            deleted=[rel for rel in self.base if rel not in current],
+            base=self.base,
+        )
+
+    async def discard(self):
+        """実行中なら中断し、コピーを削除"""
+        if self._task and not self._task.done():
+            if self._client is not None:
+                with contextlib.suppress(Exception):
+                    await self._client.interrupt()
+            try:
+                await asyncio.wait_for(self._task, timeout=10)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+
+
+def print_plan_message(message, plan_text: list):
+    """計画の段階のメッセージを表示し、計画として記録"""
+    if isinstance(message, AssistantMessage):
+        for block in message.content:
+            if isinstance(block, TextBlock):
+                plan_text.append(block.text)
+                print(block.text)
+            elif isinstance(block, ToolUseBlock):
+                tool_info = f"\n[ツール: {block.name}] {block.input}"
+                plan_text.append(tool_info)
+                print(tool_info)
+
+    elif isinstance(message, ResultMessage):
+        print(f"\n計画コスト: ${message.total_cost_usd:.4f}")
+
 
-    # Step 2: 確認
+def print_execute_message(message):
+    """実行の段階のメッセージを表示"""
+    if isinstance(message, AssistantMessage):
+        for block in message.content:
+            if isinstance(block, TextBlock):
+                print(block.text)
+            elif isinstance(block, ToolUseBlock):
+                print(f"\n[実行] {block.name}")
+
+    elif isinstance(message, ResultMessage):
+        print("\n" + "=" * 60)
+        print("実行完了")
+        print(f"使用ターン: {message.num_turns}")
+        print(f"コスト: ${message.total_cost_usd:.4f}")
+
+
+def ask_approval() -> bool:
+    """計画の実行を確認"""
     print("\n" + "=" * 60)
     print("Step 2: 確認")
     print("=" * 60)
@@ -131,113 +538,554 @@ async def review_and_execute(prompt: str):
 
     if approval.lower() != "y":
         print("\nキャンセルしました")
-        return
+        return False
+    return True
 
-    # Step 3: 実行
-    print("\n" + "=" * 60)
-    print("Step 3: 実行 (acceptEdits モード)")
-    print("=" * 60)
 
-    async for message in query(prompt=prompt, options=EXECUTE_OPTIONS):
-        if isinstance(message, AssistantMessage):
-            for block in message.content:
-                if isinstance(block, TextBlock):
-                    print(block.text)
-                elif isinstance(block, ToolUseBlock):
-                    print(f"\n[実行] {block.name}")
+async def review_and_execute(
+    prompt: str,
+    fresh: bool = False,
+    speculative: bool = False,
+    options: Optional[ClaudeAgentOptions] = None,
+    approve: Optional[Callable[[], Awaitable[bool]]] = None
+) -> dict:
+    """
+    プランニング後に確認し、承認後に実行
 
-        elif isinstance(message, ResultMessage):
-            print("\n" + "=" * 60)
-            print("実行完了")
-            print(f"使用ターン: {message.num_turns}")
-            print(f"コスト: ${message.total_cost_usd:.4f}")
+    デフォルトでは1つの ClaudeSDKClient セッションで plan モードから acceptEdits に切り替え、
+    計画を立てたときに読んだファイルと計画をそのまま使って実行します。
+    fresh=True では実行の段階で同じプロンプトを新しい query() で最初から実行します（従来の動作）。
+
+    speculative=True では、計画を確認している間に作業ディレクトリ (options.cwd) のコピーで実行を始め
+    (SpeculativeRun)、承認されたら変更をまとめて反映、却下されたら破棄します。
+    options.cwd がない場合や、作業ディレクトリがコピーの上限を超える場合は投機実行しません。
+    投機実行がエラーで終わった場合 (max_turns 到達を含む) や、確認中に作業ディレクトリ側で
+    同じファイルが変わっていた場合は反映せず、同じセッションで実行し直します。
+    options は実行時の設定 (default: EXECUTE_OPTIONS)、approve は承認を返すコルーチン関数です
+    (default: 標準入力で確認)。
+    """
+    options = options or EXECUTE_OPTIONS
+    approve = approve or (lambda: asyncio.to_thread(ask_approval))
+    report = {"approved": False, "speculative": False, "turns": 0, "cost": 0.0, "wasted_cost": 0.0}
+
+    def account(message):
+        if isinstance(message, ResultMessage):
+            report["turns"] += message.num_turns
+            report["cost"] += message.total_cost_usd or 0.0
 
+    # カレントディレクトリ全体を誤ってコピーしないよう、作業ディレクトリの指定を求める
+    no_cwd = speculative and not fresh and options.cwd is None
+    speculative = speculative and not fresh and not no_cwd
 
-async def compare_modes(prompt: str):
-    """plan モードと acceptEdits モードを比較"""
     print("=" * 60)
-    print("モード比較")
+    print("実行前レビューモード")
     print("=" * 60)
     print(f"プロンプト: {prompt}")
+    print(f"セッション: {'実行時に新規' if fresh else '継続'}")
+    print(f"投機実行: {'ON' if speculative else 'OFF'}")
+    if no_cwd:
+        print("⚠️ 投機実行には作業ディレクトリ (options.cwd / --cwd) の指定が必要です。承認後に同じセッションで実行します")
     print("=" * 60)
 
-    results = {}
+    plan_text = []
+    if fresh:
+        # Step 1: プランニング
+        print("\n" + "=" * 60)
+        print("Step 1: プランニング (plan モード)")
+        print("=" * 60)
+        async for message in query(prompt=prompt, options=plan_options(options)):
+            print_plan_message(message, plan_text)
+            account(message)
 
-    # plan モード
-    print("\n" + "=" * 60)
-    print("【plan モード】")
-    print("=" * 60)
+        if not await approve():
+            return report
+        report["approved"] = True
+        report["approved_at"] = time.perf_counter()
 
-    plan_tools = []
-    async for message in query(prompt=prompt, options=PLAN_OPTIONS):
-        if isinstance(message, AssistantMessage):
-            for block in message.content:
-                if isinstance(block, TextBlock):
-                    # 最初の100文字のみ
-                    text = block.text[:100] + "..." if len(block.text) > 100 else block.text
-                    print(f"[Text] {text}")
-                elif isinstance(block, ToolUseBlock):
-                    plan_tools.append(block.name)
-                    print(f"[計画ツール] {block.name}")
+        # Step 3: 実行
+        print("\n" + "=" * 60)
+        print("Step 3: 実行 (acceptEdits モード)")
+        print("=" * 60)
+        async for message in query(prompt=prompt, options=options):
+            print_execute_message(message)
+            account(message)
+        report["done_at"] = time.perf_counter()
+        return report
 
-        elif isinstance(message, ResultMessage):
-            results["plan"] = {
-                "turns": message.num_turns,
-                "cost": message.total_cost_usd,
-                "tools": plan_tools
-            }
+    # 実行時の設定で接続し、plan モードから始める
+    async with ClaudeSDKClient(plan_options(options)) as client:
+        print("\n" + "=" * 60)
+        print("Step 1: プランニング (plan モード)")
+        print("=" * 60)
+        await client.query(prompt)
+        async for message in client.receive_response():
+            print_plan_message(message, plan_text)
+            account(message)
 
-    # acceptEdits モード
-    print("\n" + "=" * 60)
-    print("【acceptEdits モード】")
+        speculation = None
+        if speculative:
+            speculation = SpeculativeRun(Path(options.cwd), options)
+            if await speculation.start(SpeculativeRun.prompt(prompt, plan_text)):
+                print(f"\n⚡ 確認を待つ間に実行を開始: {speculation.sandbox}")
+            else:
+                print(f"\n⚠️ 投機実行しません ({speculation.error})。承認後に同じセッションで実行します")
+                speculation = None
+
+        try:
+            approved = await approve()
+            if not approved:
+                if speculation:
+                    await speculation.discard()
+                    account(speculation.result)
+                    report["wasted_cost"] = speculation.cost
+                    print(f"🗑️ 投機実行の変更を破棄しました (コスト ${report['wasted_cost']:.4f})")
+                return report
+            report["approved"] = True
+            report["approved_at"] = time.perf_counter()
+
+            if speculation:
+                print("\n" + "=" * 60)
+                print("Step 3: 投機実行の結果を反映")
+                print("=" * 60)
+                changes = await speculation.changes()
+                account(speculation.result)
+                root = speculation.root
+                conflicts = changes.conflicts(root) if speculation.succeeded else []
+                if speculation.succeeded and not conflicts:
+                    changes.apply(root)
+                    report["speculative"] = True
+                    report["done_at"] = time.perf_counter()
+                    for tool in speculation.tools:
+                        print(f"[実行] {tool}")
+                    print(f"\n✅ 変更を反映しました: 追加・変更 {len(changes.written)}件, 削除 {len(changes.deleted)}件")
+                    for rel in [*changes.written, *changes.deleted]:
+                        print(f"  - {rel}")
+                    print(f"確認を待つ間に実行済み: {speculation.finished - speculation.started:.2f}秒")
+                    return report
+                report["wasted_cost"] = speculation.cost
+                if conflicts:
+                    print(f"\n⚠️ 確認中に変更されたファイルがあるため、投機実行の結果は反映しません: {', '.join(conflicts)}")
+                else:
+                    print(f"\n⚠️ 投機実行が完了しなかったため、結果は反映しません: {speculation.failure}")
+        finally:
+            if speculation:
+                await speculation.discard()
+
+        print("\n" + "=" * 60)
+        print("Step 3: 実行 (acceptEdits モード, 同じセッション)")
+        print("=" * 60)
+        await client.set_permission_mode("acceptEdits")
+        await client.query(EXECUTE_PROMPT)
+        async for message in client.receive_response():
+            print_execute_message(message)
+            account(message)
+        report["done_at"] = time.perf_counter()
+    return report
+
+
+def score_plan(plan: str, weights: Optional[dict[str, float]] = None) -> tuple[float, Counter, set[str]]:
+    """
+    計画の予測実行コスト
+
+    計画の手順 (番号付き・箇条書きの行) を PLAN_ACTIONS で種類ごとに数え、
+    手順の重みと触るファイル数の重みの合計を返します。
+    どの種類にも当たらない行 (見出しや補足) は手順として数えません。
+    """
+    weights = {**PLAN_WEIGHTS, **(weights or {})}
+    steps = Counter()
+    for line in PLAN_STEP.findall(plan):
+        for action, pattern in PLAN_ACTIONS.items():
+            if pattern.search(line):
+                steps[action] += 1
+                break
+    files = set(PLAN_FILE.findall(plan))
+    score = sum(weights.get(action, 0.0) * count for action, count in steps.items())
+    score += weights.get("file", 0.0) * len(files)
+    return round(score, 2), steps, files
+
+
+class PlanCandidate:
+    """
+    best-of-N の候補1つ
+
+    自分のタスクの中で ClaudeSDKClient に接続して plan モードで計画を立て、
+    選ばれたら同じセッションで acceptEdits に切り替えて実行し、選ばれなければ切断します。
+    """
+
+    def __init__(self, index: int, prompt: str, options: ClaudeAgentOptions):
+        self.index = index
+        self.prompt = prompt
+        self.options = options
+        self.status = "planning"
+        self.plan = ""
+        self.tools: list[str] = []
+        self.plan_turns = 0
+        self.plan_cost = 0.0
+        self.execute_turns = 0
+        self.execute_cost = 0.0
+        self.score = float("inf")
+        self.steps = Counter()
+        self.files: set[str] = set()
+        self.planned = asyncio.Event()
+        self._decision: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._client: Optional[ClaudeSDKClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def viable(self) -> bool:
+        """実行できる計画か (計画が完了し、手順が1つ以上ある)"""
+        return self.status == "ok" and sum(self.steps.values()) > 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            async with ClaudeSDKClient(plan_options(self.options)) as client:
+                self._client = client
+                await client.query(self.prompt)
+                text = []
+                async for message in client.receive_response():
+                    if isinstance(message, AssistantMessage):
+                        for block in message.content:
+                            if isinstance(block, TextBlock):
+                                text.append(block.text)
+                            elif isinstance(block, ToolUseBlock):
+                                if block.name == "ExitPlanMode" and isinstance(block.input.get("plan"), str):
+                                    text.append(block.input["plan"])
+                                else:
+                                    self.tools.append(block.name)
+                    elif isinstance(message, ResultMessage):
+                        self.plan_turns = message.num_turns
+                        self.plan_cost = message.total_cost_usd or 0.0
+                        if self.status == "planning":
+                            self.status = "error" if message.is_error else "ok"
+                self.plan = "\n".join(text).strip()
+                self.planned.set()
+
+                if not await self._decision:
+                    return
+                await client.set_permission_mode("acceptEdits")
+                await client.query(EXECUTE_PROMPT)
+                async for message in client.receive_response():
+                    print_execute_message(message)
+                    if isinstance(message, ResultMessage):
+                        self.execute_turns = message.num_turns
+                        self.execute_cost = message.total_cost_usd or 0.0
+        except Exception as e:
+            if self.status in ("planning", "ok"):
+                self.status = f"error ({type(e).__name__})"
+        finally:
+            self.planned.set()
+            if not self._decision.done():
+                self._decision.set_result(False)
+
+    async def timeout(self):
+        """計画が時間内に終わらなかった候補を中断"""
+        self.status = "timeout"
+        if self._client is None:
+            # まだ接続中なら、接続ごと取り消す
+            if self._task is not None:
+                self._task.cancel()
+        else:
+            with contextlib.suppress(Exception):
+                await self._client.interrupt()
+        self.decide(False)
+
+    def decide(self, execute: bool):
+        if not self._decision.done():
+            self._decision.set_result(execute)
+
+    async def wait(self):
+        if self._task is not None:
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+
+async def best_of_n_plans(
+    prompt: str,
+    n: int = 3,
+    weights: Optional[dict[str, float]] = None,
+    timeout: Optional[float] = None,
+    options: Optional[ClaudeAgentOptions] = None,
+    approve: Optional[Callable[[], Awaitable[bool]]] = None
+) -> dict:
+    """
+    N 個の計画を並列に立て、予測実行コストが最も低い計画だけを実行
+
+    各候補は別々のセッションで同時に plan モードの計画を立てます。
+    timeout 秒までに終わらなかった候補は中断して除き、残りを score_plan() で順位付けします。
+    選んだ計画は、その計画を立てたセッションで acceptEdits に切り替えて実行します。
+    options は実行時の設定 (default: EXECUTE_OPTIONS)、approve は承認を返すコルーチン関数です
+    (default: 標準入力で確認)。
+    """
+    options = options or EXECUTE_OPTIONS
+    approve = approve or (lambda: asyncio.to_thread(ask_approval))
+    report = {"approved": False, "chosen": None, "plan_turns": 0, "plan_cost": 0.0,
+              "execute_turns": 0, "execute_cost": 0.0}
+
+    print("=" * 60)
+    print(f"best-of-{n} プランニング")
+    print("=" * 60)
+    print(f"プロンプト: {prompt}")
+    print(f"計画のタイムアウト: {f'{timeout}秒' if timeout else 'なし'}")
     print("=" * 60)
 
-    exec_tools = []
-    async for message in query(prompt=prompt, options=EXECUTE_OPTIONS):
-        if isinstance(message, AssistantMessage):
-            for block in message.content:
-                if isinstance(block, TextBlock):
-                    text = block.text[:100] + "..." if len(block.text) > 100 else block.text
-                    print(f"[Text] {text}")
-                elif isinstance(block, ToolUseBlock):
-                    exec_tools.append(block.name)
-                    print(f"[実行ツール] {block.name}")
+    candidates = [PlanCandidate(i + 1, prompt, options) for i in range(n)]
+    for candidate in candidates:
+        candidate.start()
 
-        elif isinstance(message, ResultMessage):
-            results["execute"] = {
-                "turns": message.num_turns,
-                "cost": message.total_cost_usd,
-                "tools": exec_tools
-            }
+    try:
+        # Step 1: 並列に計画
+        _, pending = await asyncio.wait(
+            [asyncio.create_task(c.planned.wait()) for c in candidates], timeout=timeout
+        )
+        for task in pending:
+            task.cancel()
+        for candidate in candidates:
+            if not candidate.planned.is_set():
+                await candidate.timeout()
+            elif candidate.status == "ok":
+                candidate.score, candidate.steps, candidate.files = score_plan(candidate.plan, weights)
 
-    # 比較結果
-    print("\n" + "=" * 60)
-    print("比較結果")
+        viable = sorted((c for c in candidates if c.viable), key=lambda c: (c.score, c.plan_turns))
+        chosen = viable[0] if viable else None
+
+        print(f"\n{'候補':>4} {'状態':<10} {'計画ターン':>10} {'コスト($)':>10} {'手順':<28} {'ファイル':>8} {'スコア':>8}")
+        print("-" * 86)
+        for c in candidates:
+            steps = ", ".join(f"{action} {count}" for action, count in c.steps.most_common()) or "-"
+            score = f"{c.score:.1f}" if c.viable else "-"
+            mark = " ◀" if c is chosen else ""
+            print(
+                f"{c.index:>4} {c.status:<10} {c.plan_turns:>10} {c.plan_cost:>10.4f}"
+                f" {steps:<28} {len(c.files):>8} {score:>8}{mark}"
+            )
+        print("-" * 86)
+
+        if chosen is None:
+            print("\n実行できる計画がありません")
+            return report
+
+        report["chosen"] = chosen.index
+        print(f"\n[候補 {chosen.index} の計画]")
+        print(chosen.plan)
+        for c in candidates:
+            if c is not chosen:
+                c.decide(False)
+
+        if not await approve():
+            return report
+        report["approved"] = True
+
+        # Step 3: 選んだ計画を同じセッションで実行
+        print("\n" + "=" * 60)
+        print(f"Step 3: 実行 (acceptEdits モード, 候補 {chosen.index} のセッション)")
+        print("=" * 60)
+        chosen.decide(True)
+        await chosen.wait()
+        report["execute_turns"] = chosen.execute_turns
+        report["execute_cost"] = chosen.execute_cost
+    finally:
+        for c in candidates:
+            c.decide(False)
+        await asyncio.gather(*(c.wait() for c in candidates))
+        report["plan_turns"] = sum(c.plan_turns for c in candidates)
+        report["plan_cost"] = sum(c.plan_cost for c in candidates)
+    return report
+
+
+def make_project(root: Path, files: int):
+    """ベンチマーク用の作業ディレクトリ（app.py と files 個のモジュール、.git）"""
+    (root / "pkg").mkdir(parents=True)
+    (root / ".git").mkdir()
+    (root / ".git" / "HEAD").write_text("ref: refs/heads/main\n")
+    (root / "app.py").write_text("# app\n")
+    for i in range(files):
+        (root / "pkg" / f"module_{i}.py").write_text(f"def f{i}():\n    return {i}\n" * 20)
+
+
+async def benchmark_speculative(args: argparse.Namespace):
+    """スタンドイン CLI で、逐次実行と投機実行の所要時間を比較"""
+    explore = args.task_turns - args.edit_steps - 1
+    print("=" * 86)
+    print(f"スタンドイン CLI: 調査 {explore}ターン + 編集 {args.edit_steps}ターン + 報告 1ターン,"
+          f" 1ターン {args.turn_ms}ms, 作業ディレクトリ {args.files + 1}ファイル")
+    print("=" * 86)
+
+    async def run_case(review_sec: float, speculative: bool, decision: str = "approve"):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp) / "project"
+            make_project(root, args.files)
+            state_dir = Path(tmp) / "state"
+            state_dir.mkdir()
+            options = dataclasses.replace(
+                EXECUTE_OPTIONS,
+                cwd=str(root),
+                cli_path=str(args.cli_path),
+                env={
+                    "FAKE_CLI_STARTUP_MS": str(args.startup_ms),
+                    "FAKE_CLI_TURN_MS": str(args.turn_ms),
+                    "FAKE_CLI_TURNS": str(args.task_turns),
+                    "FAKE_CLI_EDIT_STEPS": str(args.edit_steps),
+                    "FAKE_CLI_EDIT_FILE": "app.py",
+                    "FAKE_CLI_STATE_DIR": str(state_dir),
+                }
+            )
+
+            async def approve() -> bool:
+                await asyncio.sleep(review_sec)
+                if decision == "conflict":
+                    # 確認している間に、同じファイルを手で編集した
+                    with open(root / "app.py", "a", encoding="utf-8") as f:
+                        f.write("# edited during review\n")
+                return decision != "reject"
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                report = await review_and_execute(
+                    "app.py を修正して", speculative=speculative, options=options, approve=approve
+                )
+            end = time.perf_counter()
+            edits = (root / "app.py").read_text().count("step-")
+        return report, start, end, edits
+
+    rows = []
+    for review_sec in args.review_sec:
+        for speculative in [False, True]:
+            rows.append((f"{review_sec:.1f}s", "投機実行" if speculative else "逐次 (承認後に実行)",
+                         *await run_case(review_sec, speculative)))
+    rows.append((f"{args.review_sec[0]:.1f}s", "投機実行 / 却下", *await run_case(args.review_sec[0], True, "reject")))
+    rows.append((f"{args.review_sec[0]:.1f}s", "投機実行 / 確認中に編集", *await run_case(args.review_sec[0], True, "conflict")))
+
+    print(f"\n{'確認':>5} {'方式':<24} {'合計時間(s)':>11} {'承認→反映(s)':>12} {'ターン':>6} {'コスト($)':>10} {'反映':>10}")
+    print("-" * 86)
+    for review, name, report, start, end, edits in rows:
+        lag = f"{report['done_at'] - report['approved_at']:.2f}" if report.get("done_at") else "-"
+        if not report["approved"]:
+            applied = f"なし ({edits}行)"
+        else:
+            applied = f"{'投機' if report['speculative'] else '実行'} ({edits}行)"
+        print(
+            f"{review:>5} {name:<24} {end - start:>11.2f} {lag:>12} {report['turns']:>6}"
+            f" {report['cost']:>10.4f} {applied:>10}"
+        )
+    print("-" * 86)
+    print("反映: 作業ディレクトリの app.py に反映された編集の行数")
+
+
+def parse_weights(items: list[str]) -> dict[str, float]:
+    """KEY=WEIGHT の並びを重みの辞書に変換"""
+    weights = {}
+    for item in items:
+        key, sep, value = item.partition("=")
+        if not sep or key not in PLAN_WEIGHTS:
+            raise SystemExit(f"不明な重み: {item} (利用可能: {', '.join(PLAN_WEIGHTS)})")
+        weights[key] = float(value)
+    return weights
+
+
+async def benchmark_best_of(args: argparse.Namespace):
+    """スタンドイン CLI で、計画の数ごとのターン数・コスト・時間を比較"""
+    print("=" * 86)
+    print(f"スタンドイン CLI: 調査 {args.explore_turns}ターン → 計画 (編集 {args.edit_steps}〜{args.max_edit_steps}か所)"
+          f" → 編集 + 報告 1ターン, 1ターン {args.turn_ms}ms ({args.runs}回の平均)")
+    print("=" * 86)
+
+    async def approve() -> bool:
+        return True
+
+    rows = []
+    for n in args.bench_n:
+        runs = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as state_dir:
+                options = dataclasses.replace(
+                    EXECUTE_OPTIONS,
+                    cli_path=str(args.cli_path),
+                    env={
+                        "FAKE_CLI_STARTUP_MS": str(args.startup_ms),
+                        "FAKE_CLI_TURN_MS": str(args.turn_ms),
+                        "FAKE_CLI_TURNS": str(args.explore_turns + args.edit_steps + 1),
+                        "FAKE_CLI_EDIT_STEPS": str(args.edit_steps),
+                        "FAKE_CLI_EDIT_STEPS_MAX": str(args.max_edit_steps),
+                        "FAKE_CLI_STATE_DIR": state_dir,
+                    }
+                )
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    report = await best_of_n_plans(
+                        "parse のバグを修正して", n=n, weights=parse_weights(args.plan_weights), options=options,
+                        approve=approve,
+                    )
+                runs.append((report, time.perf_counter() - start))
+        rows.append((n, runs))
+
+    print(f"\n{'計画の数':>8} {'計画ターン':>10} {'実行ターン':>10} {'合計ターン':>10} {'コスト($)':>10} {'時間(s)':>8}")
+    print("-" * 86)
+    for n, runs in rows:
+        mean = lambda key: statistics.mean(r[key] for r, _ in runs)
+        print(
+            f"{n:>8} {mean('plan_turns'):>10.1f} {mean('execute_turns'):>10.1f}"
+            f" {mean('plan_turns') + mean('execute_turns'):>10.1f}"
+            f" {mean('plan_cost') + mean('execute_cost'):>10.4f}"
+            f" {statistics.mean(elapsed for _, elapsed in runs):>8.2f}"
+        )
+    print("-" * 86)
+
+
+def load_compare():
+    """06_working_directory/05_compare.py (並列・分離した比較) を読み込む"""
+    path = Path(__file__).resolve().parents[1] / "06_working_directory" / "05_compare.py"
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def compare_modes(prompt: str, runs: int = 1):
+    """plan モードと acceptEdits モードを比較
+
+    2つのモードは作業ディレクトリの別々のコピーで同時に実行するため、
+    acceptEdits の編集が plan の実行に見えることはありません。
+    """
+    print("=" * 60)
+    print("モード比較")
+    print("=" * 60)
+    print(f"プロンプト: {prompt}")
     print("=" * 60)
 
-    if "plan" in results and "execute" in results:
-        print(f"\n{'項目':<20} {'plan':<15} {'acceptEdits':<15}")
-        print("-" * 50)
-        print(f"{'ターン数':<20} {results['plan']['turns']:<15} {results['execute']['turns']:<15}")
-        print(f"{'コスト':<20} ${results['plan']['cost']:.4f}{'':>8} ${results['execute']['cost']:.4f}")
-        print(f"{'ツール呼び出し数':<20} {len(results['plan']['tools']):<15} {len(results['execute']['tools']):<15}")
+    compare = load_compare()
+    grouped = await compare.compare_variants(
+        {"plan": PLAN_OPTIONS, "acceptEdits": EXECUTE_OPTIONS}, prompt, runs=runs
+    )
+    compare.print_comparison(grouped)
 
-        print("\n[plan モードで計画されたツール]")
-        for tool in results["plan"]["tools"]:
-            print(f"  - {tool}")
+    print("\n[plan モードで計画されたツール]")
+    for tool in grouped["plan"][0].tools:
+        print(f"  - {tool}")
 
-        print("\n[acceptEdits モードで実行されたツール]")
-        for tool in results["execute"]["tools"]:
-            print(f"  - {tool}")
+    print("\n[acceptEdits モードで実行されたツール]")
+    for tool in grouped["acceptEdits"][0].tools:
+        print(f"  - {tool}")
 
 
 async def main():
     args = parse_args()
 
-    if args.review:
-        await review_and_execute(args.prompt)
+    if args.bench_speculative:
+        await benchmark_speculative(args)
+    elif args.bench_best_of:
+        await benchmark_best_of(args)
+    elif args.best_of:
+        await best_of_n_plans(
+            args.prompt, n=args.best_of, weights=parse_weights(args.plan_weights), timeout=args.plan_timeout
+        )
+    elif args.review:
+        options = dataclasses.replace(EXECUTE_OPTIONS, cwd=args.cwd) if args.cwd else None
+        await review_and_execute(args.prompt, fresh=args.fresh, speculative=args.speculative, options=options)
     elif args.compare:
-        await compare_modes(args.prompt)
+        await compare_modes(args.prompt, runs=args.runs)
     else:
         await simple_plan(args.prompt)
 
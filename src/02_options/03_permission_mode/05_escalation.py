@@ -5,20 +5,34 @@ Usage:
     python 05_escalation.py --prompt "README.mdを更新して"
     python 05_escalation.py --start acceptEdits --prompt "コードを修正して"
     python 05_escalation.py --auto-escalate --prompt "大規模な変更を実行"
+    python 05_escalation.py --auto-escalate --fresh --prompt "大規模な変更を実行"
+    python 05_escalation.py --bench
 
 Options:
     --start MODE       : 開始モード（plan, default, acceptEdits）
     --auto-escalate    : 自動でエスカレート（確認なし）
     --max-mode MODE    : 最大エスカレートモード
+    --fresh            : モードごとに新しい query() で同じプロンプトを実行（従来の動作）
+    --bench            : 1つのセッションと2回の query() のターン数・コスト・時間を比較
 
 段階的エスカレーションにより、安全性を維持しながら
 必要に応じて権限を拡大できます。
+デフォルトでは1つの ClaudeSDKClient セッションの中で set_permission_mode() により
+モードを切り替えるため、実行の段階は plan モードで立てた計画と読んだファイルを引き継ぎます。
 """
 import argparse
 import asyncio
+import contextlib
+import dataclasses
+import io
+import statistics
+import tempfile
+import time
+from pathlib import Path
 from typing import Optional
 from claude_agent_sdk import (
     ClaudeAgentOptions,
+    ClaudeSDKClient,
     query,
     AssistantMessage,
     ResultMessage,
@@ -26,6 +40,12 @@ from claude_agent_sdk import (
     ToolUseBlock
 )
 
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[3] / "test" / "fake_claude_cli.py"
+
+# 同じセッションでエスカレートしたあとに送るプロンプト
+EXECUTE_PROMPT = "承認された計画どおりに実行してください。"
+
 
 class PermissionEscalator:
     """必要に応じて権限をエスカレート"""
@@ -79,8 +99,10 @@ class PermissionEscalator:
         self.current_index = 0
         self.history = []
 
-    def get_options(self) -> ClaudeAgentOptions:
-        return ClaudeAgentOptions(
+    def get_options(self, base: Optional[ClaudeAgentOptions] = None) -> ClaudeAgentOptions:
+        """現在のモードの options（base を渡すと、その他の設定は base から引き継ぐ）"""
+        return dataclasses.replace(
+            base or ClaudeAgentOptions(),
             permission_mode=self.current_mode,
             allowed_tools=self.allowed_tools
         )
@@ -105,78 +127,114 @@ class PermissionEscalator:
         print("-" * 40)
 
 
+async def run_phase(stream) -> tuple[list, Optional[ResultMessage]]:
+    """1つのモードの応答を表示し、ツール呼び出しと ResultMessage を返す"""
+    tool_calls = []
+    result = None
+    async for message in stream:
+        if isinstance(message, AssistantMessage):
+            for block in message.content:
+                if isinstance(block, TextBlock):
+                    text = block.text[:200] + "..." if len(block.text) > 200 else block.text
+                    print(f"[Text] {text}")
+                elif isinstance(block, ToolUseBlock):
+                    tool_calls.append(block.name)
+                    print(f"[Tool] {block.name}")
+
+        elif isinstance(message, ResultMessage):
+            result = message
+            print(f"\n完了: {message.num_turns}ターン, ${message.total_cost_usd:.4f}")
+    return tool_calls, result
+
+
 async def escalating_execution(
     prompt: str,
     escalator: PermissionEscalator,
-    auto_escalate: bool = False
-):
-    """エスカレーション付き実行"""
+    auto_escalate: bool = False,
+    fresh: bool = False,
+    options: Optional[ClaudeAgentOptions] = None
+) -> dict:
+    """
+    エスカレーション付き実行
+
+    デフォルトでは1つの ClaudeSDKClient セッションでモードを切り替え、実行の段階には
+    EXECUTE_PROMPT だけを送ります。fresh=True ではモードごとに新しい query() で
+    同じプロンプトを最初から実行します（従来の動作）。
+    options を渡すと、権限モードと許可ツール以外の設定（cli_path など）を引き継ぎます。
+    """
     print("=" * 60)
     print("段階的エスカレーション実行")
     print("=" * 60)
     print(f"開始モード: {escalator.current_mode}")
     print(f"最大モード: {escalator.MODES[escalator.max_index]}")
     print(f"自動エスカレート: {'ON' if auto_escalate else 'OFF'}")
+    print(f"セッション: {'モードごとに新規' if fresh else '継続'}")
     print("-" * 60)
     print(f"プロンプト: {prompt}")
     print("=" * 60)
 
+    client = None if fresh else ClaudeSDKClient(escalator.get_options(options))
+    if client:
+        await client.connect()
+
+    phases = []
     iteration = 0
-    while True:
-        iteration += 1
-        escalator.print_status()
-
-        print(f"\n=== イテレーション {iteration}: {escalator.current_mode} モード ===")
-        print(f"説明: {escalator.MODE_DESCRIPTIONS[escalator.current_mode]}")
-
-        options = escalator.get_options()
-
-        tool_calls = []
-        result = None
-
-        async for message in query(prompt=prompt, options=options):
-            if isinstance(message, AssistantMessage):
-                for block in message.content:
-                    if isinstance(block, TextBlock):
-                        text = block.text[:200] + "..." if len(block.text) > 200 else block.text
-                        print(f"[Text] {text}")
-                    elif isinstance(block, ToolUseBlock):
-                        tool_calls.append(block.name)
-                        print(f"[Tool] {block.name}")
-
-            elif isinstance(message, ResultMessage):
-                result = message
-                print(f"\n完了: {message.num_turns}ターン, ${message.total_cost_usd:.4f}")
-
-        # plan モードの場合は確認
-        if escalator.current_mode == "plan":
-            print("\n" + "-" * 40)
-            print(f"計画されたツール呼び出し: {len(tool_calls)}")
-            for tool in tool_calls:
-                print(f"  - {tool}")
-
-            if escalator.can_escalate:
-                if auto_escalate:
-                    print("\n自動エスカレート: 実行モードに移行します")
-                    escalator.escalate()
-                else:
-                    try:
-                        proceed = input("\n実行を続けますか？ (y/n): ")
-                    except EOFError:
-                        proceed = "n"
+    try:
+        while True:
+            iteration += 1
+            escalator.print_status()
+
+            print(f"\n=== イテレーション {iteration}: {escalator.current_mode} モード ===")
+            print(f"説明: {escalator.MODE_DESCRIPTIONS[escalator.current_mode]}")
 
-                    if proceed.lower() == "y":
+            if client:
+                await client.query(prompt if iteration == 1 else EXECUTE_PROMPT)
+                stream = client.receive_response()
+            else:
+                stream = query(prompt=prompt, options=escalator.get_options(options))
+            tool_calls, result = await run_phase(stream)
+            phases.append({
+                "mode": escalator.current_mode,
+                "turns": result.num_turns if result else 0,
+                "cost": (result.total_cost_usd or 0.0) if result else 0.0,
+                "tools": tool_calls,
+            })
+
+            # plan モードの場合は確認
+            if escalator.current_mode == "plan":
+                print("\n" + "-" * 40)
+                print(f"計画されたツール呼び出し: {len(tool_calls)}")
+                for tool in tool_calls:
+                    print(f"  - {tool}")
+
+                if escalator.can_escalate:
+                    if auto_escalate:
+                        print("\n自動エスカレート: 実行モードに移行します")
                         escalator.escalate()
-                        print(f"エスカレート: {escalator.current_mode} モードに移行")
                     else:
-                        print("終了します")
-                        break
+                        try:
+                            proceed = input("\n実行を続けますか？ (y/n): ")
+                        except EOFError:
+                            proceed = "n"
+
+                        if proceed.lower() == "y":
+                            escalator.escalate()
+                            print(f"エスカレート: {escalator.current_mode} モードに移行")
+                        else:
+                            print("終了します")
+                            break
+                    if client:
+                        # 同じセッションのまま権限だけを切り替える
+                        await client.set_permission_mode(escalator.current_mode)
+                else:
+                    print("最大モードに達しています")
+                    break
             else:
-                print("最大モードに達しています")
+                # 実行モードの場合は終了
                 break
-        else:
-            # 実行モードの場合は終了
-            break
+    finally:
+        if client:
+            await client.disconnect()
 
     # 最終レポート
     print("\n" + "=" * 60)
@@ -188,6 +246,58 @@ async def escalating_execution(
     else:
         print("  エスカレーションなし")
 
+    return {
+        "phases": phases,
+        "turns": sum(p["turns"] for p in phases),
+        "cost": sum(p["cost"] for p in phases),
+    }
+
+
+async def benchmark_escalation(args: argparse.Namespace):
+    """スタンドイン CLI で、2回の query() と1つのセッションのエスカレーションを比較"""
+    explore = args.task_turns - args.edit_steps - 1
+    print("=" * 72)
+    print(f"スタンドイン CLI: 調査 {explore}ターン + 編集 {args.edit_steps}ターン + 報告 1ターン,"
+          f" plan で計画 → 承認して実行 ({args.runs}回の中央値)")
+    print("=" * 72)
+
+    rows = []
+    for name, fresh in [("2回の query() (従来)", True), ("1つのセッション", False)]:
+        runs = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as state_dir:
+                # FAKE_CLI_STATE_DIR でセッションごとの進捗を保存する
+                # （新しいセッションは調査からやり直す）
+                options = ClaudeAgentOptions(
+                    cli_path=str(args.cli_path),
+                    env={
+                        "FAKE_CLI_STARTUP_MS": str(args.startup_ms),
+                        "FAKE_CLI_TURN_MS": str(args.turn_ms),
+                        "FAKE_CLI_TURNS": str(args.task_turns),
+                        "FAKE_CLI_EDIT_STEPS": str(args.edit_steps),
+                        "FAKE_CLI_STATE_DIR": state_dir,
+                    }
+                )
+                escalator = PermissionEscalator("plan", max_mode=args.max_mode)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = await escalating_execution(
+                        "parse のバグを修正して", escalator, auto_escalate=True, fresh=fresh, options=options
+                    )
+                runs.append((result, time.perf_counter() - start))
+        result = runs[0][0]
+        rows.append((name, result, statistics.median(elapsed for _, elapsed in runs)))
+
+    print(f"\n{'方式':<22} {'計画ターン':>10} {'実行ターン':>10} {'合計ターン':>10} {'コスト($)':>10} {'時間(s)':>8}")
+    print("-" * 72)
+    for name, result, elapsed in rows:
+        plan_turns = sum(p["turns"] for p in result["phases"] if p["mode"] == "plan")
+        print(
+            f"{name:<22} {plan_turns:>10} {result['turns'] - plan_turns:>10} {result['turns']:>10}"
+            f" {result['cost']:>10.4f} {elapsed:>8.2f}"
+        )
+    print("-" * 72)
+
 
 def parse_args() -> argparse.Namespace:
     """コマンドライン引数をパース"""
@@ -216,6 +326,52 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="自動でエスカレート（確認なし）"
     )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="モードごとに新しい query() で同じプロンプトを実行 (従来の動作)"
+    )
+    parser.add_argument(
+        "--bench",
+        action="store_true",
+        help="スタンドイン CLI で2回の query() と1つのセッションを比較"
+    )
+    parser.add_argument(
+        "--task-turns",
+        type=int,
+        default=16,
+        help="--bench のタスクに必要なターン数 (default: 16)"
+    )
+    parser.add_argument(
+        "--edit-steps",
+        type=int,
+        default=5,
+        help="--bench のうち編集のターン数 (default: 5)"
+    )
+    parser.add_argument(
+        "--startup-ms",
+        type=int,
+        default=300,
+        help="--bench の CLI 起動時間 (default: 300)"
+    )
+    parser.add_argument(
+        "--turn-ms",
+        type=int,
+        default=50,
+        help="--bench の1ターンの応答時間 (default: 50)"
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="--bench の実行回数 (default: 3)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="--bench に使う CLI のパス"
+    )
     parser.add_argument(
         "-l", "--list",
         action="store_true",
@@ -253,6 +409,10 @@ async def main():
         print_mode_list()
         return
 
+    if args.bench:
+        await benchmark_escalation(args)
+        return
+
     escalator = PermissionEscalator(
         initial_mode=args.start,
         max_mode=args.max_mode
@@ -261,7 +421,8 @@ async def main():
     await escalating_execution(
         prompt=args.prompt,
         escalator=escalator,
-        auto_escalate=args.auto_escalate
+        auto_escalate=args.auto_escalate,
+        fresh=args.fresh
     )
 
 
@@ -5,37 +5,328 @@ Usage:
     python 02_monitoring.py --max-turns 10 --prompt "プロジェクトを分析して"
     python 02_monitoring.py -t 5 -p "README.mdを読んで"
     python 02_monitoring.py --verbose -t 15 -p "src/を調査して"
+    python 02_monitoring.py -t 10 -p "src/を調査して" --archive runs.jsonl --task analysis
+    python 02_monitoring.py -n 8 --serve 9464 --metrics-jsonl metrics.jsonl -p "src/を調査して"
+    python 02_monitoring.py --bench-metrics
+    python 02_monitoring.py --stream --hook-ms 200 -p "src/を調査して"
+    python 02_monitoring.py --bench-latency
 
 このスクリプトは、ターン数をリアルタイムでモニタリングし、
 進捗状況やツール使用状況を詳細に表示します。
 """
 import argparse
 import asyncio
+import dataclasses
+import importlib
+import json
+import math
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
+from typing import Optional
 from claude_agent_sdk import (
     ClaudeAgentOptions,
+    HookMatcher,
     query,
     AssistantMessage,
     ResultMessage,
+    StreamEvent,
     TextBlock,
     ToolUseBlock,
-    ToolResultBlock
+    ToolResultBlock,
+    UserMessage
 )
 
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[3] / "test" / "fake_claude_cli.py"
+
+# =============================================================================
+# メトリクス
+# =============================================================================
+
+class CounterChild:
+    """ラベルの値ごとのカウンター"""
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class HistogramChild:
+    """ラベルの値ごとのヒストグラム（counts はバケットごとの件数。累積はしない）"""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """
+    メトリクスのファミリー（同じ名前でラベルの値が異なる系列の集まり）
+
+    labels() はラベルの値ごとの子を返します。イベントごとに labels() を呼ぶと
+    タプルの生成と辞書の検索が入るので、頻繁に記録する系列は子を保持して使います。
+    """
+
+    def __init__(self, kind: str, name: str, help: str, labelnames: tuple = (), buckets: tuple = ()):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.children: dict[tuple, object] = {}
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ラベル {self.labelnames} に対して値が {values} です")
+            child = HistogramChild(self.buckets) if self.kind == "histogram" else CounterChild()
+            self.children[values] = child
+        return child
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """{name="value",...} の形式"""
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricsRegistry:
+    """
+    カウンターとヒストグラムを登録して、OpenMetrics テキストや JSONL に書き出す
+
+    同じイベントループ内から記録する前提で、ロックは取りません
+    （スレッドから記録する場合は、スレッドごとにレジストリを分けてください）。
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def _register(self, kind: str, name: str, help: str, labelnames: tuple, buckets: tuple = ()) -> Metric:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Metric(kind, name, help, labelnames, buckets)
+        elif metric.kind != kind or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"{name} は別の種類・ラベルで登録済みです")
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Metric:
+        """カウンターを取得（なければ登録）"""
+        return self._register("counter", name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = ()) -> Metric:
+        """ヒストグラムを取得（なければ登録）"""
+        return self._register("histogram", name, help, labelnames, buckets)
+
+    def render(self) -> str:
+        """OpenMetrics テキスト形式で出力"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            for values, child in list(metric.children.items()):
+                if metric.kind == "counter":
+                    lines.append(f"{metric.name}_total{format_labels(metric.labelnames, values)} {child.value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (math.inf,), list(child.counts)):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    labels = format_labels(metric.labelnames, values, f'le="{le}"')
+                    lines.append(f"{metric.name}_bucket{labels} {cumulative}")
+                labels = format_labels(metric.labelnames, values)
+                lines.append(f"{metric.name}_count{labels} {child.count}")
+                lines.append(f"{metric.name}_sum{labels} {child.sum}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """現在の値を JSON にできる形で取得（ヒストグラムの buckets は累積しない件数）"""
+        result = {}
+        for metric in self.metrics.values():
+            series = []
+            for values, child in list(metric.children.items()):
+                labels = dict(zip(metric.labelnames, values))
+                if metric.kind == "counter":
+                    series.append({"labels": labels, "value": child.value})
+                else:
+                    series.append({
+                        "labels": labels,
+                        "count": child.count,
+                        "sum": child.sum,
+                        "buckets": dict(zip([str(b) for b in metric.buckets] + ["+Inf"], child.counts)),
+                    })
+            result[metric.name] = {"type": metric.kind, "series": series}
+        return result
+
+    def flush(self, path: str):
+        """現在の値を JSONL に1行追記"""
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"timestamp": time.time(), "metrics": self.snapshot()}, ensure_ascii=False) + "\n")
+
+
+REGISTRY = MetricsRegistry()
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+async def serve_metrics(registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9464) -> asyncio.AbstractServer:
+    """
+    GET /metrics で OpenMetrics テキストを返す HTTP サーバーを起動
+
+    同じイベントループで動くので、記録中の値を読むときにロックは要りません。
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                status, content_type, body = "200 OK", OPENMETRICS_CONTENT_TYPE, registry.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def flush_periodically(registry: MetricsRegistry, path: str, interval: float = 10.0):
+    """interval 秒ごとに JSONL へ追記（キャンセルされたら最後に1回追記）"""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            registry.flush(path)
+    finally:
+        registry.flush(path)
+
+
+# ターンの所要時間 (秒)、ツール・フックなどの短い時間 (秒)、クエリのコスト (USD) のバケット
+TURN_SECONDS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_COST_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+@dataclass
+class TurnLatency:
+    """
+    1ターンの所要時間の内訳（秒）
+
+    model は直前の区切り（1ターン目は開始、以降は最後のツール結果）から AssistantMessage が
+    届くまでで、モデルの待ち時間です。ttft はそのうち最初のトークンまで
+    （include_partial_messages のときだけ）。tools はツールの呼び出しから結果までのうち
+    フックを除いた時間、hooks は SDK 側のフックの実行時間です。
+    """
+    turn: int
+    model: float
+    ttft: Optional[float] = None
+    tools: float = 0.0
+    hooks: float = 0.0
+    tool_names: list = field(default_factory=list)
 
-class TurnMonitor:
-    """ターン数をモニタリングするクラス"""
 
-    def __init__(self, max_turns: int):
+class TurnMonitor:
+    """
+    ターン数をモニタリングするクラス
+
+    ターン数・ツールごとの呼び出し数・ターンの所要時間・コストを MetricsRegistry に記録します。
+    複数のエージェントで同じレジストリを共有すると、agent ラベルで区別したまま
+    serve_metrics() や flush_periodically() で実行中の状況を見られます。
+
+    on_message() にすべてのメッセージを渡すと、単調時計 (time.perf_counter) で
+    最初の応答までの時間・ターンごとのモデル / ツール / フックの時間を分解します
+    （ToolUseBlock.id と ToolResultBlock.tool_use_id を対応付け、フックは instrument() で計測）。
+    """
+
+    def __init__(
+        self,
+        max_turns: int,
+        registry: Optional[MetricsRegistry] = None,
+        agent: str = "",
+        quiet: bool = False
+    ):
         self.max_turns = max_turns
+        self.registry = registry or REGISTRY
+        self.agent = agent
+        self.quiet = quiet
         self.current_turn = 0
         self.tool_usage = {}  # ツール名 -> 使用回数
         self.start_time = None
-        self.turn_times = []  # 各ターンの所要時間
+        self._last_event = None
+        self.ttfm = None  # 開始から最初の AssistantMessage まで
+        self.turn_latencies: list[TurnLatency] = []
+        self._start = None
+        self._boundary = None  # モデルの待ち時間の起点
+        self._first_token = None
+        self._message_id = None
+        self._pending_tools = {}  # tool_use_id -> (ツール名, 呼び出し時刻, TurnLatency)
+        self._hook_seconds = {}  # tool_use_id -> フックの実行時間
+
+        # 記録のたびにラベルを引かないよう、系列の子を保持しておく
+        registry = self.registry
+        self._turns = registry.counter("agent_turns", "ターン数", ("agent",)).labels(agent)
+        self._tool_calls = registry.counter("agent_tool_calls", "ツール呼び出しの数", ("agent", "tool"))
+        self._tool_children = {}
+        self._turn_seconds = registry.histogram(
+            "agent_turn_seconds", "前のターンの処理を終えてから次の AssistantMessage が届くまでの秒数",
+            ("agent",), TURN_SECONDS_BUCKETS
+        ).labels(agent)
+        self._cost = registry.counter("agent_cost_usd", "完了したクエリのコスト (USD)", ("agent",)).labels(agent)
+        self._query_cost = registry.histogram(
+            "agent_query_cost_usd", "1クエリのコスト (USD)", ("agent",), QUERY_COST_BUCKETS
+        ).labels(agent)
+        self._queries = registry.counter("agent_queries", "完了したクエリの数", ("agent", "subtype"))
+        self._ttfm_seconds = registry.histogram(
+            "agent_ttfm_seconds", "開始から最初の AssistantMessage までの秒数", ("agent",), TURN_SECONDS_BUCKETS
+        ).labels(agent)
+        self._model_seconds = registry.histogram(
+            "agent_model_seconds", "ツール結果（1ターン目は開始）から AssistantMessage までの秒数",
+            ("agent",), TURN_SECONDS_BUCKETS
+        ).labels(agent)
+        self._ttft_seconds = registry.histogram(
+            "agent_ttft_seconds", "ツール結果（1ターン目は開始）から最初のトークンまでの秒数",
+            ("agent",), LATENCY_BUCKETS
+        ).labels(agent)
+        self._tool_seconds = registry.histogram(
+            "agent_tool_seconds", "ツールの呼び出しから結果までの秒数（フックを除く）",
+            ("agent", "tool"), LATENCY_BUCKETS
+        )
+        self._hook_histogram = registry.histogram(
+            "agent_hook_seconds", "SDK 側のフックの実行秒数", ("agent", "event"), LATENCY_BUCKETS
+        )
 
     def start(self):
         """モニタリングを開始"""
         self.start_time = datetime.now()
+        self._start = self._boundary = self._last_event = time.perf_counter()
+        if self.quiet:
+            return
         print(f"[モニター] 開始時刻: {self.start_time.strftime('%H:%M:%S')}")
         print(f"[モニター] 最大ターン数: {self.max_turns}")
         print("-" * 50)
@@ -43,8 +334,13 @@ class TurnMonitor:
     def on_turn_start(self):
         """ターン開始時のコールバック"""
         self.current_turn += 1
-        turn_start = datetime.now()
-        self.turn_times.append({"start": turn_start, "end": None})
+        self._turns.inc()
+        now = time.perf_counter()
+        if self._last_event is not None:
+            self._turn_seconds.observe(now - self._last_event)
+        self._last_event = now
+        if self.quiet:
+            return
 
         progress = (self.current_turn / self.max_turns) * 100
         bar_length = 20
@@ -56,6 +352,12 @@ class TurnMonitor:
     def on_tool_use(self, tool_name: str, tool_input: dict):
         """ツール使用時のコールバック"""
         self.tool_usage[tool_name] = self.tool_usage.get(tool_name, 0) + 1
+        child = self._tool_children.get(tool_name)
+        if child is None:
+            child = self._tool_children[tool_name] = self._tool_calls.labels(self.agent, tool_name)
+        child.inc()
+        if self.quiet:
+            return
         print(f"  🔧 ツール: {tool_name}")
         # 入力を短く表示
         input_str = str(tool_input)
@@ -64,9 +366,118 @@ class TurnMonitor:
         print(f"     入力: {input_str}")
 
     def on_turn_end(self):
-        """ターン終了時のコールバック"""
-        if self.turn_times and self.turn_times[-1]["end"] is None:
-            self.turn_times[-1]["end"] = datetime.now()
+        """ターン終了時のコールバック（表示にかかった時間は次のターンの所要時間に含めない）"""
+        self._last_event = time.perf_counter()
+
+    def on_message(self, message):
+        """
+        受け取ったメッセージを記録（query() / receive_response() のすべてのメッセージを渡す）
+
+        新しい message_id の AssistantMessage でターンを開始し、ツール呼び出しと結果を
+        id で対応付けます。ツール結果がすべて揃った時点を次のターンのモデルの待ち時間の起点にします。
+        """
+        now = time.perf_counter()
+        if isinstance(message, StreamEvent):
+            if self._first_token is None and message.event.get("type") == "content_block_delta":
+                self._first_token = now
+        elif isinstance(message, AssistantMessage):
+            if message.message_id is None or message.message_id != self._message_id:
+                self._message_id = message.message_id
+                self.on_turn_start()
+                latency = TurnLatency(self.current_turn, now - self._boundary)
+                if self._first_token is not None:
+                    latency.ttft = self._first_token - self._boundary
+                    self._ttft_seconds.observe(latency.ttft)
+                if self.ttfm is None:
+                    self.ttfm = now - self._start
+                    self._ttfm_seconds.observe(self.ttfm)
+                self._model_seconds.observe(latency.model)
+                self.turn_latencies.append(latency)
+                self._boundary = now
+                self._first_token = None
+            latency = self.turn_latencies[-1]
+            for block in message.content:
+                if isinstance(block, ToolUseBlock):
+                    self.on_tool_use(block.name, block.input)
+                    latency.tool_names.append(block.name)
+                    self._pending_tools[block.id] = (block.name, now, latency)
+        elif isinstance(message, UserMessage) and isinstance(message.content, list):
+            for block in message.content:
+                if not isinstance(block, ToolResultBlock) or block.tool_use_id not in self._pending_tools:
+                    continue
+                name, called, latency = self._pending_tools.pop(block.tool_use_id)
+                hooks = self._hook_seconds.pop(block.tool_use_id, 0.0)
+                tool = max(0.0, now - called - hooks)
+                latency.tools += tool
+                latency.hooks += hooks
+                self._tool_seconds.labels(self.agent, name).observe(tool)
+            if not self._pending_tools:
+                self._boundary = now
+                self._first_token = None
+        elif isinstance(message, ResultMessage):
+            self.on_result(message)
+
+    def instrument(self, options: ClaudeAgentOptions, stream: bool = False) -> ClaudeAgentOptions:
+        """
+        フックの実行時間を計測するよう options を置き換える
+
+        stream=True なら include_partial_messages も有効にして、最初のトークンまでの時間を計測します。
+        フックの時間は SDK 側のコールバックの実行時間で、CLI とのやり取りはツールの時間に含まれます。
+        """
+        hooks = {
+            event: [
+                dataclasses.replace(matcher, hooks=[self._timed_hook(event, hook) for hook in matcher.hooks])
+                for matcher in matchers
+            ]
+            for event, matchers in (options.hooks or {}).items()
+        }
+        return dataclasses.replace(
+            options,
+            hooks=hooks or options.hooks,
+            include_partial_messages=options.include_partial_messages or stream
+        )
+
+    def _timed_hook(self, event: str, hook):
+        histogram = self._hook_histogram.labels(self.agent, event)
+
+        async def timed(input_data, tool_use_id, context):
+            start = time.perf_counter()
+            try:
+                return await hook(input_data, tool_use_id, context)
+            finally:
+                elapsed = time.perf_counter() - start
+                histogram.observe(elapsed)
+                if tool_use_id:
+                    self._hook_seconds[tool_use_id] = self._hook_seconds.get(tool_use_id, 0.0) + elapsed
+
+        return timed
+
+    def print_latency(self):
+        """ターンごとの所要時間の内訳を表示"""
+        if not self.turn_latencies:
+            return
+        print(f"\n【所要時間の内訳】 最初の応答まで: {self.ttfm:.3f}秒")
+        print(f"  {'ターン':<6} {'モデル':>8} {'(TTFT)':>8} {'ツール':>8} {'フック':>8}  ツール名")
+        for t in self.turn_latencies:
+            ttft = f"{t.ttft:.3f}" if t.ttft is not None else "-"
+            print(f"  {t.turn:<6} {t.model:>8.3f} {ttft:>8} {t.tools:>8.3f} {t.hooks:>8.3f}  {','.join(t.tool_names)}")
+        totals = {
+            "モデル": sum(t.model for t in self.turn_latencies),
+            "ツール": sum(t.tools for t in self.turn_latencies),
+            "フック": sum(t.hooks for t in self.turn_latencies),
+        }
+        print(f"  {'合計':<6} {totals['モデル']:>8.3f} {'':>8} {totals['ツール']:>8.3f} {totals['フック']:>8.3f}")
+        total = sum(totals.values())
+        if total > 0:
+            name, seconds = max(totals.items(), key=lambda x: x[1])
+            print(f"  最も時間を使っているのは {name} ({seconds / total:.0%})")
+
+    def on_result(self, result_message: ResultMessage):
+        """クエリ完了時のコールバック"""
+        cost = result_message.total_cost_usd or 0.0
+        self._cost.inc(cost)
+        self._query_cost.observe(cost)
+        self._queries.labels(self.agent, result_message.subtype).inc()
 
     def get_summary(self) -> dict:
         """モニタリング結果のサマリーを取得"""
@@ -116,24 +527,41 @@ class TurnMonitor:
                 print(f"  平均(ターン):   ${cost_per_turn:.4f}/ターン")
 
 
-async def monitored_query(prompt: str, max_turns: int, verbose: bool = False):
+async def monitored_query(
+    prompt: str,
+    max_turns: int,
+    verbose: bool = False,
+    archive: Optional[str] = None,
+    registry: Optional[MetricsRegistry] = None,
+    agent: str = "",
+    quiet: bool = False,
+    cli_path: Optional[str] = None,
+    stream: bool = False,
+    hooks: Optional[dict] = None,
+    **labels
+):
     """モニタリング付きでクエリを実行"""
+    allowed_tools = ["Read", "Write", "Edit", "Glob", "Grep", "Bash"]
     options = ClaudeAgentOptions(
         max_turns=max_turns,
-        allowed_tools=["Read", "Write", "Edit", "Glob", "Grep", "Bash"]
+        allowed_tools=allowed_tools,
+        cli_path=cli_path,
+        hooks=hooks
     )
 
-    monitor = TurnMonitor(max_turns)
+    monitor = TurnMonitor(max_turns, registry, agent, quiet)
+    options = monitor.instrument(options, stream=stream)
     monitor.start()
 
     result_message = None
 
     async for message in query(prompt=prompt, options=options):
+        monitor.on_message(message)
         if isinstance(message, AssistantMessage):
-            monitor.on_turn_start()
-
             for block in message.content:
                 if isinstance(block, TextBlock):
+                    if quiet:
+                        continue
                     if verbose:
                         # 詳細モードでは全文表示
                         print(f"  📝 {block.text}")
@@ -142,17 +570,204 @@ async def monitored_query(prompt: str, max_turns: int, verbose: bool = False):
                         text = block.text[:100] + "..." if len(block.text) > 100 else block.text
                         print(f"  📝 {text}")
 
-                elif isinstance(block, ToolUseBlock):
-                    monitor.on_tool_use(block.name, block.input)
-
             monitor.on_turn_end()
 
         elif isinstance(message, ResultMessage):
             result_message = message
 
-    monitor.print_summary(result_message)
+    if not quiet:
+        monitor.print_summary(result_message)
+        monitor.print_latency()
+
+    summary = monitor.get_summary()
+    if archive and result_message:
+        # 05_report.py で集計できる形式で実行履歴に追記
+        report = importlib.import_module("05_report")
+        report.record_run(
+            archive,
+            num_turns=result_message.num_turns,
+            cost_usd=result_message.total_cost_usd or 0.0,
+            duration_ms=result_message.duration_ms,
+            tools=summary["tool_usage"],
+            subtype=result_message.subtype,
+            max_turns=max_turns,
+            prompt=prompt,
+            allowed_tools=allowed_tools,
+            cwd_files=importlib.import_module("04_adaptive").count_files(),
+            **labels
+        )
+
+    return summary
+
+
+def benchmark_metrics(iterations: int = 1_000_000):
+    """記録1回あたりのオーバーヘッドと、書き出しの時間を計測"""
+    registry = MetricsRegistry()
+    counter = registry.counter("bench_counter", "ベンチマーク", ("agent",))
+    histogram = registry.histogram("bench_seconds", "ベンチマーク", ("agent",), TURN_SECONDS_BUCKETS)
+    counter_child = counter.labels("a")
+    histogram_child = histogram.labels("a")
+    monitor = TurnMonitor(10**9, registry, agent="bench", quiet=True)
+    monitor.start()
+    tools = ["Read", "Grep", "Glob", "Edit"]
+
+    def loop_overhead():
+        for _ in range(iterations):
+            pass
 
-    return monitor.get_summary()
+    def counter_inc():
+        for _ in range(iterations):
+            counter_child.inc()
+
+    def counter_labels_inc():
+        for _ in range(iterations):
+            counter.labels("a").inc()
+
+    def histogram_observe():
+        for i in range(iterations):
+            histogram_child.observe(i & 127)
+
+    def monitor_turn():
+        # 1ターン = on_turn_start + on_tool_use + on_turn_end の3イベント
+        for i in range(iterations // 3):
+            monitor.on_turn_start()
+            monitor.on_tool_use(tools[i & 3], {})
+            monitor.on_turn_end()
+
+    def timed(fn) -> float:
+        start = time.perf_counter_ns()
+        fn()
+        return (time.perf_counter_ns() - start) / iterations
+
+    base = timed(loop_overhead)
+    rows = [
+        ("Counter (子を保持)", timed(counter_inc) - base),
+        ("Counter (labels() で検索)", timed(counter_labels_inc) - base),
+        ("Histogram.observe", timed(histogram_observe) - base),
+        ("TurnMonitor (quiet)", timed(monitor_turn) - base),
+    ]
+
+    # 100 エージェント × 4 ツールを書き出す
+    fleet = MetricsRegistry()
+    for i in range(100):
+        agent = TurnMonitor(100, fleet, agent=f"agent-{i}", quiet=True)
+        agent.start()
+        for tool in tools:
+            agent.on_turn_start()
+            agent.on_tool_use(tool, {})
+    start = time.perf_counter()
+    text = fleet.render()
+    render_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    line = json.dumps({"timestamp": time.time(), "metrics": fleet.snapshot()})
+    snapshot_ms = (time.perf_counter() - start) * 1000
+
+    print("=" * 50)
+    print(f"メトリクス記録のオーバーヘッド ({iterations:,}回)")
+    print("=" * 50)
+    print(f"{'処理':<28} {'ns/イベント':>12}")
+    print("-" * 50)
+    for name, ns in rows:
+        print(f"{name:<28} {ns:>12.0f}")
+    print("-" * 50)
+    print(f"render (100エージェント, {len(text.splitlines())}行)  {render_ms:>8.2f} ms")
+    print(f"JSONL 1行 ({len(line) / 1024:.0f} KB)               {snapshot_ms:>8.2f} ms")
+
+
+def delay_hook(ms: float) -> dict:
+    """ms ミリ秒かかる PreToolUse フック（ポリシー確認などの遅いフックの模擬）"""
+    async def check(input_data, tool_use_id, context):
+        await asyncio.sleep(ms / 1000)
+        return {}
+
+    return {"PreToolUse": [HookMatcher(matcher=None, hooks=[check])]}
+
+
+async def benchmark_latency(args: argparse.Namespace):
+    """スタンドイン CLI に既知の時間を設定し、分解した時間と比べる"""
+    cases = [
+        ("モデルが遅い", {"turn": 400, "ttft": 100, "tool": 50, "hook": 0}),
+        ("ツールが遅い", {"turn": 100, "ttft": 30, "tool": 400, "hook": 0}),
+        ("フックが遅い", {"turn": 100, "ttft": 30, "tool": 50, "hook": 300}),
+    ]
+    print("=" * 78)
+    print("所要時間の分解 (4ターン = ツール3回 + 最終応答, 2ターン目以降の平均, ms)")
+    print("=" * 78)
+    print(f"{'条件':<10} {'':<6} {'モデル':>7} {'TTFT':>7} {'ツール':>7} {'フック':>7} {'最初の応答':>10}  判定")
+    print("-" * 78)
+    for name, ms in cases:
+        options = ClaudeAgentOptions(
+            cli_path=args.cli_path,
+            hooks=delay_hook(ms["hook"]) if ms["hook"] else None,
+            env={
+                "FAKE_CLI_STARTUP_MS": "300",
+                "FAKE_CLI_TURNS": "4",
+                "FAKE_CLI_TURN_MS": str(ms["turn"]),
+                "FAKE_CLI_TTFT_MS": str(ms["ttft"]),
+                "FAKE_CLI_TOOL_MS": str(ms["tool"]),
+            }
+        )
+        monitor = TurnMonitor(10, MetricsRegistry(), quiet=True)
+        options = monitor.instrument(options, stream=True)
+        monitor.start()
+        async for message in query(prompt="src/を調査して", options=options):
+            monitor.on_message(message)
+
+        later = monitor.turn_latencies[1:]
+        with_tools = [t for t in monitor.turn_latencies if t.tool_names]
+        measured = {
+            "model": sum(t.model for t in later) / len(later),
+            "ttft": sum(t.ttft for t in later) / len(later),
+            "tool": sum(t.tools for t in with_tools) / len(with_tools),
+            "hook": sum(t.hooks for t in with_tools) / len(with_tools),
+        }
+        verdict = max([("モデル", measured["model"]), ("ツール", measured["tool"]), ("フック", measured["hook"])],
+                      key=lambda x: x[1])[0]
+        print(f"{name:<10} {'設定':<6} {ms['turn']:>7} {ms['ttft']:>7} {ms['tool']:>7} {ms['hook']:>7}")
+        print(
+            f"{'':<10} {'計測':<6} {measured['model'] * 1000:>7.0f} {measured['ttft'] * 1000:>7.0f}"
+            f" {measured['tool'] * 1000:>7.0f} {measured['hook'] * 1000:>7.0f} {monitor.ttfm * 1000:>10.0f}  {verdict}"
+        )
+    print("-" * 78)
+
+
+async def run_fleet(args: argparse.Namespace):
+    """同じプロンプトを複数のエージェントで並行に実行し、メトリクスを公開・追記"""
+    server = None
+    if args.serve:
+        server = await serve_metrics(REGISTRY, port=args.serve)
+        print(f"📈 http://127.0.0.1:{args.serve}/metrics で公開中")
+    flusher = None
+    if args.metrics_jsonl:
+        flusher = asyncio.create_task(flush_periodically(REGISTRY, args.metrics_jsonl, args.flush_interval))
+
+    quiet = args.agents > 1
+    try:
+        await asyncio.gather(*(
+            monitored_query(
+                prompt=args.prompt,
+                max_turns=args.max_turns,
+                verbose=args.verbose,
+                archive=args.archive,
+                agent=f"agent-{i}" if args.agents > 1 else "",
+                quiet=quiet,
+                cli_path=args.cli_path,
+                stream=args.stream,
+                hooks=delay_hook(args.hook_ms) if args.hook_ms else None,
+                mode="monitoring",
+                task=args.task
+            )
+            for i in range(args.agents)
+        ))
+    finally:
+        if flusher:
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+        if server:
+            server.close()
+            await server.wait_closed()
+    if quiet:
+        print(REGISTRY.render(), end="")
 
 
 def parse_args() -> argparse.Namespace:
@@ -176,25 +791,87 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="詳細な出力を表示"
     )
+    parser.add_argument(
+        "--archive",
+        help="実行結果を追記する実行履歴 (JSONL)"
+    )
+    parser.add_argument(
+        "--task",
+        default="",
+        help="実行履歴に記録するタスク名"
+    )
+    parser.add_argument(
+        "-n", "--agents",
+        type=int,
+        default=1,
+        help="同じプロンプトを並行に実行するエージェント数 (2以上なら進捗を表示せず、最後にメトリクスを表示) (default: 1)"
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        metavar="PORT",
+        help="実行中に http://127.0.0.1:PORT/metrics で OpenMetrics テキストを公開"
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        help="メトリクスを定期的に追記するファイル (JSONL)"
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=10.0,
+        help="--metrics-jsonl に追記する間隔 (秒) (default: 10)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        help="使用する CLI のパス (スタンドイン CLI: test/fake_claude_cli.py)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="include_partial_messages を有効にして、最初のトークンまでの時間を計測"
+    )
+    parser.add_argument(
+        "--hook-ms",
+        type=float,
+        default=0,
+        help="指定したミリ秒かかる PreToolUse フックを登録 (フックの時間の確認用)"
+    )
+    parser.add_argument(
+        "--bench-latency",
+        action="store_true",
+        help="スタンドイン CLI で所要時間の分解の精度を確認"
+    )
+    parser.add_argument(
+        "--bench-metrics",
+        action="store_true",
+        help="メトリクス記録のオーバーヘッドを計測"
+    )
     return parser.parse_args()
 
 
 async def main():
     args = parse_args()
 
+    if args.bench_metrics:
+        benchmark_metrics()
+        return
+    if args.bench_latency:
+        args.cli_path = args.cli_path or str(FAKE_CLI_PATH)
+        await benchmark_latency(args)
+        return
+
     print("=" * 50)
     print("ターン数モニタリング")
     print("=" * 50)
     print(f"プロンプト: {args.prompt}")
     print(f"最大ターン数: {args.max_turns}")
     print(f"詳細モード: {'ON' if args.verbose else 'OFF'}")
+    if args.agents > 1:
+        print(f"エージェント数: {args.agents}")
     print("=" * 50)
 
-    await monitored_query(
-        prompt=args.prompt,
-        max_turns=args.max_turns,
-        verbose=args.verbose
-    )
+    await run_fleet(args)
 
 
 if __name__ == "__main__":
@@ -5,35 +5,276 @@ Usage:
     python 03_budget_control.py --max-cost 0.10 --max-turns 50
     python 03_budget_control.py -c 0.05 -t 30 --prompts "README.mdを読んで" "src/を分析して"
     python 03_budget_control.py --interactive
+    python 03_budget_control.py --simulate 1000
+    python 03_budget_control.py -j 8 --timeout 120 --prompts "README.mdを読んで" "src/を分析して" "test/を調べて"
+    python 03_budget_control.py --bench-batch --concurrency-levels 1 8 32 128
+    python 03_budget_control.py --bench-cap
+    python 03_budget_control.py --allocate -t 40 --prompts "README.mdを読んで" "全ファイルをリファクタリングして" --values 1 5
+    python 03_budget_control.py --bench-allocate
 
 このスクリプトは、ターン数とコストの両方を予算として管理し、
 どちらかの上限に達した時点で処理を停止します。
 """
 import argparse
 import asyncio
+import contextlib
+import dataclasses
+import importlib
+import math
+import os
+import random
+import time
+from collections import deque
 from dataclasses import dataclass, field
-from typing import List
-from claude_agent_sdk import ClaudeAgentOptions, query, ResultMessage, AssistantMessage, TextBlock
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
 
+import numpy as np
+from claude_agent_sdk import (
+    ClaudeAgentOptions,
+    ClaudeSDKClient,
+    query,
+    ResultMessage,
+    AssistantMessage,
+    TextBlock,
+    ToolUseBlock,
+)
 
-@dataclass
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[3] / "test" / "fake_claude_cli.py"
+
+
+class BudgetExceededError(Exception):
+    """予算を予約できなかった"""
+
+
+@dataclass(eq=False)
+class Reservation:
+    """
+    実行前に確保した予算
+
+    完了したら commit() で実際のコスト・ターン数を記録し、予約との差額を返却します。
+    async with で使うと、commit() せずに抜けた場合（例外・キャンセル）は全額を返却します。
+    """
+    budget: "BudgetManager"
+    turns: int
+    cost: float
+    label: str = ""
+    done: bool = False
+
+    def commit(self, cost: float, turns: int):
+        self.budget._settle(self, cost, turns)
+
+    def release(self):
+        self.budget._settle(self, 0.0, 0)
+
+    async def __aenter__(self) -> "Reservation":
+        return self
+
+    async def __aexit__(self, *exc):
+        if not self.done:
+            self.release()
+
+
+@dataclass(eq=False)
 class BudgetManager:
-    """ターン数とコストの予算を管理するクラス"""
+    """
+    ターン数とコストの予算を管理するクラス
+
+    check_budget() は実行後にコストを加算するだけなので、並行に実行すると
+    全員が can_continue() を通過して上限を超えてしまいます。
+    並行実行では reserve() で見積もり分を先に確保し、完了したら差額を返却します。
+
+    child() で global → tenant → job の階層を作ると、予約は親をたどって
+    すべての階層の上限に収まる場合だけ成立します。予約が取れないときは
+    policy="reject" なら BudgetExceededError、policy="wait" なら返却を待ちます。
+    判定と加算の間に await を挟まないので、同じイベントループ内の並行実行で安全です。
+    """
     max_cost_usd: float
     max_turns: int
     total_cost: float = 0.0
     total_turns: int = 0
     query_history: List[dict] = field(default_factory=list)
+    name: str = "global"
+    policy: str = "reject"
+    cost_per_turn: float = 0.01
+    reserved_cost: float = 0.0
+    reserved_turns: int = 0
+    parent: Optional["BudgetManager"] = field(default=None, repr=False)
+    children: dict = field(default_factory=dict, repr=False)
+    _waiters: deque = field(default_factory=deque, repr=False)
+
+    EPSILON = 1e-9
+
+    def child(
+        self,
+        name: str,
+        max_cost_usd: float,
+        max_turns: int,
+        policy: Optional[str] = None
+    ) -> "BudgetManager":
+        """子の予算を作成（global → tenant → job）"""
+        node = BudgetManager(
+            max_cost_usd=max_cost_usd,
+            max_turns=max_turns,
+            name=f"{self.name}/{name}",
+            policy=policy or self.policy,
+            parent=self,
+        )
+        self.children[name] = node
+        return node
+
+    @property
+    def root(self) -> "BudgetManager":
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
+
+    def chain(self) -> list["BudgetManager"]:
+        """自分からルートまでの予算"""
+        nodes = [self]
+        while nodes[-1].parent is not None:
+            nodes.append(nodes[-1].parent)
+        return nodes
+
+    def estimate_cost(self, turns: int) -> float:
+        """ターン数からコストを見積もる（単価はルートで共有）"""
+        return turns * self.root.cost_per_turn
+
+    def _grantable_turns(self, turns: int, min_turns: int) -> int:
+        """すべての階層に収まる最大のターン数（min_turns 未満なら 0）"""
+        cost_per_turn = self.root.cost_per_turn
+        for node in self.chain():
+            free_turns = node.max_turns - node.total_turns - node.reserved_turns
+            free_cost = node.max_cost_usd - node.total_cost - node.reserved_cost
+            turns = min(turns, free_turns)
+            if cost_per_turn > 0:
+                turns = min(turns, math.floor(free_cost / cost_per_turn + self.EPSILON))
+        return turns if turns >= min_turns else 0
+
+    def _can_fit_later(self, min_turns: int) -> bool:
+        """予約がすべて返却されれば収まるか（収まらないなら待っても無駄）"""
+        cost = self.estimate_cost(min_turns)
+        return all(
+            node.total_turns + min_turns <= node.max_turns
+            and node.total_cost + cost <= node.max_cost_usd + self.EPSILON
+            for node in self.chain()
+        )
+
+    def try_reserve(self, turns: int, min_turns: Optional[int] = None, label: str = "") -> Optional[Reservation]:
+        """
+        予算を予約（待たない）
+
+        min_turns を指定すると、turns 全体が収まらなくても min_turns 以上なら
+        収まる分だけ予約します。予約できなければ None。
+        """
+        granted = self._grantable_turns(turns, min_turns or turns)
+        if granted <= 0:
+            return None
+        reservation = Reservation(self, granted, self.estimate_cost(granted), label)
+        for node in self.chain():
+            node.reserved_turns += reservation.turns
+            node.reserved_cost += reservation.cost
+        return reservation
+
+    async def reserve(
+        self,
+        turns: int,
+        min_turns: Optional[int] = None,
+        label: str = "",
+        timeout: Optional[float] = None
+    ) -> Reservation:
+        """
+        予算を予約
+
+        Raises:
+            BudgetExceededError: policy="reject" で予約できない、
+                待っても収まらない、または timeout までに予約できなかった
+        """
+        min_turns = min_turns or turns
+        reservation = self.try_reserve(turns, min_turns, label)
+        if reservation is not None:
+            return reservation
+        if self.policy != "wait" or not self._can_fit_later(min_turns):
+            raise BudgetExceededError(f"{self.name}: {min_turns}ターン分の予算がありません")
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (self, turns, min_turns, label, future)
+        self.root._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise BudgetExceededError(f"{self.name}: {timeout}秒待っても予約できませんでした") from None
+        except asyncio.CancelledError:
+            # 予約が成立した直後にキャンセルされた場合は返却する
+            if future.done() and not future.cancelled() and future.exception() is None:
+                future.result().release()
+            raise
+        finally:
+            if waiter in self.root._waiters:
+                self.root._waiters.remove(waiter)
+
+    def _settle(self, reservation: Reservation, cost: float, turns: int):
+        """予約を精算し、差額を返却して待っている予約を再評価"""
+        if reservation.done:
+            return
+        reservation.done = True
+        for node in self.chain():
+            node.reserved_turns -= reservation.turns
+            node.reserved_cost = max(0.0, node.reserved_cost - reservation.cost)
+            node.total_turns += turns
+            node.total_cost += cost
+        self.query_history.append({
+            "label": reservation.label,
+            "cost": cost,
+            "turns": turns,
+            "reserved_cost": reservation.cost,
+            "reserved_turns": reservation.turns,
+            "cumulative_cost": self.total_cost,
+            "cumulative_turns": self.total_turns,
+        })
+        # 見積もりより高くついた場合は単価を引き上げる（以降の予約を保守的にする）
+        root = self.root
+        if turns and cost / turns > root.cost_per_turn:
+            root.cost_per_turn = cost / turns
+        root._wake()
+
+    def _wake(self):
+        """
+        返却された予算で、待っている予約を順に成立させる
+
+        1回の走査の中では空きは減る一方なので、一度予約できなかった
+        (予算, min_turns) は以降の待ちも予約できないものとして判定を省きます。
+        """
+        blocked = set()
+        for waiter in list(self._waiters):
+            node, turns, min_turns, label, future = waiter
+            if future.done():
+                self._waiters.remove(waiter)
+                continue
+            if (node, min_turns) in blocked:
+                continue
+            reservation = node.try_reserve(turns, min_turns, label)
+            if reservation is not None:
+                future.set_result(reservation)
+                self._waiters.remove(waiter)
+            elif not node._can_fit_later(min_turns):
+                future.set_exception(BudgetExceededError(f"{node.name}: {min_turns}ターン分の予算がありません"))
+                self._waiters.remove(waiter)
+            else:
+                blocked.add((node, min_turns))
 
     def check_budget(self, cost: float, turns: int) -> tuple[bool, str]:
         """
-        予算内かどうかをチェック
+        予算内かどうかをチェック（実行後に加算する。並行実行では reserve() を使う）
 
         Returns:
             (is_within_budget, message)
         """
-        self.total_cost += cost
-        self.total_turns += turns
+        for node in self.chain():
+            node.total_cost += cost
+            node.total_turns += turns
 
         self.query_history.append({
             "cost": cost,
@@ -42,37 +283,43 @@ class BudgetManager:
             "cumulative_turns": self.total_turns,
         })
 
-        if self.total_cost > self.max_cost_usd:
-            return False, f"コスト上限 (${self.max_cost_usd:.4f}) を超過: ${self.total_cost:.4f}"
+        for node in self.chain():
+            if node.total_cost > node.max_cost_usd:
+                return False, f"コスト上限 (${node.max_cost_usd:.4f}) を超過: ${node.total_cost:.4f}"
 
-        if self.total_turns > self.max_turns:
-            return False, f"ターン上限 ({self.max_turns}) を超過: {self.total_turns}ターン"
+            if node.total_turns > node.max_turns:
+                return False, f"ターン上限 ({node.max_turns}) を超過: {node.total_turns}ターン"
 
         return True, "予算内"
 
     def get_remaining(self) -> dict:
-        """残りの予算を取得"""
+        """残りの予算を取得（予約済みの分は使用済みとして扱う）"""
+        used_cost = self.total_cost + self.reserved_cost
+        used_turns = self.total_turns + self.reserved_turns
         return {
-            "remaining_cost": max(0, self.max_cost_usd - self.total_cost),
-            "remaining_turns": max(0, self.max_turns - self.total_turns),
+            "remaining_cost": max(0, self.max_cost_usd - used_cost),
+            "remaining_turns": max(0, self.max_turns - used_turns),
+            "reserved_cost": self.reserved_cost,
+            "reserved_turns": self.reserved_turns,
             "cost_percentage": (self.total_cost / self.max_cost_usd) * 100 if self.max_cost_usd > 0 else 0,
             "turns_percentage": (self.total_turns / self.max_turns) * 100 if self.max_turns > 0 else 0,
         }
 
     def can_continue(self, min_turns: int = 1) -> bool:
-        """処理を継続できるかどうかを判定"""
-        remaining = self.get_remaining()
-        return remaining["remaining_turns"] >= min_turns and remaining["remaining_cost"] > 0
+        """処理を継続できるかどうかを判定（親の予算も含めて判定）"""
+        return self._grantable_turns(min_turns, min_turns) > 0
 
     def print_status(self):
         """現在の予算状況を表示"""
         remaining = self.get_remaining()
 
         print("\n" + "-" * 40)
-        print("💰 予算状況")
+        print(f"💰 予算状況 ({self.name})")
         print("-" * 40)
         print(f"  コスト:  ${self.total_cost:.4f} / ${self.max_cost_usd:.4f} ({remaining['cost_percentage']:.1f}%)")
         print(f"  ターン:  {self.total_turns} / {self.max_turns} ({remaining['turns_percentage']:.1f}%)")
+        if self.reserved_turns:
+            print(f"  予約中:  ${self.reserved_cost:.4f}, {self.reserved_turns}ターン")
         print(f"  残り:    ${remaining['remaining_cost']:.4f}, {remaining['remaining_turns']}ターン")
         print("-" * 40)
 
@@ -91,6 +338,141 @@ class BudgetManager:
             print(f"       累計: ${entry['cumulative_cost']:.4f}, {entry['cumulative_turns']}ターン")
 
 
+# 1M トークンあたりの料金 (USD, 目安)。モデル名に含まれる文字列で選ぶ
+MODEL_PRICING = {
+    "opus": {"input": 15.0, "output": 75.0, "cache_read": 1.5, "cache_write": 18.75},
+    "sonnet": {"input": 3.0, "output": 15.0, "cache_read": 0.3, "cache_write": 3.75},
+    "haiku": {"input": 1.0, "output": 5.0, "cache_read": 0.1, "cache_write": 1.25},
+}
+DEFAULT_PRICING = MODEL_PRICING["sonnet"]
+
+
+class CostMeter:
+    """
+    AssistantMessage の usage から実行中のクエリのコストを見積もる
+
+    total_cost_usd は ResultMessage が届くまでわからないため、ターンごとの usage を
+    料金表で換算して累計します。1つの API 応答が複数の AssistantMessage に
+    分かれることがあるので、usage は message_id ごとに1回だけ数えます。
+    """
+
+    def __init__(self, pricing: Optional[dict] = None, safety: float = 1.2, window: int = 3):
+        self.pricing = pricing
+        self.safety = safety
+        self.spent = 0.0
+        self.turns = 0
+        self.recent = deque(maxlen=window)
+        self._seen: set[str] = set()
+
+    @staticmethod
+    def pricing_for(model: Optional[str]) -> dict:
+        for name, pricing in MODEL_PRICING.items():
+            if model and name in model:
+                return pricing
+        return DEFAULT_PRICING
+
+    def turn_cost(self, usage: dict, model: Optional[str] = None) -> float:
+        price = self.pricing or self.pricing_for(model)
+        return (
+            usage.get("input_tokens", 0) * price["input"]
+            + usage.get("output_tokens", 0) * price["output"]
+            + usage.get("cache_read_input_tokens", 0) * price["cache_read"]
+            + usage.get("cache_creation_input_tokens", 0) * price["cache_write"]
+        ) / 1_000_000
+
+    def observe(self, message: AssistantMessage) -> float:
+        """usage を加算し、ここまでの見積もりコストを返す"""
+        if not message.usage:
+            return self.spent
+        if message.message_id:
+            if message.message_id in self._seen:
+                return self.spent
+            self._seen.add(message.message_id)
+        cost = self.turn_cost(message.usage, message.model)
+        self.spent += cost
+        self.turns += 1
+        self.recent.append(cost)
+        return self.spent
+
+    def projected(self) -> float:
+        """
+        次のターンまで進んだ場合の見込みコスト
+
+        コンテキストが増えるとターンのコストも増えるため、直近のターンの増え方を
+        延長して次のターンのコストを見積もり、safety 倍の余裕を持たせます。
+        """
+        if not self.recent:
+            return self.spent
+        last = self.recent[-1]
+        trend = (last - self.recent[0]) / (len(self.recent) - 1) if len(self.recent) > 1 else 0.0
+        return self.spent + (last + max(0.0, trend)) * self.safety
+
+
+@dataclass
+class CappedResult:
+    """コスト上限付きで実行したクエリの結果"""
+    allowance: float
+    completed: bool = False
+    interrupted: bool = False
+    subtype: str = ""
+    turns: int = 0
+    cost: float = 0.0
+    estimated_cost: float = 0.0
+    projected_cost: float = 0.0
+    tool_calls: int = 0
+    texts: List[str] = field(default_factory=list)
+
+
+async def capped_query(
+    prompt: str,
+    allowance: float,
+    options: ClaudeAgentOptions,
+    meter: Optional[CostMeter] = None,
+    verbose: bool = True
+) -> CappedResult:
+    """
+    見込みコストが allowance を超える前に interrupt() で止めるクエリ
+
+    AssistantMessage ごとに CostMeter で見積もりを更新し、次のターンまで進むと
+    allowance を超える見込みになった時点で中断します。中断までに受け取った
+    テキストとツール呼び出しは結果に残ります。
+    """
+    meter = meter or CostMeter()
+    result = CappedResult(allowance=allowance)
+
+    async with ClaudeSDKClient(options) as client:
+        await client.query(prompt)
+        async for message in client.receive_response():
+            if isinstance(message, AssistantMessage):
+                meter.observe(message)
+                for block in message.content:
+                    if isinstance(block, TextBlock):
+                        result.texts.append(block.text)
+                        if verbose:
+                            # 最初の200文字のみ表示
+                            text = block.text[:200] + "..." if len(block.text) > 200 else block.text
+                            print(f"  📝 {text}")
+                    elif isinstance(block, ToolUseBlock):
+                        result.tool_calls += 1
+
+                projected = meter.projected()
+                if not result.interrupted and projected > allowance:
+                    result.interrupted = True
+                    result.projected_cost = projected
+                    if verbose:
+                        print(f"\n⛔ 見込みコスト ${projected:.4f} が上限 ${allowance:.4f} を超えるため中断します")
+                    await client.interrupt()
+
+            elif isinstance(message, ResultMessage):
+                result.subtype = message.subtype
+                result.turns = message.num_turns
+                result.cost = message.total_cost_usd or 0.0
+                result.completed = not result.interrupted and not message.is_error
+
+    result.estimated_cost = meter.spent
+    return result
+
+
 async def budget_aware_query(
     prompt: str,
     budget: BudgetManager,
@@ -99,87 +481,691 @@ async def budget_aware_query(
     """
     予算を考慮してクエリを実行
 
+    実行前に turns_per_query ターン分（足りなければ残りの分）を予約し、
+    完了後に実際のコスト・ターン数で精算します。実行中も usage からコストを
+    見積もり、予約分と未予約の残り予算を超える見込みになったら中断します。
+
     Returns:
         処理が正常に完了したかどうか
     """
-    remaining = budget.get_remaining()
-
-    # 残りターンが足りない場合
-    if remaining["remaining_turns"] < 1:
-        print("⚠️ ターン予算が不足しています")
+    try:
+        reservation = await budget.reserve(turns_per_query, min_turns=1, label=prompt[:50])
+    except BudgetExceededError as e:
+        print(f"⚠️ ターン予算が不足しています: {e}")
         return False
 
-    # このクエリで使用するターン数を決定
-    turns_to_use = min(turns_per_query, remaining["remaining_turns"])
+    async with reservation:
+        allowance = reservation.cost + budget.get_remaining()["remaining_cost"]
+        options = ClaudeAgentOptions(
+            max_turns=reservation.turns,
+            allowed_tools=["Read", "Glob", "Grep"]
+        )
+
+        print(f"\n🚀 クエリ実行: max_turns={reservation.turns}, コスト上限 ${allowance:.4f}")
+
+        result = await capped_query(prompt, allowance, options)
+        reservation.commit(result.cost, result.turns)
+
+        if result.interrupted:
+            print("  保持した結果:")
+            print(f"    {result.turns}ターン, ツール呼び出し {result.tool_calls}件, テキスト {len(result.texts)}件")
+            print(f"    実コスト ${result.cost:.4f} (見積もり ${result.estimated_cost:.4f})")
+            if result.texts:
+                print(f"    最後の出力: {result.texts[-1][:100]}")
+            return False
+
+        if budget.total_cost > budget.max_cost_usd:
+            print(f"\n⛔ 予算超過: ${budget.total_cost:.4f} > ${budget.max_cost_usd:.4f}")
+            return False
+
+    return True
+
 
+async def benchmark_cost_cap(args: argparse.Namespace):
+    """スタンドイン CLI で、ターンごとにコストが増えるクエリを上限付きで実行"""
+    allowances = [0.05, 0.10, 0.20]
     options = ClaudeAgentOptions(
-        max_turns=turns_to_use,
-        allowed_tools=["Read", "Glob", "Grep"]
+        cli_path=str(args.cli_path),
+        model="claude-sonnet-fake",
+        max_turns=40,
+        env={
+            "FAKE_CLI_STARTUP_MS": "100",
+            "FAKE_CLI_TURN_MS": "20",
+            "FAKE_CLI_TURNS": "40",
+            # 1200 入力 + 150 出力トークンを sonnet の料金で換算したコスト
+            "FAKE_CLI_COST_PER_TURN": "0.00585",
+            "FAKE_CLI_CONTEXT_GROWTH": "2000",
+        }
     )
 
-    print(f"\n🚀 クエリ実行: max_turns={turns_to_use}")
+    print("=" * 60)
+    print("コスト上限 ベンチマーク")
+    print("=" * 60)
+    print("タスク: 40ターン、入力が1ターンごとに2000トークン増える")
+    print("=" * 60)
+
+    rows = []
+    # 従来: ResultMessage が届くまでコストがわからない
+    async for message in query(prompt="暴走するクエリ", options=options):
+        if isinstance(message, ResultMessage):
+            rows.append(("上限なし", None, message.num_turns, message.total_cost_usd, None, message.subtype))
+    for allowance in allowances:
+        result = await capped_query("暴走するクエリ", allowance, options, verbose=False)
+        rows.append((f"上限 ${allowance:.2f}", allowance, result.turns, result.cost, result, result.subtype))
+
+    print(f"\n{'方式':<12} {'ターン':>6} {'実コスト($)':>12} {'見積もり($)':>12} {'見込み($)':>10} {'上限比':>7} {'結果':<24}")
+    print("-" * 90)
+    for name, allowance, turns, cost, result, subtype in rows:
+        estimated = f"{result.estimated_cost:>12.4f}" if result else f"{'-':>12}"
+        projected = f"{result.projected_cost:>10.4f}" if result and result.interrupted else f"{'-':>10}"
+        ratio = f"{cost / allowance:>6.0%}" if allowance else f"{'-':>6}"
+        print(f"{name:<12} {turns:>6} {cost:>12.4f} {estimated} {projected} {ratio:>7} {subtype:<24}")
+    print("-" * 90)
+
 
-    async for message in query(prompt=prompt, options=options):
-        if isinstance(message, AssistantMessage):
-            for block in message.content:
-                if isinstance(block, TextBlock):
-                    # 最初の200文字のみ表示
-                    text = block.text[:200] + "..." if len(block.text) > 200 else block.text
-                    print(f"  📝 {text}")
+class TurnAllocator:
+    """
+    バッチ内のプロンプトに予算のターン数を配分する
+
+    プロンプト i に t ターンを配分したときの期待価値を value_i × P(必要なターン数 ≤ t) とし、
+    合計が残り予算に収まる範囲で期待価値の合計を最大にします（多選択ナップサック）。
+    必要なターン数は「推定ターン数 × 比 (実際 / 推定)」で、比の分布は ratios
+    （省略時は対数正規分布の標本）を使います。
 
-        elif isinstance(message, ResultMessage):
-            is_ok, msg = budget.check_budget(
-                message.total_cost_usd,
-                message.num_turns
+    ラグランジュ緩和で解きます。1ターンの価格 λ に対して各プロンプトが
+    value × P - λ × t を最大にする t を選び、合計が予算に収まる最小の λ を二分探索します。
+    完了確率は t について S 字なので、単純な貪欲法と違い「少しだけ配分して打ち切られる」
+    配分を避けられます。
+
+    結果が返るたびに observe() で比の分布を更新し、take() は未開始のプロンプトだけを
+    その時点の残り予算（予約中の分は除く）で解き直してから、次に実行するものを選びます。
+    """
+
+    def __init__(
+        self,
+        budget: BudgetManager,
+        estimated_turns: List[int],
+        values: Optional[List[float]] = None,
+        max_turns: int = 100,
+        ratios: Optional[List[float]] = None,
+        seed: int = 0
+    ):
+        self.budget = budget
+        self.estimated = np.maximum(np.asarray(estimated_turns, dtype=float), 1)
+        self.values = np.asarray(values if values is not None else [1.0] * len(estimated_turns), dtype=float)
+        if len(self.values) != len(self.estimated):
+            raise ValueError(
+                f"values の数 ({len(self.values)}) がプロンプトの数 ({len(self.estimated)}) と一致しません"
             )
+        self.max_turns = max_turns
+        self.rng = np.random.default_rng(seed)
+        if ratios is None:
+            # 推定は外れる前提で、実際が推定の 1/2〜2 倍に収まる程度の広さにする
+            ratios = self.rng.lognormal(0.0, 0.5, 50)
+        self.ratios = np.sort(np.asarray(ratios, dtype=float))
+        self.allocated = np.zeros(len(self.estimated), dtype=int)
+        self.pending = np.ones(len(self.estimated), dtype=bool)
+        self.levels = np.arange(max_turns + 1)
 
-            if not is_ok:
-                print(f"\n⛔ 予算超過: {msg}")
-                return False
+    def completion(self, rows: np.ndarray) -> np.ndarray:
+        """rows の各プロンプトに 0..max_turns ターン配分したときの完了確率 (len(rows) × (max_turns + 1))"""
+        needed = self.levels[None, :] / self.estimated[rows, None]
+        return np.searchsorted(self.ratios, needed, side="right") / len(self.ratios)
 
-    return True
+    def solve(self, rows: np.ndarray, capacity: int) -> np.ndarray:
+        """rows に合計 capacity ターン以内で配分"""
+        if len(rows) == 0 or capacity <= 0:
+            return np.zeros(len(rows), dtype=int)
+        gain = self.values[rows, None] * self.completion(rows)
+
+        def pick(price: float) -> np.ndarray:
+            return np.argmax(gain - price * self.levels[None, :], axis=1)
+
+        turns = pick(0.0)
+        if turns.sum() <= capacity:
+            return turns
+        low, high = 0.0, float(self.values[rows].max())
+        for _ in range(40):
+            price = (low + high) / 2
+            if pick(price).sum() > capacity:
+                low = price
+            else:
+                high = price
+        # 同じような項目が多いと λ のわずかな差で配分が一斉に変わり、予算が余る。
+        # 余った分は、低い価格での配分に上げたときの効率が高い順に詰める
+        turns, upgrade = pick(high), pick(low)
+        rows_index = np.arange(len(rows))
+        extra = upgrade - turns
+        efficiency = (gain[rows_index, upgrade] - gain[rows_index, turns]) / np.maximum(extra, 1)
+        free = capacity - turns.sum()
+        for i in np.argsort(-efficiency):
+            if 0 < extra[i] <= free:
+                turns[i] = upgrade[i]
+                free -= extra[i]
+        return turns
+
+    def capacity(self) -> int:
+        """残り予算で配分できるターン数（予約中の分は除く）"""
+        remaining = self.budget.get_remaining()
+        turns = remaining["remaining_turns"]
+        cost_per_turn = self.budget.root.cost_per_turn
+        if cost_per_turn > 0:
+            turns = min(turns, math.floor(remaining["remaining_cost"] / cost_per_turn + BudgetManager.EPSILON))
+        return int(turns)
+
+    def rebalance(self):
+        """未開始のプロンプトの配分を解き直す"""
+        rows = np.flatnonzero(self.pending)
+        self.allocated[rows] = self.solve(rows, self.capacity())
+
+    def take(self) -> Optional[int]:
+        """
+        次に実行するプロンプトの index（配分できるものがなければ None）
+
+        配分したターン数あたりの期待価値が大きいものから実行します。
+        """
+        self.rebalance()
+        rows = np.flatnonzero(self.pending & (self.allocated > 0))
+        if len(rows) == 0:
+            return None
+        probability = self.completion(rows)[np.arange(len(rows)), self.allocated[rows]]
+        index = int(rows[np.argmax(self.values[rows] * probability / self.allocated[rows])])
+        self.pending[index] = False
+        return index
+
+    def observe(self, index: int, turns: int, completed: bool):
+        """
+        実行結果から比の分布を更新
+
+        打ち切られた実行は「比は turns / 推定 より大きい」としかわからないので、
+        今の分布のうちそれより大きい値から1つ引いて補います。
+        """
+        ratio = turns / self.estimated[index]
+        if not completed:
+            tail = self.ratios[self.ratios > ratio]
+            ratio = self.rng.choice(tail) if len(tail) else ratio * 2
+        self.ratios = np.insert(self.ratios, np.searchsorted(self.ratios, ratio), ratio)
+
+
+@dataclass
+class BatchResult:
+    """バッチ内の1件の結果"""
+    index: int
+    prompt: str
+    status: str  # ok / timeout / error / skipped / cancelled
+    subtype: str = ""
+    turns: int = 0
+    cost: float = 0.0
+    elapsed: float = 0.0
+    text: str = ""
+    error: str = ""
+
+
+class BatchRunner:
+    """
+    複数のプロンプトを同時実行数を制限して並行に実行
+
+    concurrency 個のワーカーが順にプロンプトを取り出し、BudgetManager に予約してから
+    ClaudeSDKClient で実行します。使用済みの予算が stop_ratio に達した、または予約できない
+    (policy="wait" なら待っても収まらない) 場合は新しいクエリを開始せず、残りは skipped になります。
+    timeout を超えたクエリや cancel() されたクエリは、それまでに観測した
+    ターン数を見積もり単価で精算します。打ち切ったクエリは interrupt() で止めてから
+    接続を閉じ（stop_timeout を過ぎても終わらなければキャンセル）、この終了処理は
+    バックグラウンドで行って同時実行の枠はすぐに空けます。
+
+    allocator を渡すと、turns_per_query の代わりに TurnAllocator の配分で
+    実行順と各クエリのターン数を決め、結果が返るたびに配分を解き直します。
+    """
+
+    def __init__(
+        self,
+        budget: BudgetManager,
+        concurrency: int = 8,
+        turns_per_query: int = 10,
+        timeout: Optional[float] = None,
+        stop_ratio: float = 0.95,
+        options: Optional[ClaudeAgentOptions] = None,
+        allocator: Optional[TurnAllocator] = None,
+        stop_timeout: float = 10.0
+    ):
+        self.budget = budget
+        self.concurrency = concurrency
+        self.turns_per_query = turns_per_query
+        self.timeout = timeout
+        self.stop_ratio = stop_ratio
+        self.options = options or ClaudeAgentOptions(allowed_tools=["Read", "Glob", "Grep"])
+        self.allocator = allocator
+        self.stop_timeout = stop_timeout
+        self._stopping = False
+        self._cancelled: set[int] = set()
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._closing: set[asyncio.Task] = set()
+
+    def budget_exhausted(self) -> bool:
+        """新しいクエリを開始すべきでないか"""
+        if self._stopping:
+            return True
+        # 予約中の分は返却されることがあるので、使用済みの分だけで判定する
+        remaining = self.budget.get_remaining()
+        return max(remaining["cost_percentage"], remaining["turns_percentage"]) >= self.stop_ratio * 100
+
+    def cancel(self, index: Optional[int] = None):
+        """index のクエリ（省略時はすべて）をキャンセル"""
+        if index is None:
+            self._stopping = True
+            targets = list(self._tasks.items())
+        else:
+            targets = [(index, self._tasks[index])] if index in self._tasks else []
+        for i, task in targets:
+            self._cancelled.add(i)
+            task.cancel()
+
+    async def _run_one(self, index: int, prompt: str) -> BatchResult:
+        result = BatchResult(index, prompt, "ok")
+        start = time.perf_counter()
+        if self.budget_exhausted():
+            result.status = "skipped"
+            result.error = "予算の上限に近いため開始しませんでした"
+            return result
+
+        turns = int(self.allocator.allocated[index]) if self.allocator else self.turns_per_query
+        try:
+            reservation = await self.budget.reserve(turns, min_turns=1, label=prompt[:50])
+        except BudgetExceededError as e:
+            self._stopping = True
+            result.status = "skipped"
+            result.error = str(e)
+            return result
+        except asyncio.CancelledError:
+            if index not in self._cancelled:
+                raise
+            result.status = "cancelled"
+            return result
+
+        client: Optional[ClaudeSDKClient] = None
+        stopped = False
+
+        async def consume():
+            nonlocal client
+            options = dataclasses.replace(self.options, max_turns=reservation.turns)
+            message_id = None
+            async with ClaudeSDKClient(options) as connected:
+                if stopped:
+                    return
+                await connected.query(prompt)
+                client = connected
+                if stopped:
+                    await connected.interrupt()
+                async for message in connected.receive_response():
+                    # 打ち切ったあとのメッセージは精算済みの結果に含めない
+                    if stopped:
+                        continue
+                    if isinstance(message, AssistantMessage):
+                        # 1つの応答のテキストとツール呼び出しは同じ message_id で別々に届く
+                        if message.message_id is None or message.message_id != message_id:
+                            result.turns += 1
+                            message_id = message.message_id
+                        for block in message.content:
+                            if isinstance(block, TextBlock):
+                                result.text = block.text
+                    elif isinstance(message, ResultMessage):
+                        result.subtype = message.subtype
+                        result.turns = message.num_turns
+                        result.cost = message.total_cost_usd or 0.0
+                        reservation.commit(result.cost, result.turns)
+                        if self.allocator:
+                            self.allocator.observe(index, result.turns, message.subtype == "success")
+
+        async def stop():
+            """実行中のクエリを interrupt() で止める（接続前なら接続後すぐに閉じる）"""
+            nonlocal stopped
+            stopped = True
+            if client is not None:
+                with contextlib.suppress(Exception):
+                    await client.interrupt()
+
+        async with reservation:
+            task = asyncio.create_task(consume())
+            try:
+                done, _ = await asyncio.wait({task}, timeout=self.timeout)
+                if task in done:
+                    task.result()
+                else:
+                    result.status = "timeout"
+                    self._abandon(task, stop)
+            except asyncio.CancelledError:
+                self._abandon(task, stop)
+                if index not in self._cancelled:
+                    raise
+                result.status = "cancelled"
+            except Exception as e:
+                result.status = "error"
+                result.error = f"{type(e).__name__}: {e}"
+            finally:
+                if not reservation.done:
+                    # 途中で打ち切ったクエリも、観測したターン数分は使ったものとして精算
+                    result.cost = self.budget.estimate_cost(result.turns)
+                    reservation.commit(result.cost, result.turns)
+
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def _abandon(self, task: asyncio.Task, stop: Callable[[], Awaitable[None]]):
+        """クエリの終了処理をバックグラウンドで始め、完了を待たずに枠を空ける"""
+        closing = asyncio.create_task(self._close(task, stop))
+        self._closing.add(closing)
+        closing.add_done_callback(self._closing.discard)
+
+    async def _close(self, task: asyncio.Task, stop: Callable[[], Awaitable[None]]):
+        """
+        interrupt() で止めて接続を閉じるまで待つ
+
+        task.cancel() だけでは SDK が CLI プロセスを終了させずに残すため、
+        stop_timeout を過ぎても終わらない場合に限ってキャンセルします。
+        """
+        await stop()
+        _, pending = await asyncio.wait({task}, timeout=self.stop_timeout)
+        for remaining in pending:
+            remaining.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def run(self, prompts: List[str], ordered: bool = True):
+        """
+        結果を順に返す非同期イテレータ
+
+        ordered=True ならプロンプトの順、False なら完了した順に返します。
+        途中でイテレーションをやめると、実行中のクエリはキャンセルされます。
+        """
+        self._stopping = False
+        self._cancelled.clear()
+        pending: asyncio.Queue = asyncio.Queue()
+        for item in enumerate(prompts):
+            pending.put_nowait(item)
+        results: asyncio.Queue = asyncio.Queue()
+
+        def next_item() -> Optional[tuple[int, str]]:
+            if self.allocator is None:
+                return None if pending.empty() else pending.get_nowait()
+            index = None if self._stopping else self.allocator.take()
+            return None if index is None else (index, prompts[index])
+
+        async def worker():
+            while (item := next_item()) is not None:
+                index, prompt = item
+                task = asyncio.create_task(self._run_one(index, prompt))
+                self._tasks[index] = task
+                try:
+                    result = await task
+                finally:
+                    self._tasks.pop(index, None)
+                await results.put(result)
+
+        async def supervise():
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(prompts)))))
+            # 配分が付かなかったプロンプト
+            if self.allocator is not None:
+                for index in np.flatnonzero(self.allocator.pending):
+                    self.allocator.pending[index] = False
+                    await results.put(BatchResult(
+                        int(index), prompts[index], "skipped", error="予算を配分できませんでした"
+                    ))
+
+        workers = [asyncio.create_task(supervise())]
+        try:
+            buffered = {}
+            next_index = 0
+            for _ in range(len(prompts)):
+                result = await results.get()
+                if not ordered:
+                    yield result
+                    continue
+                buffered[result.index] = result
+                while next_index in buffered:
+                    yield buffered.pop(next_index)
+                    next_index += 1
+        finally:
+            self.cancel()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # 打ち切ったクエリの CLI プロセスが終了するまで待つ
+            await asyncio.gather(*self._closing, return_exceptions=True)
 
 
 async def run_multiple_queries(
     prompts: List[str],
     budget: BudgetManager,
-    turns_per_query: int = 10
+    turns_per_query: int = 10,
+    concurrency: int = 1,
+    ordered: bool = True,
+    timeout: Optional[float] = None,
+    options: Optional[ClaudeAgentOptions] = None,
+    values: Optional[List[float]] = None,
+    allocate: bool = False
 ):
-    """複数のクエリを予算内で実行"""
+    """
+    複数のクエリを予算内で実行（concurrency 件まで並行）
+
+    allocate=True なら、04_adaptive.py の TurnEstimator の推定と values（優先度）から
+    TurnAllocator で各クエリのターン数（上限 turns_per_query）を配分します。
+    """
     print("=" * 50)
     print("複数クエリの予算管理実行")
     print("=" * 50)
     print(f"クエリ数: {len(prompts)}")
     print(f"予算: ${budget.max_cost_usd:.4f}, {budget.max_turns}ターン")
+    print(f"同時実行数: {concurrency}")
     print("=" * 50)
 
-    completed = 0
-    for i, prompt in enumerate(prompts, 1):
-        print(f"\n--- クエリ {i}/{len(prompts)} ---")
-        print(f"プロンプト: {prompt[:50]}{'...' if len(prompt) > 50 else ''}")
-
-        if not budget.can_continue():
-            print("⚠️ 予算が不足しているため、残りのクエリをスキップします")
-            break
-
-        success = await budget_aware_query(prompt, budget, turns_per_query)
+    allocator = None
+    if allocate:
+        estimator = importlib.import_module("04_adaptive").TurnEstimator()
+        estimated = [estimator.estimate(prompt) for prompt in prompts]
+        allocator = TurnAllocator(budget, estimated, values, max_turns=turns_per_query)
+        allocator.rebalance()
+        for prompt, turns, value in zip(prompts, allocator.allocated, allocator.values):
+            print(f"  配分 {turns:>3}ターン (価値 {value:g}): {prompt[:40]}")
 
-        if success:
-            completed += 1
-            budget.print_status()
-        else:
-            print("⚠️ 予算超過のため処理を中断")
-            break
+    runner = BatchRunner(budget, concurrency, turns_per_query, timeout, options=options, allocator=allocator)
+    counts: dict[str, int] = {}
+    start = time.perf_counter()
+    async for result in runner.run(prompts, ordered=ordered):
+        counts[result.status] = counts.get(result.status, 0) + 1
+        print(f"\n--- クエリ {result.index + 1}/{len(prompts)} [{result.status}] ---")
+        print(f"プロンプト: {result.prompt[:50]}{'...' if len(result.prompt) > 50 else ''}")
+        if result.status == "ok":
+            text = result.text[:200] + "..." if len(result.text) > 200 else result.text
+            print(f"  📝 {text}")
+            print(f"  {result.turns}ターン, ${result.cost:.4f}, {result.elapsed:.1f}秒")
+        elif result.error:
+            print(f"  ⚠️ {result.error}")
+    elapsed = time.perf_counter() - start
 
     # 最終レポート
     print("\n" + "=" * 50)
     print("📊 最終レポート")
     print("=" * 50)
-    print(f"完了クエリ: {completed}/{len(prompts)}")
+    print(f"完了クエリ: {counts.get('ok', 0)}/{len(prompts)}")
+    for status in ["timeout", "error", "skipped", "cancelled"]:
+        if counts.get(status):
+            print(f"{status}: {counts[status]}")
+    print(f"所要時間: {elapsed:.1f}秒 ({len(prompts) / elapsed:.2f}クエリ/秒)")
     budget.print_status()
     budget.print_history()
 
 
+async def benchmark_batch(args: argparse.Namespace):
+    """スタンドイン CLI で、同時実行数ごとのスループットを計測"""
+    prompts = [f"ファイル {i} を要約して" for i in range(args.batch_size)]
+
+    def make_options(env: dict) -> ClaudeAgentOptions:
+        return ClaudeAgentOptions(
+            cli_path=str(args.cli_path),
+            allowed_tools=["Read", "Glob", "Grep"],
+            env={"FAKE_CLI_STARTUP_MS": "300", "FAKE_CLI_TURN_MS": "200", "FAKE_CLI_TURNS": "2", **env}
+        )
+
+    # スタンドイン CLI にバージョン確認は不要。並列に起動すると確認用のプロセスが
+    # タイムアウトで終了させられ、"Unknown child process" の警告が出る
+    os.environ.setdefault("CLAUDE_AGENT_SDK_SKIP_VERSION_CHECK", "1")
+
+    async def measure(concurrency: int, budget: BudgetManager, timeout=None, env=None) -> dict:
+        runner = BatchRunner(budget, concurrency, args.turns_per_query, timeout, options=make_options(env or {}))
+        counts: dict[str, int] = {}
+        latencies = []
+        start = time.perf_counter()
+        async for result in runner.run(prompts, ordered=False):
+            counts[result.status] = counts.get(result.status, 0) + 1
+            if result.status == "ok":
+                latencies.append(result.elapsed)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        return {
+            "counts": counts,
+            "elapsed": elapsed,
+            "throughput": counts.get("ok", 0) / elapsed,
+            "p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "budget": budget,
+        }
+
+    print("=" * 60)
+    print("バッチ実行 ベンチマーク")
+    print("=" * 60)
+    print(f"クエリ数: {args.batch_size} (1件: 起動 300ms + 2ターン × 200ms)")
+    print("=" * 60)
+
+    rows = []
+    for concurrency in args.concurrency_levels:
+        budget = BudgetManager(max_cost_usd=100.0, max_turns=100000, cost_per_turn=0.002)
+        rows.append((f"同時 {concurrency}", await measure(concurrency, budget)))
+
+    # 予算が途中で尽きる場合と、応答が止まるクエリがある場合
+    concurrency = args.concurrency_levels[min(1, len(args.concurrency_levels) - 1)]
+    budget = BudgetManager(max_cost_usd=100.0, max_turns=args.batch_size, cost_per_turn=0.002, policy="wait")
+    rows.append((f"同時 {concurrency} 予算{args.batch_size}ターン", await measure(concurrency, budget)))
+    budget = BudgetManager(max_cost_usd=100.0, max_turns=100000, cost_per_turn=0.002)
+    rows.append((
+        f"同時 {concurrency} 10%停止",
+        await measure(concurrency, budget, timeout=3.0,
+                      env={"FAKE_CLI_STALL_RATE": "0.1", "FAKE_CLI_STALL_MS": "10000"})
+    ))
+
+    base = rows[0][1]["throughput"]
+    print(f"\n{'条件':<22} {'完了':>5} {'timeout':>7} {'skipped':>7} {'時間(s)':>8} {'件/秒':>7} {'倍率':>6} {'p50(s)':>7} {'ターン':>11}")
+    print("-" * 90)
+    for name, r in rows:
+        counts = r["counts"]
+        budget = r["budget"]
+        print(
+            f"{name:<22} {counts.get('ok', 0):>5} {counts.get('timeout', 0):>7} {counts.get('skipped', 0):>7}"
+            f" {r['elapsed']:>8.2f} {r['throughput']:>7.2f} {r['throughput'] / base:>5.1f}x {r['p50']:>7.2f}"
+            f" {budget.total_turns:>5}/{budget.max_turns:<5}"
+        )
+    print("-" * 90)
+
+
+def allocation_workload(count: int, seed: int = 0) -> dict:
+    """推定ターン数・実際に必要なターン数・価値（優先度）を持つプロンプトを合成"""
+    rng = np.random.default_rng(seed)
+    estimated = rng.choice([3, 5, 10, 20, 30], count)
+    # 推定はやや少なめに外れる
+    needed = np.maximum(1, np.round(estimated * rng.lognormal(0.2, 0.6, count))).astype(int)
+    values = rng.choice([1.0, 2.0, 5.0, 10.0], count)
+    return {"estimated": estimated, "needed": needed, "values": values}
+
+
+def optimal_value(needed: np.ndarray, values: np.ndarray, capacity: int) -> float:
+    """必要なターン数を知っている場合の最適値（0/1 ナップサックの動的計画法）"""
+    best = np.zeros(capacity + 1)
+    for turns, value in zip(needed, values):
+        if turns <= capacity:
+            best[turns:] = np.maximum(best[turns:], best[:-turns] + value)
+    return float(best[-1])
+
+
+def simulate_allocation(workload: dict, strategy: str, budget_turns: int, max_turns: int = 100) -> dict:
+    """
+    API を呼ばずに、1件ずつ順に実行した場合の配分戦略を比較
+
+    strategy:
+        uniform   : 全件に 予算 / 件数 ターン（turns_per_query を揃えた従来の実行）
+        estimate  : 推定ターン数をそのまま配分
+        static    : TurnAllocator で最初に1回だけ配分
+        rebalance : TurnAllocator で結果ごとに解き直す
+    """
+    estimated, needed, values = workload["estimated"], workload["needed"], workload["values"]
+    budget = BudgetManager(max_cost_usd=1e9, max_turns=budget_turns)
+    allocator = TurnAllocator(budget, estimated, values, max_turns=max_turns)
+
+    if strategy == "uniform":
+        plan = [(i, budget_turns // len(needed)) for i in range(len(needed))]
+    elif strategy == "estimate":
+        plan = [(i, int(turns)) for i, turns in enumerate(estimated)]
+    elif strategy == "static":
+        allocator.rebalance()
+        order = np.argsort(-values / np.maximum(allocator.allocated, 1))
+        plan = [(int(i), int(allocator.allocated[i])) for i in order if allocator.allocated[i] > 0]
+    else:
+        plan = None
+
+    completed = value = wasted = 0
+    start = time.perf_counter()
+    while True:
+        if plan is None:
+            index = allocator.take()
+            if index is None:
+                break
+            turns = int(allocator.allocated[index])
+        elif plan:
+            index, turns = plan.pop(0)
+        else:
+            break
+        reservation = budget.try_reserve(turns, min_turns=1)
+        if reservation is None:
+            continue
+        used = min(needed[index], reservation.turns)
+        done = needed[index] <= reservation.turns
+        reservation.commit(budget.estimate_cost(used), int(used))
+        allocator.observe(index, int(used), bool(done))
+        if done:
+            completed += 1
+            value += values[index]
+        else:
+            wasted += used
+    return {
+        "completed": completed,
+        "value": value,
+        "turns": budget.total_turns,
+        "wasted": wasted,
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+def benchmark_allocation(args: argparse.Namespace):
+    """配分戦略ごとに、予算内で完了した価値を比較"""
+    workload = allocation_workload(args.batch_size)
+    needed, values = workload["needed"], workload["values"]
+
+    print("=" * 70)
+    print("ターン配分 ベンチマーク")
+    print("=" * 70)
+    print(f"プロンプト: {len(needed)}件, 必要なターン数の合計: {needed.sum()}, 価値の合計: {values.sum():.0f}")
+    print("=" * 70)
+    print(f"\n{'予算':>6} {'戦略':<10} {'完了':>5} {'価値':>7} {'最適比':>7} {'ターン':>7} {'打ち切り分':>9} {'時間(ms)':>9}")
+    print("-" * 70)
+    for ratio in args.budget_ratios:
+        budget_turns = int(needed.sum() * ratio)
+        optimum = optimal_value(needed, values, budget_turns)
+        for strategy in ["uniform", "estimate", "static", "rebalance"]:
+            r = simulate_allocation(workload, strategy, budget_turns)
+            print(
+                f"{ratio:>6.0%} {strategy:<10} {r['completed']:>5} {r['value']:>7.0f} {r['value'] / optimum:>7.1%}"
+                f" {r['turns']:>7} {r['wasted']:>9} {r['elapsed'] * 1000:>9.1f}"
+            )
+        print(f"{'':>6} {'(最適)':<10} {'':>5} {optimum:>7.0f} {1:>7.1%}")
+        print("-" * 70)
+
+
 async def interactive_mode(budget: BudgetManager):
     """インタラクティブモードで実行"""
     print("=" * 50)
@@ -210,6 +1196,114 @@ async def interactive_mode(budget: BudgetManager):
     budget.print_history()
 
 
+# =============================================================================
+# 並行実行のシミュレーション
+# =============================================================================
+
+def build_hierarchy(policy: str, tenants: int, jobs: int) -> tuple[BudgetManager, list[BudgetManager]]:
+    """global → tenant → job の予算を作成（各階層の合計は親の上限を超える）"""
+    root = BudgetManager(max_cost_usd=5.0, max_turns=3000, policy=policy, cost_per_turn=0.002)
+    leaves = []
+    for t in range(tenants):
+        tenant = root.child(f"tenant-{t}", max_cost_usd=0.8, max_turns=500)
+        for j in range(jobs):
+            leaves.append(tenant.child(f"job-{j}", max_cost_usd=0.25, max_turns=150))
+    return root, leaves
+
+
+def all_nodes(root: BudgetManager) -> list[BudgetManager]:
+    nodes = [root]
+    for child in root.children.values():
+        nodes.extend(all_nodes(child))
+    return nodes
+
+
+async def simulate(queries: int, mode: str, seed: int = 0, tenants: int = 10, jobs: int = 5) -> dict:
+    """
+    queries 件のクエリを同時に実行したときの予算の使われ方を計測
+
+    mode:
+        naive : can_continue() を確認して実行し、完了後に check_budget()（従来の方法）
+        reject / wait : reserve() で予約してから実行
+    各クエリは 1〜20 ターン必要で、1ターンあたり 0.001〜0.002 USD、1ms かかるとします。
+    """
+    rng = random.Random(seed)
+    root, leaves = build_hierarchy("wait" if mode == "wait" else "reject", tenants, jobs)
+    nodes = all_nodes(root)
+    stats = {"completed": 0, "rejected": 0, "violations": 0}
+
+    def check_invariants():
+        # 使用済み + 予約中 が上限を超えた階層がないか
+        for node in nodes:
+            if (node.total_turns + node.reserved_turns > node.max_turns
+                    or node.total_cost + node.reserved_cost > node.max_cost_usd + BudgetManager.EPSILON):
+                stats["violations"] += 1
+
+    async def run(job: BudgetManager, needed: int, rate: float):
+        if mode == "naive":
+            if not job.can_continue():
+                stats["rejected"] += 1
+                return
+            await asyncio.sleep(needed * 0.001)
+            job.check_budget(needed * rate, needed)
+            stats["completed"] += 1
+            check_invariants()
+            return
+
+        try:
+            reservation = await job.reserve(20, min_turns=1)
+        except BudgetExceededError:
+            stats["rejected"] += 1
+            return
+        check_invariants()
+        async with reservation:
+            turns = min(needed, reservation.turns)
+            await asyncio.sleep(turns * 0.001)
+            reservation.commit(turns * rate, turns)
+        stats["completed"] += 1
+        check_invariants()
+
+    tasks = [
+        run(rng.choice(leaves), rng.randint(1, 20), rng.uniform(0.001, 0.002))
+        for _ in range(queries)
+    ]
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    over = [node for node in nodes if node.total_cost > node.max_cost_usd + BudgetManager.EPSILON
+            or node.total_turns > node.max_turns]
+    return {
+        **stats,
+        "turns": root.total_turns,
+        "cost": root.total_cost,
+        "max_turns": root.max_turns,
+        "max_cost": root.max_cost_usd,
+        "over_budget_nodes": len(over),
+        "leaked": root.reserved_turns,
+        "elapsed": elapsed,
+    }
+
+
+async def run_simulation(queries: int):
+    """従来の方法と予約方式を比較"""
+    print("=" * 60)
+    print(f"並行実行シミュレーション: {queries}クエリを同時に実行")
+    print("予算: global $5.00/3000ターン → tenant×10 $0.80/500ターン → job×5 $0.25/150ターン")
+    print("=" * 60)
+    print(f"\n{'方式':<8} {'完了':>6} {'拒否':>6} {'ターン':>11} {'コスト($)':>13} {'超過':>5} {'違反':>6} {'予約残':>6} {'時間(s)':>8}")
+    print("-" * 78)
+    for mode in ["naive", "reject", "wait"]:
+        r = await simulate(queries, mode)
+        print(
+            f"{mode:<8} {r['completed']:>6} {r['rejected']:>6} {r['turns']:>5}/{r['max_turns']:<5}"
+            f" {r['cost']:>6.3f}/{r['max_cost']:<6.2f} {r['over_budget_nodes']:>5} {r['violations']:>6}"
+            f" {r['leaked']:>6} {r['elapsed']:>8.2f}"
+        )
+    print("-" * 78)
+    print("超過: 上限を超えた予算の数, 違反: 使用済み+予約中が上限を超えた回数, 予約残: 精算されなかった予約ターン")
+
+
 def parse_args() -> argparse.Namespace:
     """コマンドライン引数をパース"""
     parser = argparse.ArgumentParser(
@@ -243,15 +1337,113 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="インタラクティブモードで実行"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "-j", "--concurrency",
+        type=int,
+        default=1,
+        help="同時に実行するクエリ数 (default: 1)"
+    )
+    parser.add_argument(
+        "--as-completed",
+        action="store_true",
+        help="結果をプロンプトの順ではなく完了した順に表示"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="1クエリあたりのタイムアウト (秒)"
+    )
+    parser.add_argument(
+        "--bench-batch",
+        action="store_true",
+        help="スタンドイン CLI で同時実行数ごとのスループットを計測"
+    )
+    parser.add_argument(
+        "--concurrency-levels",
+        type=int,
+        nargs="+",
+        default=[1, 8, 32, 128],
+        help="--bench-batch の同時実行数 (default: 1 8 32 128)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=128,
+        help="--bench-batch のクエリ数 (default: 128)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="--bench-batch / --bench-cap に使う CLI のパス"
+    )
+    parser.add_argument(
+        "--bench-cap",
+        action="store_true",
+        help="スタンドイン CLI で実行中のコスト上限を計測"
+    )
+    parser.add_argument(
+        "--allocate",
+        action="store_true",
+        help="推定ターン数と --values から各クエリのターン数を配分"
+    )
+    parser.add_argument(
+        "--values",
+        type=float,
+        nargs="+",
+        help="--prompts の各プロンプトの価値（優先度）"
+    )
+    parser.add_argument(
+        "--bench-allocate",
+        action="store_true",
+        help="API を呼ばずにターン配分の戦略を比較"
+    )
+    parser.add_argument(
+        "--budget-ratios",
+        type=float,
+        nargs="+",
+        default=[0.3, 0.5, 0.8],
+        help="--bench-allocate の予算（必要なターン数の合計に対する割合）(default: 0.3 0.5 0.8)"
+    )
+    parser.add_argument(
+        "--simulate",
+        type=int,
+        nargs="?",
+        const=1000,
+        help="API を呼ばずに N 件の並行クエリで予算管理を検証 (default: 1000)"
+    )
+    parser.add_argument(
+        "--policy",
+        choices=["reject", "wait"],
+        default="reject",
+        help="予約できないときの動作 (default: reject)"
+    )
+    args = parser.parse_args()
+    if args.values is not None and len(args.values) != len(args.prompts or []):
+        parser.error(f"--values は --prompts と同じ数だけ指定してください ({len(args.values)} 件 / {len(args.prompts or [])} 件)")
+    return args
 
 
 async def main():
     args = parse_args()
 
+    if args.simulate:
+        await run_simulation(args.simulate)
+        return
+    if args.bench_batch:
+        await benchmark_batch(args)
+        return
+    if args.bench_cap:
+        await benchmark_cost_cap(args)
+        return
+    if args.bench_allocate:
+        benchmark_allocation(args)
+        return
+
     budget = BudgetManager(
         max_cost_usd=args.max_cost,
-        max_turns=args.max_turns
+        max_turns=args.max_turns,
+        policy=args.policy
     )
 
     if args.interactive:
@@ -260,7 +1452,12 @@ async def main():
         await run_multiple_queries(
             args.prompts,
             budget,
-            args.turns_per_query
+            args.turns_per_query,
+            concurrency=args.concurrency,
+            ordered=not args.as_completed,
+            timeout=args.timeout,
+            values=args.values,
+            allocate=args.allocate
         )
     else:
         # デフォルトの実行
@@ -272,7 +1469,10 @@ async def main():
         await run_multiple_queries(
             default_prompts,
             budget,
-            args.turns_per_query
+            args.turns_per_query,
+            concurrency=args.concurrency,
+            ordered=not args.as_completed,
+            timeout=args.timeout
         )
 
 
@@ -5,19 +5,66 @@ Usage:
     python 04_adaptive.py --mode estimate --prompt "全ファイルを分析してリファクタリングして"
     python 04_adaptive.py -m continue --prompt "大規模なコード分析を実行"
     python 04_adaptive.py -m progressive --prompt "プロジェクトを調査して"
+    python 04_adaptive.py -m continue --fresh --prompt "大規模なコード分析を実行"
+    python 04_adaptive.py -m train --history runs.jsonl --model turn_estimator.npz
+    python 04_adaptive.py -m estimate --model turn_estimator.npz --explain --prompt "src/を分析して"
+    python 04_adaptive.py -m evaluate
+    python 04_adaptive.py -m bench-match --table-sizes 10 100 1000 10000
+    python 04_adaptive.py -m bench-continue --task-turns 24
+    python 04_adaptive.py -m progressive --fresh --checkpoint progress.json --prompt "プロジェクトを調査して"
+    python 04_adaptive.py -m bench-checkpoint --task-turns 30
+    python 04_adaptive.py -m evaluate-completion
+    python 04_adaptive.py -m bench-completion --task-turns 12 --initial-turns 6
 
 Available modes:
     estimate    : プロンプトからターン数を推定して実行
     continue    : 必要に応じてターンを継続
     progressive : 段階的にターン数を増やして実行
+    train       : 実行履歴からターン数の推定モデルを学習
+    evaluate    : キーワード表と学習モデルの推定精度を比較
+    bench-match : キーワード検索の速度を表の大きさごとに比較
+    bench-continue : 毎回新規の query() と継続セッションのターン数・コストを比較
+    bench-checkpoint : チェックポイントによる試行ごとの節約と異常終了からの再開を計測
+    evaluate-completion : 完了の検出の適合率・再現率と節約ターンを記録したセッションで評価
+    bench-completion : 完了の検出による中断の効果をスタンドイン CLI で計測
 
 このスクリプトは、タスクの複雑さに応じてターン数を動的に調整します。
 """
 import argparse
 import asyncio
+import contextlib
+import dataclasses
+import io
+import json
+import math
+import os
+import random
 import re
-from typing import Optional
-from claude_agent_sdk import ClaudeAgentOptions, query, ResultMessage, AssistantMessage, TextBlock
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+from claude_agent_sdk import (
+    ClaudeAgentOptions,
+    ClaudeSDKClient,
+    HookMatcher,
+    query,
+    ResultMessage,
+    AssistantMessage,
+    SystemMessage,
+    StreamEvent,
+    UserMessage,
+    TextBlock,
+    ToolUseBlock,
+    ToolResultBlock,
+)
+
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[3] / "test" / "fake_claude_cli.py"
 
 
 class TurnEstimator:
@@ -69,73 +116,424 @@ class TurnEstimator:
         "ざっくり": 0.5,
     }
 
-    def estimate(self, prompt: str) -> int:
-        """プロンプトからターン数を推定"""
-        base_turns = 5
+    # 表の項目数 (キーワード + 修飾語) がこれ以上なら Aho-Corasick で検索する
+    # （少ない表では `in` を繰り返す方が速い。bench-match で計測）
+    MATCHER_THRESHOLD = 64
 
-        # キーワードマッチング
-        for keyword, turns in self.KEYWORD_TURNS.items():
-            if keyword in prompt:
-                base_turns = max(base_turns, turns)
+    @classmethod
+    def matcher(cls) -> "KeywordMatcher":
+        """
+        キーワード表と修飾語表をまとめてコンパイル（クラスごとに1回）
 
-        # 修飾語による調整
-        multiplier = 1.0
-        for modifier, mult in self.MODIFIER_MULTIPLIERS.items():
-            if modifier in prompt:
-                multiplier = mult
-                break
+        表を差し替えたり、キーワードを追加・削除したりすると自動で再コンパイルします。
+        既存のキーワードの値だけを書き換えた場合は invalidate_matcher() を呼んでください
+        （推定のたびに表全体を比較すると、大きな表では検索より遅くなるため）。
+        """
+        # 表そのものを保持して is で比べる（id() は解放後に再利用されるため）
+        tables = (cls.KEYWORD_TURNS, cls.MODIFIER_MULTIPLIERS)
+        sizes = tuple(len(table) for table in tables)
+        cached = cls.__dict__.get("_matcher_tables")
+        if (
+            cls.__dict__.get("_matcher") is None
+            or cached is None
+            or any(a is not b for a, b in zip(cached[0], tables))
+            or cached[1] != sizes
+        ):
+            cls._matcher = KeywordMatcher(
+                [(keyword, (False, turns)) for keyword, turns in cls.KEYWORD_TURNS.items()]
+                + [(modifier, (True, mult)) for modifier, mult in cls.MODIFIER_MULTIPLIERS.items()]
+            )
+            cls._matcher_tables = (tables, sizes)
+        return cls._matcher
+
+    @classmethod
+    def invalidate_matcher(cls):
+        """コンパイル済みの検索を破棄し、次の推定で表から作り直す"""
+        cls._matcher = None
+
+    def match(self, prompt: str) -> tuple[list, list]:
+        """(マッチしたキーワード, マッチした修飾語) を表の順で返す"""
+        if len(self.KEYWORD_TURNS) + len(self.MODIFIER_MULTIPLIERS) < self.MATCHER_THRESHOLD:
+            return (
+                [(keyword, turns) for keyword, turns in self.KEYWORD_TURNS.items() if keyword in prompt],
+                [(modifier, mult) for modifier, mult in self.MODIFIER_MULTIPLIERS.items() if modifier in prompt],
+            )
+
+        # 大きな表はプロンプトを1回だけ走査する
+        matched_keywords = []
+        matched_modifiers = []
+        for pattern, (is_modifier, value) in self.matcher().find(prompt):
+            if is_modifier:
+                matched_modifiers.append((pattern, value))
+            else:
+                matched_keywords.append((pattern, value))
+        return matched_keywords, matched_modifiers
+
+    @staticmethod
+    def estimate_from(matched_keywords: list, matched_modifiers: list) -> int:
+        """マッチ結果からターン数を推定"""
+        base_turns = max([5] + [turns for _, turns in matched_keywords])
+
+        # 修飾語は表で先に定義されたものを使う
+        multiplier = matched_modifiers[0][1] if matched_modifiers else 1.0
 
         estimated = int(base_turns * multiplier)
 
         # 上限と下限
         return max(3, min(100, estimated))
 
+    def estimate(self, prompt: str) -> int:
+        """プロンプトからターン数を推定"""
+        return self.estimate_from(*self.match(prompt))
+
     def explain(self, prompt: str) -> dict:
         """推定の根拠を説明"""
-        matched_keywords = []
-        for keyword in self.KEYWORD_TURNS:
-            if keyword in prompt:
-                matched_keywords.append((keyword, self.KEYWORD_TURNS[keyword]))
-
-        matched_modifiers = []
-        for modifier in self.MODIFIER_MULTIPLIERS:
-            if modifier in prompt:
-                matched_modifiers.append((modifier, self.MODIFIER_MULTIPLIERS[modifier]))
+        matched_keywords, matched_modifiers = self.match(prompt)
 
         return {
-            "estimated_turns": self.estimate(prompt),
+            "estimated_turns": self.estimate_from(matched_keywords, matched_modifiers),
             "matched_keywords": matched_keywords,
             "matched_modifiers": matched_modifiers,
         }
 
+    def estimate_batch(self, prompts) -> list[dict]:
+        """
+        複数のプロンプトを推定
+
+        各プロンプトの検索は1回だけ行い、推定値と根拠をまとめて返します。
+        """
+        return [self.explain(prompt) for prompt in prompts]
+
+
+class KeywordMatcher:
+    """
+    複数のキーワードを1回の走査で検索する Aho-Corasick オートマトン
+
+    `keyword in prompt` をキーワードの数だけ繰り返す代わりに、
+    プロンプトの長さに比例した時間で全キーワードを検索します。
+    """
+
+    def __init__(self, patterns: list[tuple[str, object]]):
+        self.patterns = patterns
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail = [0]
+        self.output: list[tuple[int, ...]] = [()]
+
+        # トライ木を構築
+        for index, (pattern, _) in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                child = self.goto[node].get(char)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto[node][char] = child
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                node = child
+            self.output[node] += (index,)
+
+        # 幅優先で失敗遷移を設定
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                target = self.goto[state].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                self.output[child] += self.output[self.fail[child]]
+
+    def find(self, text: str) -> list[tuple[str, object]]:
+        """text に含まれるパターンを登録順に返す（重複なし）"""
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return [self.patterns[index] for index in sorted(found)]
+
+
+class LearnedTurnEstimator(TurnEstimator):
+    """
+    実行履歴から学習するターン数推定
+
+    プロンプトのキーワード・修飾語・長さ、許可したツール、作業ディレクトリの
+    ファイル数を特徴量として、log(ターン数) をリッジ回帰で推定します。
+    正規方程式の行列 (X^T X + λI) と X^T y を保持するため、ResultMessage を
+    受け取るたびに1件ずつ更新できます。
+    推定値には直近の残差の quantile 分の余裕を加え、実際のターン数が
+    推定値以下に収まる割合が quantile になるようにします。
+    """
 
-async def adaptive_query(prompt: str, explain: bool = False):
+    TOOLS = ["Read", "Write", "Edit", "Bash", "Glob", "Grep", "WebFetch", "WebSearch"]
+
+    # ターン上限に達した実行は実際より少なく記録されるため、この倍率で補正する
+    CENSORED_FACTOR = 1.5
+
+    def __init__(
+        self,
+        quantile: float = 0.9,
+        ridge: float = 1.0,
+        min_samples: int = 30,
+        window: int = 500,
+        max_turns: int = 100
+    ):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.max_turns = max_turns
+        self.feature_names = (
+            ["bias", "log_prompt_chars", "log_cwd_files"]
+            + [f"kw:{keyword}" for keyword in self.KEYWORD_TURNS]
+            + [f"mod:{modifier}" for modifier in self.MODIFIER_MULTIPLIERS]
+            + [f"tool:{tool}" for tool in self.TOOLS]
+        )
+        self.feature_index = {name: i for i, name in enumerate(self.feature_names)}
+        size = len(self.feature_names)
+        self.xtx = np.eye(size) * ridge
+        self.xtx[0, 0] = 1e-6  # 切片には正則化をかけない
+        self.xty = np.zeros(size)
+        self.weights = np.zeros(size)
+        self.samples = 0
+        self.margin = 0.0
+        self.recent: deque[tuple[np.ndarray, float]] = deque(maxlen=window)
+
+        # 学習前に推定した値と実際の値の比較（キャリブレーション）
+        self.evaluated = 0
+        self.covered = 0
+        self.abs_error = 0.0
+        self.headroom = 0.0
+
+    @property
+    def trained(self) -> bool:
+        return self.samples >= self.min_samples
+
+    def features(
+        self,
+        prompt: str,
+        allowed_tools: Optional[list[str]] = None,
+        cwd_files: int = 0,
+        matches: Optional[tuple[list, list]] = None
+    ) -> np.ndarray:
+        matched_keywords, matched_modifiers = matches or self.match(prompt)
+        x = np.zeros(len(self.feature_names))
+        x[:3] = 1.0, math.log1p(len(prompt)), math.log1p(cwd_files)
+        for keyword, _ in matched_keywords:
+            x[self.feature_index[f"kw:{keyword}"]] = 1.0
+        for modifier, _ in matched_modifiers:
+            x[self.feature_index[f"mod:{modifier}"]] = 1.0
+        for tool in allowed_tools or []:
+            if f"tool:{tool}" in self.feature_index:
+                x[self.feature_index[f"tool:{tool}"]] = 1.0
+        return x
+
+    def _predict(self, x: np.ndarray) -> int:
+        estimated = math.ceil(math.exp(float(x @ self.weights) + self.margin))
+        return max(1, min(self.max_turns, estimated))
+
+    def estimate(
+        self,
+        prompt: str,
+        allowed_tools: Optional[list[str]] = None,
+        cwd_files: int = 0
+    ) -> int:
+        """プロンプトからターン数を推定（学習前はキーワード表を使う）"""
+        matches = self.match(prompt)
+        if not self.trained:
+            return self.estimate_from(*matches)
+        return self._predict(self.features(prompt, allowed_tools, cwd_files, matches))
+
+    def update(
+        self,
+        prompt: str,
+        num_turns: int,
+        allowed_tools: Optional[list[str]] = None,
+        cwd_files: int = 0,
+        censored: bool = False
+    ):
+        """実際のターン数を1件学習"""
+        x = self.features(prompt, allowed_tools, cwd_files)
+        if self.trained:
+            estimated = self._predict(x)
+            self.evaluated += 1
+            self.covered += num_turns <= estimated
+            self.abs_error += abs(estimated - num_turns)
+            self.headroom += max(0, estimated - num_turns)
+
+        y = math.log(max(1, num_turns) * (self.CENSORED_FACTOR if censored else 1.0))
+        self.xtx += np.outer(x, x)
+        self.xty += x * y
+        self.samples += 1
+        self.recent.append((x, y))
+        self._solve()
+
+    def _solve(self):
+        """重みと、直近の残差から推定値に加える余裕を更新"""
+        self.weights = np.linalg.solve(self.xtx, self.xty)
+        if self.recent:
+            xs = np.array([item[0] for item in self.recent])
+            ys = np.array([item[1] for item in self.recent])
+            self.margin = max(0.0, float(np.quantile(ys - xs @ self.weights, self.quantile)))
+
+    def observe(
+        self,
+        prompt: str,
+        result: ResultMessage,
+        allowed_tools: Optional[list[str]] = None,
+        cwd_files: int = 0
+    ):
+        """ResultMessage から学習"""
+        self.update(
+            prompt,
+            result.num_turns,
+            allowed_tools,
+            cwd_files,
+            censored=result.subtype == "error_max_turns"
+        )
+
+    def fit(self, records) -> "LearnedTurnEstimator":
+        """
+        実行履歴から学習
+
+        records は prompt / num_turns を持つ辞書（05_report.py の実行履歴形式）
+        """
+        for record in records:
+            if record.get("prompt") and record.get("num_turns"):
+                self.update(
+                    record["prompt"],
+                    record["num_turns"],
+                    record.get("allowed_tools"),
+                    record.get("cwd_files") or 0,
+                    censored=record.get("subtype") == "error_max_turns"
+                )
+        return self
+
+    def calibration(self) -> dict:
+        """学習前に推定した値と実際の値の比較"""
+        n = max(1, self.evaluated)
+        coverage = self.covered / n
+        return {
+            "samples": self.samples,
+            "evaluated": self.evaluated,
+            "target_coverage": self.quantile,
+            "coverage": coverage,
+            "calibration_error": abs(coverage - self.quantile),
+            "mean_abs_error": self.abs_error / n,
+            "mean_headroom": self.headroom / n,
+        }
+
+    def explain(
+        self,
+        prompt: str,
+        allowed_tools: Optional[list[str]] = None,
+        cwd_files: int = 0
+    ) -> dict:
+        """推定の根拠を説明（寄与の大きい特徴量を含む）"""
+        explanation = super().explain(prompt)
+        explanation["source"] = "learned" if self.trained else "keywords"
+        if self.trained:
+            matches = (explanation["matched_keywords"], explanation["matched_modifiers"])
+            x = self.features(prompt, allowed_tools, cwd_files, matches)
+            explanation["estimated_turns"] = self._predict(x)
+            contributions = [
+                (name, math.exp(value))
+                for name, value in zip(self.feature_names[1:], (x * self.weights)[1:])
+                if value != 0
+            ]
+            contributions.sort(key=lambda item: -abs(math.log(item[1])))
+            explanation["base_turns"] = math.exp(self.weights[0])
+            explanation["contributions"] = contributions
+            explanation["margin"] = math.exp(self.margin)
+        return explanation
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            xtx=self.xtx,
+            xty=self.xty,
+            samples=self.samples,
+            recent_x=np.array([item[0] for item in self.recent]),
+            recent_y=np.array([item[1] for item in self.recent]),
+            stats=np.array([self.evaluated, self.covered, self.abs_error, self.headroom]),
+            feature_names=np.array(self.feature_names),
+        )
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "LearnedTurnEstimator":
+        estimator = cls(**kwargs)
+        with np.load(path) as data:
+            if list(data["feature_names"]) != estimator.feature_names:
+                raise ValueError("特徴量が変更されています。実行履歴から学習し直してください")
+            estimator.xtx = data["xtx"]
+            estimator.xty = data["xty"]
+            estimator.samples = int(data["samples"])
+            estimator.recent.extend(zip(data["recent_x"], data["recent_y"].tolist()))
+            evaluated, covered, abs_error, headroom = data["stats"].tolist()
+            estimator.evaluated, estimator.covered = int(evaluated), int(covered)
+            estimator.abs_error, estimator.headroom = abs_error, headroom
+        estimator._solve()
+        return estimator
+
+
+def count_files(path: str = ".", limit: int = 10000) -> int:
+    """作業ディレクトリのファイル数（limit で打ち切り）"""
+    count = 0
+    for _, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        count += len(files)
+        if count >= limit:
+            return limit
+    return count
+
+
+async def adaptive_query(
+    prompt: str,
+    explain: bool = False,
+    estimator: Optional[TurnEstimator] = None,
+    model_path: Optional[str] = None
+):
     """推定ターン数で実行"""
-    estimator = TurnEstimator()
-    estimated = estimator.estimate(prompt)
+    estimator = estimator or TurnEstimator()
+    allowed_tools = ["Read", "Write", "Edit", "Glob", "Grep"]
+    learned = isinstance(estimator, LearnedTurnEstimator)
+    context = {"allowed_tools": allowed_tools, "cwd_files": count_files()} if learned else {}
+    estimated = estimator.estimate(prompt, **context)
 
     if explain:
-        explanation = estimator.explain(prompt)
+        explanation = estimator.explain(prompt, **context)
         print("\n📊 ターン数推定")
         print("-" * 40)
         print(f"推定ターン数: {explanation['estimated_turns']}")
 
-        if explanation['matched_keywords']:
-            print("マッチしたキーワード:")
-            for kw, turns in explanation['matched_keywords']:
-                print(f"  - '{kw}' -> {turns}ターン")
+        if explanation.get('source') == "learned":
+            # 学習済みモデルでは、各特徴量がターン数を何倍にしたかを表示
+            print(f"基準: {explanation['base_turns']:.1f}ターン, 余裕: x{explanation['margin']:.2f}")
+            print("寄与した特徴量:")
+            for name, factor in explanation['contributions'][:8]:
+                print(f"  - {name} -> x{factor:.2f}")
+        else:
+            if explanation['matched_keywords']:
+                print("マッチしたキーワード:")
+                for kw, turns in explanation['matched_keywords']:
+                    print(f"  - '{kw}' -> {turns}ターン")
 
-        if explanation['matched_modifiers']:
-            print("マッチした修飾語:")
-            for mod, mult in explanation['matched_modifiers']:
-                print(f"  - '{mod}' -> x{mult}")
+            if explanation['matched_modifiers']:
+                print("マッチした修飾語:")
+                for mod, mult in explanation['matched_modifiers']:
+                    print(f"  - '{mod}' -> x{mult}")
         print("-" * 40)
 
     print(f"\n🚀 実行: max_turns={estimated}")
 
     options = ClaudeAgentOptions(
         max_turns=estimated,
-        allowed_tools=["Read", "Write", "Edit", "Glob", "Grep"]
+        allowed_tools=allowed_tools
     )
 
     async for message in query(prompt=prompt, options=options):
@@ -148,13 +546,532 @@ async def adaptive_query(prompt: str, explain: bool = False):
             print(f"\n✅ 完了: {message.num_turns}/{estimated}ターン使用")
             print(f"💰 コスト: ${message.total_cost_usd:.4f}")
 
+            if learned:
+                # 実際のターン数を学習してモデルを保存
+                estimator.observe(prompt, message, **context)
+                if model_path:
+                    estimator.save(model_path)
+
+
+CONTINUE_PROMPT = "続きを実行してください。前回の作業を継続し、完了させてください。"
+
+# タスク完了を表す語句（CompletionDetector は引用の外にあるものだけを数える）
+COMPLETION_INDICATORS = [
+    "完了しました",
+    "終了しました",
+    "以上です",
+    "完了です",
+]
+
+# 作業を続ける意図を表す語句
+CONTINUATION_INDICATORS = ["次に", "続いて", "これから", "引き続き", "残りの", "まだ"]
+
+# 結果を確かめたことを表す語句
+VERIFICATION_INDICATORS = ["確認しました", "通りました", "成功しました", "検証しました"]
+
+# 構造化された完了の印（システムプロンプトで、最終報告の最後に書くよう指示する）
+COMPLETION_MARKER = "[[TASK_COMPLETE]]"
+COMPLETION_INSTRUCTION = (
+    f"作業がすべて完了したら、最終報告の最後の行に {COMPLETION_MARKER} とだけ書いてください。"
+    "作業の途中では書かないでください。"
+)
+
+QUOTED_TEXT = re.compile(r"```[\s\S]*?```|`[^`\n]*`|「[^」]*」|『[^』]*』|\"[^\"\n]*\"|^>.*$", re.MULTILINE)
+SUMMARY_HEADING = re.compile(r"^#{1,3}\s*(結果|まとめ|変更内容|変更点|修正内容|概要|Summary)", re.MULTILINE)
+PLAN_HEADING = re.compile(r"^#{1,3}\s*(方針|計画|手順|予定|Plan)", re.MULTILINE)
+BULLET_LINE = re.compile(r"^\s*(?:[-*・]|\d+\.)\s+\S", re.MULTILINE)
+SENTENCE_END = re.compile(r"[。！？!?\n]+")
+
+
+@dataclass
+class CompletionSignal:
+    """完了の判定"""
+    turn: int
+    score: float
+    reasons: list[str]
+
+
+class CompletionDetector:
+    """
+    ストリーミングのメッセージから、タスクの完了を判定する
+
+    テキストごとに次の手がかりの重みを合計し、threshold 以上になった時点で完了とみなします。
+    既定の threshold=1.0 では、印があるか、語句・確認・結果の形が揃ったときだけ判定します。
+
+    marker   : 引用の外に COMPLETION_MARKER がある (+1.0)
+    phrase   : 最後の文に COMPLETION_INDICATORS がある (+0.5。途中の文なら +0.2)
+    verified : VERIFICATION_INDICATORS がある (+0.2)
+    summary  : 結果の見出しや3項目以上の箇条書きなど、結果の形をしている (+0.3)
+    clean    : 直前のツール呼び出しがすべて成功し、結果待ちの呼び出しがない (+0.1)
+    continue : 最後の文に CONTINUATION_INDICATORS がある (-0.6)
+    plan     : 方針や手順の見出しがある (-0.6)
+    error    : 直前のツール結果にエラーがある (-0.3)
+
+    引用（「」、`code`、```ブロック```、> の行）の中の語句は数えません。
+    印はストリームイベント（include_partial_messages）の途中でも検出し、
+    モデルがツールを呼ばずに応答を終えた（ResultMessage が success）場合も完了とみなします。
+    feed() はメッセージごとに呼び、初めて完了と判定したときだけ CompletionSignal を返します。
+    """
+
+    WEIGHTS = {"marker": 1.0, "phrase": 0.5, "phrase-early": 0.2, "verified": 0.2, "summary": 0.3,
+               "clean": 0.1, "continue": -0.6, "plan": -0.6, "error": -0.3}
+
+    def __init__(self, threshold: float = 1.0):
+        self.threshold = threshold
+        self.turns = 0
+        self.signal: Optional[CompletionSignal] = None
+        self._message_id: Optional[str] = None
+        self._pending: set[str] = set()
+        self._errors = 0
+        self._partial = ""
+
+    @property
+    def done(self) -> bool:
+        return self.signal is not None
+
+    @staticmethod
+    def strip_quoted(text: str) -> str:
+        """引用・コードを取り除いたテキスト"""
+        return QUOTED_TEXT.sub(" ", text)
+
+    @staticmethod
+    def with_marker(options: ClaudeAgentOptions) -> ClaudeAgentOptions:
+        """システムプロンプトに COMPLETION_INSTRUCTION を追加した options"""
+        system_prompt = options.system_prompt
+        if system_prompt is None:
+            system_prompt = COMPLETION_INSTRUCTION
+        elif isinstance(system_prompt, str):
+            system_prompt = f"{system_prompt}\n\n{COMPLETION_INSTRUCTION}"
+        elif system_prompt.get("type") == "preset":
+            append = system_prompt.get("append")
+            system_prompt = {**system_prompt, "append": f"{append}\n\n{COMPLETION_INSTRUCTION}" if append else COMPLETION_INSTRUCTION}
+        else:
+            return options
+        return dataclasses.replace(options, system_prompt=system_prompt)
+
+    def score(self, text: str) -> tuple[float, list[str]]:
+        """テキストの完了らしさと、その根拠"""
+        plain = self.strip_quoted(text)
+        reasons = []
+        if COMPLETION_MARKER in plain:
+            reasons.append("marker")
+        sentences = [s for s in SENTENCE_END.split(plain.replace(COMPLETION_MARKER, "")) if s.strip()]
+        last = sentences[-1] if sentences else ""
+        if any(ind in last for ind in COMPLETION_INDICATORS):
+            reasons.append("phrase")
+        elif any(ind in plain for ind in COMPLETION_INDICATORS):
+            reasons.append("phrase-early")
+        if any(ind in plain for ind in VERIFICATION_INDICATORS):
+            reasons.append("verified")
+        if PLAN_HEADING.search(plain):
+            reasons.append("plan")
+        elif SUMMARY_HEADING.search(plain) or len(BULLET_LINE.findall(plain)) >= 3:
+            reasons.append("summary")
+        if any(ind in last for ind in CONTINUATION_INDICATORS):
+            reasons.append("continue")
+        if self._errors:
+            reasons.append("error")
+        elif not self._pending:
+            reasons.append("clean")
+        return round(sum(self.WEIGHTS[r] for r in reasons), 2), reasons
+
+    def _fire(self, score: float, reasons: list[str], turn: Optional[int] = None) -> Optional[CompletionSignal]:
+        if self.signal is None and score >= self.threshold:
+            self.signal = CompletionSignal(turn or self.turns, score, reasons)
+            return self.signal
+        return None
+
+    def on_text(self, text: str) -> Optional[CompletionSignal]:
+        return self._fire(*self.score(text))
+
+    def on_tool_use(self, tool_use_id: str):
+        # 新しい呼び出しが始まったら、エラーはその結果だけで数え直す
+        if not self._pending:
+            self._errors = 0
+        self._pending.add(tool_use_id)
+
+    def on_tool_result(self, tool_use_id: str, is_error: bool):
+        if tool_use_id in self._pending:
+            self._pending.discard(tool_use_id)
+            self._errors += int(is_error)
+
+    def on_result(self, subtype: str) -> Optional[CompletionSignal]:
+        """応答の終わり。ツールを呼ばずに止まったなら完了"""
+        stopped = not self._pending
+        self._pending.clear()
+        if subtype == "success" and stopped:
+            return self._fire(max(self.threshold, 1.0), ["stopped"])
+        return None
+
+    def feed(self, message) -> Optional[CompletionSignal]:
+        """メッセージを1つ受け取り、初めて完了と判定したら CompletionSignal を返す"""
+        if isinstance(message, AssistantMessage):
+            message_id = getattr(message, "message_id", None)
+            if message_id is None or message_id != self._message_id:
+                self.turns += 1
+                self._message_id = message_id
+                self._partial = ""
+            signal = None
+            for block in message.content:
+                if isinstance(block, TextBlock):
+                    signal = signal or self.on_text(block.text)
+                elif isinstance(block, ToolUseBlock):
+                    self.on_tool_use(block.id)
+            return signal
+        if isinstance(message, UserMessage) and isinstance(message.content, list):
+            for block in message.content:
+                if isinstance(block, ToolResultBlock):
+                    self.on_tool_result(block.tool_use_id, bool(block.is_error))
+        elif isinstance(message, StreamEvent):
+            event = message.event
+            delta = event.get("delta") or {}
+            if event.get("type") == "message_start":
+                self._partial = ""
+            elif delta.get("type") == "text_delta":
+                self._partial += delta.get("text", "")
+                # ストリームイベントは、そのターンの AssistantMessage より先に届く
+                if COMPLETION_MARKER in self.strip_quoted(self._partial):
+                    return self._fire(1.0, ["marker"], self.turns + 1)
+        elif isinstance(message, ResultMessage):
+            return self.on_result(message.subtype)
+        return None
+
+
+class ContinuedSession:
+    """
+    1つの ClaudeSDKClient セッションで反復を続ける
+
+    毎回新しい query() を起動するとコンテキストが失われ、読んだファイルを
+    読み直すことになります。同じセッションに続きのプロンプトを送れば、
+    前回止まったところから再開できます。
+    CLI の max_turns は接続時に固定されるため、反復ごとのターン数の上限は
+    AssistantMessage を数えて interrupt() で打ち切ります。
+    上限で打ち切った反復の ResultMessage は、CLI の max_turns と同じく
+    subtype を "error_max_turns" にして返します（中断後の subtype や num_turns は
+    CLI によって異なり、上限に達したかの判定に使えないため）。
+    stop を渡すと、メッセージを1つ返すごとに呼び、True なら上限の前でも打ち切ります。
+    """
+
+    def __init__(self, options: ClaudeAgentOptions):
+        self.client = ClaudeSDKClient(options)
+        self.session_id: Optional[str] = None
+
+    async def __aenter__(self) -> "ContinuedSession":
+        await self.client.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.disconnect()
+
+    async def run(self, prompt: str, max_turns: int, stop: Optional[Callable[[], bool]] = None):
+        """プロンプトを送り、max_turns ターンで打ち切りながら応答を返す"""
+        await self.client.query(prompt)
+        turns = 0
+        message_id = None
+        interrupted = capped = False
+        async for message in self.client.receive_response():
+            if isinstance(message, AssistantMessage):
+                # 1つの応答のテキストとツール呼び出しは同じ message_id で別々に届く
+                if message.message_id is None or message.message_id != message_id:
+                    turns += 1
+                    message_id = message.message_id
+                if turns >= max_turns and not interrupted:
+                    interrupted = capped = True
+                    await self.client.interrupt()
+            elif isinstance(message, ResultMessage):
+                self.session_id = message.session_id
+                if capped:
+                    message = dataclasses.replace(message, subtype="error_max_turns", is_error=True)
+            yield message
+            if stop is not None and not interrupted and not isinstance(message, ResultMessage) and stop():
+                interrupted = True
+                await self.client.interrupt()
+
+
+async def iterate(
+    prompt: str,
+    max_turns: int,
+    options: ClaudeAgentOptions,
+    session: Optional[ContinuedSession],
+    stop: Optional[Callable[[], bool]] = None
+):
+    """1回の反復を実行（session がなければ新しい query()。stop を渡すと新しいセッション）"""
+    if session is not None:
+        async for message in session.run(prompt, max_turns, stop):
+            yield message
+    elif stop is not None:
+        # query() は途中で interrupt() できないので、反復ごとに使い捨てのセッションを開く
+        async with ContinuedSession(dataclasses.replace(options, max_turns=max_turns)) as fresh_session:
+            async for message in fresh_session.run(prompt, max_turns, stop):
+                yield message
+    else:
+        fresh_options = dataclasses.replace(options, max_turns=max_turns)
+        async for message in query(prompt=prompt, options=fresh_options):
+            yield message
+
+
+class ToolCheckpoint:
+    """
+    progressive_execution のチェックポイント
+
+    完了したツール呼び出しと結果を「ツール名 + 正規化した入力 + 参照ファイルの mtime」
+    をキーに記録し、後の試行に2つの方法で提供します。
+
+    - primer(): 続きのプロンプトに完了済みの呼び出しと結果を添える（ターンの節約）
+    - PreToolUse フック: それでも同じ呼び出しが来たら実行せずに記録済みの結果を返す
+
+    記録はツール結果ごとに JSON ファイルへ書き出すため、プロセスが異常終了しても
+    同じファイルを指定して progressive_execution を再実行すれば続きから再開できます。
+    ファイルを変更するツール (MUTATING_TOOLS) が成功したら記録をすべて破棄し、
+    外部での変更は参照ファイルの mtime (options.cwd 基準) の変化で検出するので、古い結果は使われません。
+    """
+
+    # 結果を再利用しても副作用のないツール
+    CACHEABLE_TOOLS = {"Read", "Glob", "Grep", "LS", "WebFetch", "WebSearch"}
+    # 成功したら記録済みの結果をすべて無効にするツール
+    # （ディレクトリの mtime は中のファイルの編集では変わらず、Grep/Glob はパスを持たないこともあるため）
+    MUTATING_TOOLS = {"Edit", "Write", "MultiEdit", "NotebookEdit", "Bash"}
+    # mtime をキーに含める入力のキー
+    PATH_KEYS = ("file_path", "path", "notebook_path")
+
+    def __init__(
+        self,
+        path: Optional[str],
+        prompt: str,
+        cacheable_tools: Optional[set] = None,
+        reuse: bool = True,
+        primer_limit: int = 50,
+        result_chars: int = 2000,
+        cwd: Optional[str] = None
+    ):
+        self.path = Path(path) if path else None
+        # 相対パスの mtime を調べる基準 (default: apply() に渡した options.cwd)
+        self.cwd = cwd
+        self.cacheable_tools = cacheable_tools or self.CACHEABLE_TOOLS
+        self.reuse = reuse
+        self.primer_limit = primer_limit
+        self.result_chars = result_chars
+        self.state = {
+            "prompt": prompt,
+            "current_turns": None,
+            "session_id": None,
+            "completed": False,
+            "total_turns": 0,
+            "total_cost": 0.0,
+            "executed_turns": 0,
+            # 記録済みの呼び出しまでを新しいセッションで最初から実行した場合のターン数
+            "progress_turns": 0,
+            "entries": {},
+            "attempts": [],
+        }
+        self.resumed = False
+        self.hits = 0
+        self._pending: dict[str, tuple[str, dict]] = {}
+        # 試行ごとの計測（ターンは message_id ごとに数える）
+        self._message_id = None
+        self._turns = 0
+        self._known: set = set()
+        self._base_progress = 0
+        self._caught_up_at: Optional[int] = None
+
+        if self.path and self.path.exists():
+            state = json.loads(self.path.read_text())
+            if state.get("prompt") == prompt:
+                state.setdefault("progress_turns", 0)
+                self.state = state
+                self.resumed = True
+
+    @property
+    def entries(self) -> dict:
+        return self.state["entries"]
+
+    @classmethod
+    def normalize(cls, value):
+        """キーの比較に使うため、入力の表記ゆれをそろえる"""
+        if isinstance(value, dict):
+            return {
+                k: os.path.normpath(v) if k in cls.PATH_KEYS and isinstance(v, str) and v else cls.normalize(v)
+                for k, v in sorted(value.items())
+            }
+        if isinstance(value, list):
+            return [cls.normalize(v) for v in value]
+        if isinstance(value, str):
+            return value.strip()
+        return value
+
+    def key(self, tool_name: str, tool_input: dict) -> str:
+        """ツール名 + 正規化した入力 + 参照ファイルの mtime"""
+        normalized = self.normalize(tool_input)
+        mtimes = {}
+        for name in self.PATH_KEYS:
+            if normalized.get(name):
+                try:
+                    mtimes[name] = os.stat(os.path.join(self.cwd or "", normalized[name])).st_mtime_ns
+                except OSError:
+                    mtimes[name] = None
+        return json.dumps([tool_name, normalized, mtimes], ensure_ascii=False, sort_keys=True)
+
+    def record(self, message):
+        """メッセージからツール呼び出しと結果を記録"""
+        if isinstance(message, AssistantMessage):
+            # 1つの応答は同じ message_id の複数のメッセージとして届く
+            if message.message_id is None or message.message_id != self._message_id:
+                self.state["executed_turns"] += 1
+                self._turns += 1
+                self._message_id = message.message_id
+            for block in message.content:
+                if isinstance(block, ToolUseBlock):
+                    self._pending[block.id] = (block.name, block.input)
+                    # 試行の開始時に記録になかった呼び出し = 前回までの続きの作業
+                    if self._caught_up_at is None and self.key(block.name, block.input) not in self._known:
+                        self._caught_up_at = self._turns - 1
+        elif isinstance(message, UserMessage) and isinstance(message.content, list):
+            for block in message.content:
+                if not isinstance(block, ToolResultBlock):
+                    continue
+                call = self._pending.pop(block.tool_use_id, None)
+                if call is None or block.is_error:
+                    continue
+                if call[0] in self.MUTATING_TOOLS:
+                    if self.entries:
+                        self.entries.clear()
+                        self.save()
+                    continue
+                if call[0] not in self.cacheable_tools:
+                    continue
+                content = block.content
+                if isinstance(content, list):
+                    content = "\n".join(
+                        item.get("text", "") for item in content if isinstance(item, dict)
+                    )
+                self.entries[self.key(*call)] = {
+                    "tool": call[0],
+                    "input": call[1],
+                    "result": (content or "")[:self.result_chars],
+                    "attempt": len(self.state["attempts"]) + 1,
+                }
+                # 異常終了しても、ここまでの進み具合を次の試行の比較に使う
+                self.state["progress_turns"] = max(self.state["progress_turns"], self._progress())
+                self.save()
+        elif isinstance(message, SystemMessage) and message.subtype == "init":
+            self.state["session_id"] = message.data.get("session_id") or self.state["session_id"]
+        elif isinstance(message, ResultMessage):
+            self.state["session_id"] = message.session_id
+
+    async def pre_tool_use(self, input_data, tool_use_id, context):
+        """記録済みの呼び出しは実行せずに結果を返す"""
+        if not self.reuse or input_data["tool_name"] not in self.cacheable_tools:
+            return {}
+        entry = self.entries.get(self.key(input_data["tool_name"], input_data["tool_input"]))
+        if entry is None:
+            return {}
+        self.hits += 1
+        return {
+            "hookSpecificOutput": {
+                "hookEventName": "PreToolUse",
+                "permissionDecision": "deny",
+                "permissionDecisionReason": (
+                    "前回の試行で取得済みの結果です。再実行せずにこの結果を使ってください:\n"
+                    + entry["result"]
+                ),
+            }
+        }
+
+    def apply(self, options: ClaudeAgentOptions) -> ClaudeAgentOptions:
+        """options に PreToolUse フックを追加"""
+        self.cwd = self.cwd or (str(options.cwd) if options.cwd else None)
+        hooks = dict(options.hooks or {})
+        hooks["PreToolUse"] = [*hooks.get("PreToolUse", []), HookMatcher(hooks=[self.pre_tool_use])]
+        return dataclasses.replace(options, hooks=hooks)
+
+    def primer(self) -> str:
+        """続きのプロンプトに添える完了済みの呼び出しの一覧"""
+        if not self.reuse or not self.entries or self.primer_limit <= 0:
+            return ""
+        lines = ["以下のツール呼び出しは前回までの試行で完了しています。結果を再利用し、繰り返さないでください。"]
+        for entry in list(self.entries.values())[-self.primer_limit:]:
+            tool_input = json.dumps(entry["input"], ensure_ascii=False)
+            result = entry["result"][:200].replace("\n", " ")
+            lines.append(f"- {entry['tool']} {tool_input} → {result}")
+        return "\n".join(lines)
+
+    def begin_attempt(self, current_turns: int) -> dict:
+        """試行の開始を記録（異常終了したらこの試行からやり直す）"""
+        self.hits = 0
+        self._message_id = None
+        self._turns = 0
+        self._known = set(self.entries)
+        self._base_progress = self.state["progress_turns"]
+        self._caught_up_at = None
+        self.state["current_turns"] = current_turns
+        self.save()
+        return {"max_turns": current_turns, "cached": len(self.entries)}
+
+    def _saved_turns(self) -> int:
+        """前回までの試行が記録済みの呼び出しに使ったターンのうち、この試行が繰り返さなかった数"""
+        caught_up = self._caught_up_at if self._caught_up_at is not None else self._turns
+        return max(0, self._base_progress - caught_up)
+
+    def _progress(self) -> int:
+        """この試行の到達点を、最初から実行した場合のターン数に換算"""
+        return self._saved_turns() + self._turns
+
+    def end_attempt(self, attempt: dict, turns: int, cost: float, primed: bool):
+        """
+        試行の結果を記録
+
+        primer を使った試行の節約ターンは、前回までの試行が記録済みの呼び出しに
+        使ったターン数から、この試行が記録にない呼び出しを始めるまでのターン数を
+        引いて計測します。
+        """
+        saved_turns = self._saved_turns() if primed else 0
+        attempt.update({
+            "turns": turns,
+            "cost": cost,
+            "hits": self.hits,
+            "saved_turns": saved_turns,
+        })
+        self.state["attempts"].append(attempt)
+        self.state["total_turns"] += turns
+        self.state["total_cost"] += cost
+        self.state["progress_turns"] = max(self.state["progress_turns"], saved_turns + self._turns)
+        self.save()
+
+    def finish(self, completed: bool):
+        self.state["completed"] = completed
+        self.save()
+
+    def save(self):
+        """一時ファイルに書いてから置き換える（書き込み中の異常終了に備える）"""
+        if self.path is None:
+            return
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps(self.state, ensure_ascii=False))
+        os.replace(tmp, self.path)
+
 
 async def continue_if_needed(
     prompt: str,
     initial_turns: int = 10,
-    max_total_turns: int = 50
+    max_total_turns: int = 50,
+    fresh: bool = False,
+    options: Optional[ClaudeAgentOptions] = None,
+    early_stop: bool = True,
+    threshold: float = 1.0
 ):
-    """必要に応じてターンを継続"""
+    """
+    必要に応じてターンを継続
+
+    デフォルトでは1つのセッションで続きを実行します。
+    fresh=True では反復ごとに新しいセッションを起動します（従来の動作）。
+    early_stop=True では CompletionDetector が完了と判定した時点でセッションを中断し、
+    完了後の確認やまとめのターンを使いません。False では応答のテキストに
+    COMPLETION_INDICATORS が含まれるかだけを見て、反復の終わりまで続けます（従来の動作）。
+    """
+    options = options or ClaudeAgentOptions(allowed_tools=["Read", "Write", "Edit", "Glob", "Grep"])
+    detector = CompletionDetector(threshold) if early_stop else None
+    if detector:
+        options = CompletionDetector.with_marker(options)
     total_turns = 0
     iteration = 0
     total_cost = 0.0
@@ -164,64 +1081,68 @@ async def continue_if_needed(
     print("=" * 50)
     print(f"初期ターン数: {initial_turns}")
     print(f"最大合計ターン数: {max_total_turns}")
+    print(f"セッション: {'毎回新規' if fresh else '継続'}")
+    print(f"完了の検出: {f'CompletionDetector (閾値 {threshold})' if detector else '語句の部分一致'}")
     print("=" * 50)
 
-    while total_turns < max_total_turns:
-        iteration += 1
-        remaining = max_total_turns - total_turns
+    session = None if fresh else ContinuedSession(dataclasses.replace(options, max_turns=max_total_turns))
+    if session:
+        await session.__aenter__()
 
-        turns_for_this_iteration = min(initial_turns, remaining)
+    try:
+        while total_turns < max_total_turns:
+            iteration += 1
+            remaining = max_total_turns - total_turns
 
-        options = ClaudeAgentOptions(
-            max_turns=turns_for_this_iteration,
-            allowed_tools=["Read", "Write", "Edit", "Glob", "Grep"]
-        )
+            turns_for_this_iteration = min(initial_turns, remaining)
 
-        print(f"\n=== イテレーション {iteration} ===")
-        print(f"このイテレーションのターン数: {turns_for_this_iteration}")
-        print(f"累計ターン: {total_turns}/{max_total_turns}")
+            print(f"\n=== イテレーション {iteration} ===")
+            print(f"このイテレーションのターン数: {turns_for_this_iteration}")
+            print(f"累計ターン: {total_turns}/{max_total_turns}")
 
-        current_prompt = prompt if iteration == 1 else "続きを実行してください。前回の作業を継続し、完了させてください。"
+            current_prompt = prompt if iteration == 1 else CONTINUE_PROMPT
 
-        iteration_turns = 0
-        task_completed = False
+            iteration_turns = 0
+            task_completed = False
 
-        async for message in query(prompt=current_prompt, options=options):
-            if isinstance(message, AssistantMessage):
-                for block in message.content:
-                    if isinstance(block, TextBlock):
-                        text = block.text[:150] + "..." if len(block.text) > 150 else block.text
-                        print(f"📝 {text}")
-
-                        # タスク完了の判定（簡易的な実装）
-                        completion_indicators = [
-                            "完了しました",
-                            "終了しました",
-                            "以上です",
-                            "完了です",
-                        ]
-                        if any(ind in block.text for ind in completion_indicators):
-                            task_completed = True
+            stop = (lambda: detector.done) if detector else None
+            async for message in iterate(current_prompt, turns_for_this_iteration, options, session, stop):
+                if detector and (signal := detector.feed(message)):
+                    task_completed = True
+                    print(f"🏁 完了を検出: {signal.turn}ターン目 (score {signal.score}: {', '.join(signal.reasons)})")
+                if isinstance(message, AssistantMessage):
+                    for block in message.content:
+                        if isinstance(block, TextBlock):
+                            text = block.text[:150] + "..." if len(block.text) > 150 else block.text
+                            print(f"📝 {text}")
 
-            elif isinstance(message, ResultMessage):
-                iteration_turns = message.num_turns
-                total_turns += iteration_turns
-                total_cost += message.total_cost_usd
-
-                print(f"\n--- イテレーション {iteration} 結果 ---")
-                print(f"このイテレーション: {iteration_turns}ターン")
-                print(f"累計: {total_turns}/{max_total_turns}ターン")
-                print(f"累計コスト: ${total_cost:.4f}")
-
-                # タスクが完了したと判断
-                if iteration_turns < turns_for_this_iteration or task_completed:
-                    print("\n✅ タスク完了")
-                    return {
-                        "total_turns": total_turns,
-                        "iterations": iteration,
-                        "total_cost": total_cost,
-                        "completed": True,
-                    }
+                            if not detector and any(ind in block.text for ind in COMPLETION_INDICATORS):
+                                task_completed = True
+
+                elif isinstance(message, ResultMessage):
+                    iteration_turns = message.num_turns
+                    total_turns += iteration_turns
+                    total_cost += message.total_cost_usd
+                    # ターン数の上限で止まらずに終わった = タスク完了
+                    if message.subtype == "success":
+                        task_completed = True
+
+                    print(f"\n--- イテレーション {iteration} 結果 ---")
+                    print(f"このイテレーション: {iteration_turns}ターン")
+                    print(f"累計: {total_turns}/{max_total_turns}ターン")
+                    print(f"累計コスト: ${total_cost:.4f}")
+
+            if task_completed:
+                print("\n✅ タスク完了")
+                return {
+                    "total_turns": total_turns,
+                    "iterations": iteration,
+                    "total_cost": total_cost,
+                    "completed": True,
+                }
+    finally:
+        if session:
+            await session.__aexit__(None, None, None)
 
     print("\n⚠️ 最大ターン数に達しました")
     return {
@@ -236,67 +1157,716 @@ async def progressive_execution(
     prompt: str,
     initial_turns: int = 5,
     max_turns: int = 50,
-    growth_factor: float = 2.0
+    growth_factor: float = 2.0,
+    fresh: bool = False,
+    options: Optional[ClaudeAgentOptions] = None,
+    checkpoint=None
 ):
-    """段階的にターン数を増やして実行"""
+    """
+    段階的にターン数を増やして実行
+
+    デフォルトでは1つのセッションで続きを実行するため、
+    各試行は前回の作業をやり直さずに残りだけを実行します。
+    checkpoint (ファイルパスまたは ToolCheckpoint) を指定すると、完了したツール呼び出しを
+    記録して後の試行に提供し、異常終了した実行を同じファイルから再開できます。
+    """
+    options = options or ClaudeAgentOptions(allowed_tools=["Read", "Write", "Edit", "Glob", "Grep"])
+
     print("=" * 50)
     print("段階的実行モード")
     print("=" * 50)
     print(f"初期ターン数: {initial_turns}")
     print(f"最大ターン数: {max_turns}")
     print(f"増加係数: {growth_factor}")
+    print(f"セッション: {'毎回新規' if fresh else '継続'}")
+    if checkpoint is not None:
+        print(f"チェックポイント: {getattr(checkpoint, 'path', checkpoint)}")
     print("=" * 50)
 
     current_turns = initial_turns
     iteration = 0
     total_cost = 0.0
+    total_turns = 0
 
-    while current_turns <= max_turns:
-        iteration += 1
+    ckpt = checkpoint
+    if isinstance(checkpoint, (str, Path)):
+        ckpt = ToolCheckpoint(checkpoint, prompt)
+    resuming = False
+    if ckpt is not None:
+        options = ckpt.apply(options)
+        if ckpt.resumed:
+            state = ckpt.state
+            if state["completed"]:
+                print("\n✅ チェックポイントの実行は完了済みです")
+                return checkpoint_summary(ckpt, True)
+            resuming = True
+            iteration = len(state["attempts"])
+            current_turns = state["current_turns"] or initial_turns
+            total_turns = state["total_turns"]
+            total_cost = state["total_cost"]
+            print(f"\n🔁 チェックポイントから再開: 試行 {iteration + 1}, 記録済みの呼び出し {len(ckpt.entries)}件")
 
-        options = ClaudeAgentOptions(
-            max_turns=current_turns,
-            allowed_tools=["Read", "Write", "Edit", "Glob", "Grep"]
-        )
+    session = None
+    if not fresh:
+        session_options = dataclasses.replace(options, max_turns=max_turns)
+        if resuming and ckpt.state["session_id"]:
+            session_options = dataclasses.replace(session_options, resume=ckpt.state["session_id"])
+        session = ContinuedSession(session_options)
+        await session.__aenter__()
 
-        print(f"\n=== 試行 {iteration}: max_turns={current_turns} ===")
+    try:
+        while current_turns <= max_turns:
+            iteration += 1
 
-        current_prompt = prompt if iteration == 1 else f"前回は{current_turns // int(growth_factor)}ターンでは足りませんでした。続きを実行してください。"
+            print(f"\n=== 試行 {iteration}: max_turns={current_turns} ===")
 
-        async for message in query(prompt=current_prompt, options=options):
-            if isinstance(message, AssistantMessage):
-                for block in message.content:
-                    if isinstance(block, TextBlock):
-                        print(f"📝 {block.text[:100]}...")
+            # 新しいコンテキストで始まる試行には、完了済みの呼び出しを添える
+            primer = ckpt.primer() if ckpt is not None and (fresh or resuming) else ""
+            if primer:
+                current_prompt = f"{prompt}\n\n{primer}"
+            elif iteration == 1:
+                current_prompt = prompt
+            else:
+                current_prompt = f"前回は{current_turns // int(growth_factor)}ターンでは足りませんでした。続きを実行してください。"
+            resuming = False
+            attempt = ckpt.begin_attempt(current_turns) if ckpt is not None else None
 
-            elif isinstance(message, ResultMessage):
-                total_cost += message.total_cost_usd
-                used_turns = message.num_turns
-
-                print(f"\n結果: {used_turns}/{current_turns}ターン使用")
-                print(f"累計コスト: ${total_cost:.4f}")
-
-                # ターンを使い切らなかった = タスク完了
-                if used_turns < current_turns:
-                    print("\n✅ タスク完了")
-                    return {
-                        "turns_used": used_turns,
-                        "iterations": iteration,
-                        "total_cost": total_cost,
-                    }
+            used_turns = 0
+            attempt_cost = 0.0
+            completed = False
+            async for message in iterate(current_prompt, current_turns, options, session):
+                if ckpt is not None:
+                    ckpt.record(message)
+                if isinstance(message, AssistantMessage):
+                    for block in message.content:
+                        if isinstance(block, TextBlock):
+                            print(f"📝 {block.text[:100]}...")
 
-        # 次の試行のためにターン数を増加
-        current_turns = int(current_turns * growth_factor)
-        print(f"\n⏫ ターン数を増加: {current_turns}")
+                elif isinstance(message, ResultMessage):
+                    attempt_cost = message.total_cost_usd or 0.0
+                    total_cost += attempt_cost
+                    used_turns = message.num_turns
+                    total_turns += used_turns
+                    completed = message.subtype == "success"
+
+                    print(f"\n結果: {used_turns}/{current_turns}ターン使用")
+                    print(f"累計コスト: ${total_cost:.4f}")
+
+            if ckpt is not None:
+                ckpt.end_attempt(attempt, used_turns, attempt_cost, bool(primer))
+                print(
+                    f"♻️ 記録済みの結果を提供: {attempt['hits']}件,"
+                    f" 繰り返さずに済んだターン: {attempt['saved_turns']}"
+                )
+
+            # ターン数の上限で止まらずに終わった = タスク完了
+            if completed:
+                print("\n✅ タスク完了")
+                if ckpt is not None:
+                    ckpt.finish(True)
+                    return checkpoint_summary(ckpt, True, used_turns)
+                return {
+                    "turns_used": used_turns,
+                    "total_turns": total_turns,
+                    "iterations": iteration,
+                    "total_cost": total_cost,
+                    "completed": True,
+                }
+
+            # 次の試行のためにターン数を増加
+            current_turns = int(current_turns * growth_factor)
+            print(f"\n⏫ ターン数を増加: {current_turns}")
+    finally:
+        if session:
+            await session.__aexit__(None, None, None)
 
     print(f"\n⚠️ 最大ターン数 ({max_turns}) に達しました")
+    if ckpt is not None:
+        ckpt.finish(False)
+        return checkpoint_summary(ckpt, False, max_turns)
     return {
         "turns_used": max_turns,
+        "total_turns": total_turns,
         "iterations": iteration,
         "total_cost": total_cost,
+        "completed": False,
+    }
+
+
+def checkpoint_summary(ckpt: ToolCheckpoint, completed: bool, turns_used: Optional[int] = None) -> dict:
+    """チェックポイントの状態から progressive_execution の結果を作る"""
+    state = ckpt.state
+    attempts = state["attempts"]
+    return {
+        "turns_used": turns_used if turns_used is not None else (attempts[-1]["turns"] if attempts else 0),
+        "total_turns": state["total_turns"],
+        "iterations": len(attempts),
+        "total_cost": state["total_cost"],
+        "completed": completed,
+        "executed_turns": state["executed_turns"],
+        "attempts": attempts,
+        "saved_turns": sum(a["saved_turns"] for a in attempts),
+    }
+
+
+async def benchmark_continuation(args: argparse.Namespace):
+    """スタンドイン CLI で、毎回新規の query() と継続セッションを比較"""
+    print("=" * 60)
+    print("継続実行 ベンチマーク")
+    print("=" * 60)
+    print(f"タスク: {args.task_turns}ターン")
+    print(f"continue: 初期 {args.initial_turns}ターン, 最大 {args.max_turns}ターン")
+    print(f"progressive: 初期 {args.initial_turns // 2}ターン, 最大 {args.max_turns}ターン")
+    print("=" * 60)
+
+    rows = []
+    for mode in ["continue", "progressive"]:
+        for fresh in [True, False]:
+            with tempfile.TemporaryDirectory() as state_dir:
+                # FAKE_CLI_STATE_DIR でセッションごとの進捗を保存する
+                # （新しいセッションは最初から作業をやり直す）
+                options = ClaudeAgentOptions(
+                    cli_path=str(args.cli_path),
+                    allowed_tools=["Read", "Glob", "Grep"],
+                    env={
+                        "FAKE_CLI_STARTUP_MS": "100",
+                        "FAKE_CLI_TURN_MS": "5",
+                        "FAKE_CLI_TURNS": str(args.task_turns),
+                        "FAKE_CLI_STATE_DIR": state_dir,
+                    }
+                )
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if mode == "continue":
+                        result = await continue_if_needed(
+                            "大規模なコード分析を実行", args.initial_turns, args.max_turns,
+                            fresh=fresh, options=options
+                        )
+                    else:
+                        result = await progressive_execution(
+                            "大規模なコード分析を実行", args.initial_turns // 2, args.max_turns,
+                            fresh=fresh, options=options
+                        )
+                elapsed = time.perf_counter() - start
+            rows.append((mode, "fresh" if fresh else "session", result, elapsed))
+
+    print(f"\n{'モード':<12} {'方式':<8} {'完了':>6} {'反復':>6} {'合計ターン':>10} {'コスト($)':>10} {'時間(s)':>8}")
+    print("-" * 68)
+    for mode, name, result, elapsed in rows:
+        print(
+            f"{mode:<12} {name:<8} {'はい' if result['completed'] else 'いいえ':>6} {result['iterations']:>6}"
+            f" {result['total_turns']:>10} {result['total_cost']:>10.4f} {elapsed:>8.2f}"
+        )
+    print("-" * 68)
+
+
+async def benchmark_checkpoint(args: argparse.Namespace):
+    """スタンドイン CLI で、チェックポイントの有無による試行ごとのターン数・コストを比較"""
+    prompt = "大規模なコード分析を実行"
+    initial_turns = args.initial_turns // 2
+
+    print("=" * 60)
+    print("チェックポイント ベンチマーク (毎回新規の query())")
+    print("=" * 60)
+    print(f"タスク: {args.task_turns}ターン (ツール実行 {args.tool_ms}ms/回)")
+    print(f"progressive: 初期 {initial_turns}ターン, 最大 {args.max_turns}ターン")
+    print(f"異常終了率: {args.crash_rate:.0%}/ターン ({args.runs}回の平均)")
+    print("=" * 60)
+
+    def make_options(crash_rate: float = 0.0) -> ClaudeAgentOptions:
+        return ClaudeAgentOptions(
+            cli_path=str(args.cli_path),
+            allowed_tools=["Read", "Glob", "Grep"],
+            env={
+                "FAKE_CLI_STARTUP_MS": "100",
+                "FAKE_CLI_TURN_MS": "5",
+                "FAKE_CLI_TOOL_MS": str(args.tool_ms),
+                "FAKE_CLI_TURNS": str(args.task_turns),
+                "FAKE_CLI_CRASH_RATE": str(crash_rate),
+            }
+        )
+
+    # 1. 試行ごとの比較
+    scenarios = [
+        ("なし", None),
+        ("フックのみ", dict(primer_limit=0)),
+        ("primer+フック", dict()),
+    ]
+    rows = []
+    for name, kwargs in scenarios:
+        ckpt = ToolCheckpoint(None, prompt, reuse=kwargs is not None, **(kwargs or {}))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = await progressive_execution(
+                prompt, initial_turns, args.max_turns, fresh=True,
+                options=make_options(), checkpoint=ckpt
+            )
+        rows.append((name, result, time.perf_counter() - start))
+
+    # 提供: フックが返した記録済みの結果, 節約: primer でやり直さずに済んだターン
+    print(f"\n{'チェックポイント':<14} {'試行':>4} {'max_turns':>9} {'ターン':>6} {'コスト($)':>10} {'提供':>5} {'節約ターン':>10}")
+    print("-" * 66)
+    for name, result, _ in rows:
+        for i, attempt in enumerate(result["attempts"]):
+            print(
+                f"{name:<14} {i + 1:>4} {attempt['max_turns']:>9} {attempt['turns']:>6} {attempt['cost']:>10.4f}"
+                f" {attempt['hits']:>5} {attempt['saved_turns']:>10}"
+            )
+    print("-" * 66)
+    print(f"\n{'チェックポイント':<14} {'試行':>4} {'合計ターン':>10} {'コスト($)':>10} {'時間(s)':>8}")
+    print("-" * 52)
+    for name, result, elapsed in rows:
+        print(f"{name:<14} {result['iterations']:>4} {result['total_turns']:>10} {result['total_cost']:>10.4f} {elapsed:>8.2f}")
+    print("-" * 52)
+
+    # 2. 異常終了からの再開
+    print(f"\n{'再開方法':<14} {'完了':>6} {'再起動':>6} {'実行ターン':>10} {'時間(s)':>8}")
+    print("-" * 50)
+    for name, use_file in [("最初から", False), ("チェックポイント", True)]:
+        completed = restarts = executed = 0
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "checkpoint.json")
+                for _ in range(args.max_restarts + 1):
+                    # チェックポイントなしでは、毎回新しい記録で最初からやり直す
+                    ckpt = ToolCheckpoint(path if use_file else None, prompt, reuse=use_file)
+                    try:
+                        # 異常終了時の SDK のエラーログも抑制する
+                        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                            result = await progressive_execution(
+                                prompt, initial_turns, args.max_turns, fresh=True,
+                                options=make_options(args.crash_rate), checkpoint=ckpt
+                            )
+                        completed += result["completed"]
+                        break
+                    except Exception:
+                        restarts += 1
+                    finally:
+                        executed += ckpt.state["executed_turns"] if not use_file else 0
+                if use_file:
+                    executed += ckpt.state["executed_turns"]
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:<14} {completed:>3}/{args.runs:<2} {restarts / args.runs:>6.1f}"
+            f" {executed / args.runs:>10.1f} {elapsed / args.runs:>8.2f}"
+        )
+    print("-" * 50)
+    print(f"異常終了なしの最小ターン数: {args.task_turns}")
+
+
+# =============================================================================
+# 推定の評価
+# =============================================================================
+
+async def benchmark_completion(args: argparse.Namespace):
+    """スタンドイン CLI で、完了の検出による中断の効果を比較"""
+    done_at = args.task_turns * 2 // 3
+    quoted = "ログに「処理が完了しました」と出力するよう修正します。"
+    finals = {
+        "印": f"## 変更内容\n- parse を修正\n- テストを追加\n\n{COMPLETION_MARKER}",
+        "語句": "parse を修正し、テストが通ることを確認しました。作業は完了しました。",
+    }
+    print("=" * 82)
+    print(f"スタンドイン CLI: {args.task_turns}ターンのタスク, {done_at}ターン目で作業が終わり残りは確認とまとめ")
+    print(f"引用: 3ターン目に「処理が完了しました」を引用したテキスト, 継続実行 初期 {args.initial_turns}ターン")
+    print("=" * 82)
+
+    cases = [
+        ("部分一致 (従来)", "語句", False, False, 1.0),
+        ("部分一致 (従来)", "語句", True, False, 1.0),
+        ("CompletionDetector 1.0", "印", True, True, 1.0),
+        ("CompletionDetector 1.0", "語句", True, True, 1.0),
+        ("CompletionDetector 0.8", "語句", True, True, 0.8),
+    ]
+    rows = []
+    for name, style, quote, early_stop, threshold in cases:
+        texts = {str(done_at): finals[style]}
+        if quote:
+            texts["3"] = quoted
+        with tempfile.TemporaryDirectory() as state_dir:
+            options = ClaudeAgentOptions(
+                cli_path=str(args.cli_path),
+                allowed_tools=["Read", "Glob", "Grep"],
+                env={
+                    "FAKE_CLI_STARTUP_MS": "100",
+                    "FAKE_CLI_TURN_MS": "5",
+                    "FAKE_CLI_TURNS": str(args.task_turns),
+                    "FAKE_CLI_STATE_DIR": state_dir,
+                    "FAKE_CLI_TEXTS": json.dumps(texts, ensure_ascii=False),
+                }
+            )
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = await continue_if_needed(
+                    "parse のバグを修正して", args.initial_turns, args.max_turns,
+                    options=options, early_stop=early_stop, threshold=threshold
+                )
+        rows.append((name, style, quote, result))
+
+    print(f"\n{'判定':<24} {'完了の書き方':<8} {'引用':<4} {'反復':>4} {'合計ターン':>10} {'コスト($)':>10} {'作業の完了':>10}")
+    print("-" * 82)
+    for name, style, quote, result in rows:
+        finished = "はい" if result["total_turns"] >= done_at else "いいえ (早すぎる)"
+        print(
+            f"{name:<24} {style:<8} {'あり' if quote else 'なし':<4} {result['iterations']:>4} {result['total_turns']:>10}"
+            f" {result['total_cost']:>10.4f} {finished:>10}"
+        )
+    print("-" * 82)
+
+
+def synthetic_history(count: int, seed: int = 0) -> list[dict]:
+    """
+    評価用の実行履歴
+
+    実際のターン数はキーワード表とは異なる傾向（読み取り系は少なく、
+    分析や作成はファイル数や書き込みツールに応じて増える）で生成します。
+    """
+    rng = random.Random(seed)
+    true_turns = {
+        "分析": 12, "調査": 9, "確認": 2, "レビュー": 10, "読んで": 2, "表示": 1,
+        "作成": 14, "書いて": 9, "修正": 6, "更新": 5, "リファクタリング": 35,
+        "全ファイル": 25, "テスト": 16, "ドキュメント": 8, "説明": 3, "要約": 3,
+    }
+    true_modifiers = {"詳細": 1.8, "徹底的": 2.5, "簡潔": 0.6, "ざっくり": 0.4}
+    targets = ["src/", "README.md", "この関数", "API モジュール", "設定ファイル"]
+    tool_sets = [["Read", "Glob", "Grep"], ["Read", "Write", "Edit", "Glob", "Grep"], ["Read", "Edit", "Bash"]]
+
+    records = []
+    for _ in range(count):
+        keywords = rng.sample(list(true_turns), rng.choice([1, 1, 2]))
+        modifier = rng.choice([None, None, *true_modifiers])
+        tools = rng.choice(tool_sets)
+        cwd_files = int(rng.lognormvariate(5, 1.2))
+
+        prompt = f"{rng.choice(targets)}を" + ("、".join(keywords)) + "して"
+        if modifier:
+            prompt = f"{modifier}に{prompt}"
+
+        turns = max(true_turns[k] for k in keywords)
+        turns *= true_modifiers.get(modifier, 1.0)
+        turns *= 1 + 0.1 * math.log10(1 + cwd_files)
+        if "Write" in tools or "Bash" in tools:
+            turns *= 1.3
+        turns = max(1, round(turns * rng.lognormvariate(0, 0.25)))
+
+        records.append({"prompt": prompt, "allowed_tools": tools, "cwd_files": cwd_files, "num_turns": turns})
+    return records
+
+
+def evaluate_estimators(records: list[dict], quantile: float = 0.9):
+    """
+    キーワード表と学習モデルを比較
+
+    学習モデルは各実行を推定してから学習する（逐次評価）ため、
+    未知のデータに対する誤差になります。
+    """
+    rules = TurnEstimator()
+    learned = LearnedTurnEstimator(quantile=quantile)
+
+    rows = {"keywords": [], "learned": []}
+    for record in records:
+        actual = record["num_turns"]
+        context = {"allowed_tools": record["allowed_tools"], "cwd_files": record["cwd_files"]}
+        rows["keywords"].append((rules.estimate(record["prompt"]), actual))
+        if learned.trained:
+            rows["learned"].append((learned.estimate(record["prompt"], **context), actual))
+        learned.update(record["prompt"], actual, **context)
+
+    print(f"\n{'推定方式':<10} {'件数':>6} {'平均誤差':>8} {'不足率':>8} {'平均余裕':>8}")
+    print("-" * 46)
+    for name, pairs in rows.items():
+        estimates = np.array([p[0] for p in pairs])
+        actuals = np.array([p[1] for p in pairs])
+        print(
+            f"{name:<10} {len(pairs):>6} {np.abs(estimates - actuals).mean():>8.1f}"
+            f" {(actuals > estimates).mean():>8.1%} {np.maximum(0, estimates - actuals).mean():>8.1f}"
+        )
+    print("-" * 46)
+    print("不足率: 推定ターン数で足りなかった割合 (continue_if_needed の再実行が必要)")
+    print("平均余裕: 推定ターン数のうち使われなかったターン数")
+
+    calibration = learned.calibration()
+    print(f"\nキャリブレーション: 目標 {calibration['target_coverage']:.0%}, "
+          f"実際 {calibration['coverage']:.1%} (誤差 {calibration['calibration_error']:.1%})")
+    return learned
+
+
+def synthetic_sessions(count: int = 400, seed: int = 0, marker_rate: float = 0.5) -> list[dict]:
+    """
+    完了の検出を評価するためのセッション
+
+    complete   : done_at ターン目で作業が終わり、そのあと確認やまとめのターンが 0〜5 続く
+                 （完了の書き方は marker / phrase / summary / implicit のいずれか）
+    incomplete : 作業の途中で max_turns に達する
+    どちらも作業中のテキストに、引用した「完了しました」や部分的な完了の報告、
+    「以上です」で終わる作業方針を含みます（続ける意図を書かない報告は判定を誤ります）。
+    各ターンは {"text", "tools": [{"tool", "is_error"}], "cost"} で、コストは文脈とともに増えます。
+    """
+    rng = random.Random(seed)
+    files = ["src/parser.py", "src/api.py", "tests/test_parser.py", "README.md", "config.yaml"]
+    progress = [
+        "{f} を読んで構造を確認します。",
+        "{f} の parse を修正します。",
+        "テストを実行して結果を確認します。",
+        "次に {f} の呼び出し元を調べます。",
+    ]
+    quoted = [
+        "ログに「処理が完了しました」と出力するよう {f} を修正します。",
+        "```python\nprint(\"完了しました\")\n```\nを {f} の最後に追加します。",
+        "エラーメッセージ `完了です` が二重に出ている原因を {f} で調べます。",
+        "> 以上です\nで終わるコメントの後ろに処理を追加します。",
+    ]
+    partial = [
+        "{f} の修正は完了しました。次にテストを修正します。",
+        "1つ目の修正は完了です。残りのファイルも同様に修正します。",
+        "テストの一部は終了しましたが、まだ2件失敗しています。",
+        "ビルドは完了しました。",
+        "{f} の読み込みが終了しました。",
+        "{f} を修正し、テストが通ることを確認しました。ビルドも完了しました。",
+    ]
+    plan = "## 方針\n- {f} を読む\n- parse を修正\n- テストを追加\n\n方針は以上です。"
+    finals = {
+        "marker": "## 変更内容\n- {f} の parse を修正\n- テストを追加\n\n" + COMPLETION_MARKER,
+        "phrase": "{f} を修正し、テストが通ることを確認しました。作業は完了しました。",
+        "summary": "## まとめ\n- {f} の parse を修正\n- 例外処理を追加\n- テストを追加\n\n修正は以上です。念のため全体のテストを実行します。",
+        "implicit": "{f} を修正し、テストはすべて通りました。",
+    }
+
+    def work_turn(turns: list, cost: float, error_rate: float = 0.1):
+        f = rng.choice(files)
+        kind = rng.random()
+        text = None
+        if kind < 0.3:
+            text = rng.choice(progress).format(f=f)
+        elif kind < 0.42:
+            text = rng.choice(quoted).format(f=f)
+        elif kind < 0.5:
+            text = rng.choice(partial).format(f=f)
+        tools = [{"tool": rng.choice(["Read", "Grep", "Edit", "Bash"]), "is_error": rng.random() < error_rate}
+                 for _ in range(rng.choice([1, 1, 2]))]
+        turns.append({"text": text, "tools": tools, "cost": round(cost * (1 + 0.08 * len(turns)), 5)})
+
+    sessions = []
+    for i in range(count):
+        cost = rng.uniform(0.005, 0.02)
+        turns = []
+        if rng.random() < 0.2:
+            turns.append({"text": plan.format(f=rng.choice(files)), "tools": [{"tool": "Read", "is_error": False}],
+                          "cost": round(cost, 5)})
+        if rng.random() < 0.7:
+            done_at = rng.randint(len(turns) + 3, 20)
+            while len(turns) < done_at - 1:
+                work_turn(turns, cost)
+            style = "marker" if rng.random() < marker_rate else rng.choice(["phrase", "summary", "implicit"])
+            trailing = rng.randint(0, 5)
+            text = finals[style].format(f=rng.choice(files))
+            tools = [{"tool": "Bash", "is_error": False}] if trailing else []
+            turns.append({"text": text, "tools": tools, "cost": round(cost * (1 + 0.08 * len(turns)), 5)})
+            for n in range(trailing):
+                if n == trailing - 1:
+                    text = "## 変更内容\n- 修正したファイルと内容の一覧\n\n以上です。"
+                    turns.append({"text": text, "tools": [], "cost": round(cost * (1 + 0.08 * len(turns)), 5)})
+                else:
+                    text = "念のため確認します。" if rng.random() < 0.5 else None
+                    turns.append({"text": text, "tools": [{"tool": "Read", "is_error": False}],
+                                  "cost": round(cost * (1 + 0.08 * len(turns)), 5)})
+            label, subtype = style, "success"
+        else:
+            done_at = None
+            for _ in range(rng.randint(5, 30)):
+                work_turn(turns, cost)
+            label, subtype = "incomplete", "error_max_turns"
+        sessions.append({"prompt": f"session {i}", "label": label, "done_at": done_at, "subtype": subtype, "turns": turns})
+    return sessions
+
+
+def replay_completion(session: dict, detect) -> tuple[Optional[int], str]:
+    """
+    セッションを先頭から再生し、完了と判定したターンと根拠（stream / stopped）を返す
+
+    detect は CompletionDetector か、テキストを受け取り bool を返す関数（部分一致の判定）。
+    どちらも、ツールを呼ばずに応答を終えたセッションは最後のターンで完了とみなします（stopped）。
+    判定しなければ (None, "") です。
+    """
+    for n, turn in enumerate(session["turns"], 1):
+        if turn.get("text"):
+            if isinstance(detect, CompletionDetector):
+                detect.turns = n
+                if detect.on_text(turn["text"]):
+                    return n, "stream"
+            elif detect(turn["text"]):
+                return n, "stream"
+        for k, call in enumerate(turn.get("tools") or []):
+            if isinstance(detect, CompletionDetector):
+                detect.on_tool_use(f"{n}-{k}")
+                detect.on_tool_result(f"{n}-{k}", call.get("is_error", False))
+    if session.get("subtype") == "success" and not (session["turns"] and session["turns"][-1].get("tools")):
+        return len(session["turns"]), "stopped"
+    return None, ""
+
+
+def evaluate_completion(sessions: list[dict], thresholds=(0.6, 0.8, 1.0)):
+    """
+    完了の検出を、部分一致（従来）と CompletionDetector で比較
+
+    ストリームの途中の判定について、完了したセッションの done_at 以降なら正解、それより前や
+    未完了のセッションなら早すぎる停止として適合率・再現率を出します（モデルが自分で応答を
+    終えたセッションは中断しなくても止まるので、どちらにも数えません）。
+    正解の判定で中断すれば、判定後のターンが節約できます。
+    """
+    total_turns = sum(len(s["turns"]) for s in sessions)
+    total_cost = sum(t["cost"] for s in sessions for t in s["turns"])
+    complete = [s for s in sessions if s["done_at"]]
+
+    def without_marker(session: dict) -> dict:
+        turns = [{**t, "text": (t.get("text") or "").replace(COMPLETION_MARKER, "").strip() or None}
+                 for t in session["turns"]]
+        return {**session, "turns": turns}
+
+    configs = [("部分一致 (従来)", lambda: (lambda text: any(ind in text for ind in COMPLETION_INDICATORS)), False)]
+    configs += [(f"CompletionDetector {t}", lambda t=t: CompletionDetector(t), False) for t in thresholds]
+    configs.append(("CompletionDetector 0.8 印なし", lambda: CompletionDetector(0.8), True))
+
+    print("=" * 92)
+    print(f"完了の検出: {len(sessions)}セッション (完了 {len(complete)}件), {total_turns}ターン, ${total_cost:.2f}")
+    print("=" * 92)
+    print(f"{'判定':<28} {'適合率':>7} {'再現率':>7} {'早すぎる':>6} {'遅れ':>6} {'節約ターン':>14} {'節約コスト':>16}")
+    print("-" * 92)
+    breakdown = {}
+    for name, make, strip in configs:
+        correct = early = saved_turns = 0
+        saved_cost = 0.0
+        delays = []
+        rows = breakdown.setdefault(name, {})
+        for session in sessions:
+            played = without_marker(session) if strip else session
+            fired, source = replay_completion(played, make())
+            row = rows.setdefault(session["label"], [0, 0, 0])
+            row[0] += 1
+            if source != "stream":
+                continue
+            if session["done_at"] and fired >= session["done_at"]:
+                correct += 1
+                row[1] += 1
+                delays.append(fired - session["done_at"])
+                saved_turns += len(session["turns"]) - fired
+                saved_cost += sum(t["cost"] for t in session["turns"][fired:])
+            else:
+                early += 1
+                row[2] += 1
+        precision = correct / (correct + early) if correct + early else 0.0
+        delay = np.mean(delays) if delays else float("nan")
+        print(
+            f"{name:<28} {precision:>7.1%} {correct / len(complete):>7.1%} {early:>6} {delay:>6.1f}"
+            f" {saved_turns:>6} ({saved_turns / total_turns:>4.0%}) ${saved_cost:>8.2f} ({saved_cost / total_cost:>4.0%})"
+        )
+    print("-" * 92)
+    print("早すぎる: 作業が終わる前に完了と判定した件数 / 遅れ: 作業が終わってから判定するまでのターン数")
+
+    detector_name = "CompletionDetector 1.0"
+    print(f"\n{'完了の書き方':<12} {'件数':>6} {'部分一致 正解/早すぎる':>22} {'Detector 1.0 正解/早すぎる':>26}")
+    print("-" * 70)
+    for label in ["marker", "phrase", "summary", "implicit", "incomplete"]:
+        base = breakdown["部分一致 (従来)"].get(label, [0, 0, 0])
+        ours = breakdown[detector_name].get(label, [0, 0, 0])
+        print(f"{label:<12} {base[0]:>6} {base[1]:>13}/{base[2]:<8} {ours[1]:>17}/{ours[2]:<8}")
+    print("-" * 70)
+
+
+def load_history(paths: list[str]) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+# =============================================================================
+# キーワード検索のベンチマーク
+# =============================================================================
+
+def naive_explain(estimator: TurnEstimator, prompt: str) -> dict:
+    """キーワードごとに `in` で検索する従来の実装（比較用）"""
+    def estimate() -> int:
+        base_turns = 5
+        for keyword, turns in estimator.KEYWORD_TURNS.items():
+            if keyword in prompt:
+                base_turns = max(base_turns, turns)
+        multiplier = 1.0
+        for modifier, mult in estimator.MODIFIER_MULTIPLIERS.items():
+            if modifier in prompt:
+                multiplier = mult
+                break
+        return max(3, min(100, int(base_turns * multiplier)))
+
+    return {
+        "estimated_turns": estimate(),
+        "matched_keywords": [(k, t) for k, t in estimator.KEYWORD_TURNS.items() if k in prompt],
+        "matched_modifiers": [(m, x) for m, x in estimator.MODIFIER_MULTIPLIERS.items() if m in prompt],
     }
 
 
+def benchmark_matcher(table_sizes: list[int], prompts: int):
+    """キーワード表の大きさごとに、従来の検索・1回の線形走査・Aho-Corasick を比較"""
+    rng = random.Random(0)
+    chars = "あいうえおかきくけこさしすせそたちつてとなにぬねのアイウエオカキクケコ分析調査作成修正"
+
+    def word() -> str:
+        return "".join(rng.choice(chars) for _ in range(rng.randint(2, 6)))
+
+    print("=" * 60)
+    print("ターン数推定 キーワード検索ベンチマーク")
+    print("=" * 60)
+    print(f"プロンプト数: {prompts}")
+    print("=" * 60)
+    print(f"\n{'キーワード数':>12} {'従来(µs/件)':>12} {'線形(µs/件)':>12} {'AC(µs/件)':>12} {'構築(ms)':>10} {'既定':>6}")
+    print("-" * 70)
+
+    for size in table_sizes:
+        keywords = dict(TurnEstimator.KEYWORD_TURNS)
+        while len(keywords) < size:
+            keywords[word()] = rng.randint(2, 30)
+        keywords = dict(list(keywords.items())[:size])
+        estimator_cls = type(f"Estimator{size}", (TurnEstimator,), {"KEYWORD_TURNS": keywords})
+        estimator = estimator_cls()
+        # 同じ表で、検索方法だけを固定したもの
+        linear = type(f"Linear{size}", (estimator_cls,), {"MATCHER_THRESHOLD": float("inf")})()
+        compiled_estimator = type(f"Compiled{size}", (estimator_cls,), {"MATCHER_THRESHOLD": 0})()
+
+        batch = [
+            "".join(rng.choice(list(keywords)) if rng.random() < 0.2 else word() for _ in range(8)) + "して"
+            for _ in range(prompts)
+        ]
+
+        start = time.perf_counter()
+        compiled_estimator.matcher()
+        build = time.perf_counter() - start
+
+        def best_of(func, repeat: int = 3) -> tuple[float, list]:
+            """ばらつきを抑えるため、最も速かった回の1件あたりの時間を使う"""
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = func()
+                times.append((time.perf_counter() - start) / prompts)
+            return min(times), result
+
+        naive, expected = best_of(lambda: [naive_explain(estimator, prompt) for prompt in batch])
+        scanned, scanned_results = best_of(lambda: linear.estimate_batch(batch))
+        compiled, results = best_of(lambda: compiled_estimator.estimate_batch(batch))
+
+        assert scanned_results == expected
+        assert results == expected
+        assert estimator.estimate_batch(batch) == expected
+        default = "線形" if len(keywords) + len(estimator.MODIFIER_MULTIPLIERS) < estimator.MATCHER_THRESHOLD else "AC"
+        print(
+            f"{size:>12} {naive * 1e6:>12.1f} {scanned * 1e6:>12.1f} {compiled * 1e6:>12.1f}"
+            f" {build * 1000:>10.1f} {default:>6}"
+        )
+    print("-" * 70)
+    print(f"既定: estimate() が使う検索（表の項目数が {TurnEstimator.MATCHER_THRESHOLD} 以上なら AC）")
+
+
 def parse_args() -> argparse.Namespace:
     """コマンドライン引数をパース"""
     parser = argparse.ArgumentParser(
@@ -304,7 +1874,8 @@ def parse_args() -> argparse.Namespace:
     )
     parser.add_argument(
         "-m", "--mode",
-        choices=["estimate", "continue", "progressive"],
+        choices=["estimate", "continue", "progressive", "train", "evaluate", "bench-match", "bench-continue",
+                 "bench-checkpoint", "evaluate-completion", "bench-completion"],
         default="estimate",
         help="実行モード (default: estimate)"
     )
@@ -330,6 +1901,91 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="ターン数推定の根拠を表示 (estimate モード用)"
     )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.0,
+        help="continue で完了と判定する CompletionDetector の閾値 (default: 1.0)"
+    )
+    parser.add_argument(
+        "--no-early-stop",
+        action="store_true",
+        help="continue で完了を検出しても中断せず、語句の部分一致で判定 (従来の動作)"
+    )
+    parser.add_argument(
+        "--corpus",
+        nargs="+",
+        default=[],
+        help="evaluate-completion に使うセッション (JSONL)。省略すると合成データを使用"
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="continue / progressive で反復ごとに新しい query() を起動 (従来の動作)"
+    )
+    parser.add_argument(
+        "--task-turns",
+        type=int,
+        default=24,
+        help="bench-continue / bench-checkpoint / bench-completion のタスクに必要なターン数 (default: 24)"
+    )
+    parser.add_argument(
+        "--cli-path",
+        type=Path,
+        default=FAKE_CLI_PATH,
+        help="bench-continue / bench-checkpoint / bench-completion に使う CLI のパス"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="progressive の記録を保存するファイル。既存のファイルを指定すると続きから再開"
+    )
+    parser.add_argument(
+        "--tool-ms",
+        type=int,
+        default=30,
+        help="bench-checkpoint のツール実行時間 (default: 30)"
+    )
+    parser.add_argument(
+        "--crash-rate",
+        type=float,
+        default=0.03,
+        help="bench-checkpoint で1ターンごとに異常終了する確率 (default: 0.03)"
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="bench-checkpoint の異常終了シナリオの実行回数 (default: 5)"
+    )
+    parser.add_argument(
+        "--max-restarts",
+        type=int,
+        default=20,
+        help="bench-checkpoint で異常終了後に再起動する最大回数 (default: 20)"
+    )
+    parser.add_argument(
+        "--model",
+        help="学習済みの推定モデル (.npz)。estimate モードでは実行後に更新して保存"
+    )
+    parser.add_argument(
+        "--history",
+        nargs="+",
+        default=[],
+        help="学習・評価に使う実行履歴 (JSONL)。evaluate で省略すると合成データを使用"
+    )
+    parser.add_argument(
+        "--table-sizes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="bench-match のキーワード表の大きさ (default: 10 100 1000 10000)"
+    )
+    parser.add_argument(
+        "--prompts",
+        type=int,
+        default=2000,
+        help="bench-match のプロンプト数 (default: 2000)"
+    )
     return parser.parse_args()
 
 
@@ -342,13 +1998,48 @@ async def main():
     print("=" * 50)
 
     if args.mode == "estimate":
-        await adaptive_query(args.prompt, explain=args.explain)
+        estimator = None
+        if args.model and Path(args.model).exists():
+            estimator = LearnedTurnEstimator.load(args.model)
+        elif args.model:
+            estimator = LearnedTurnEstimator()
+        await adaptive_query(args.prompt, explain=args.explain, estimator=estimator, model_path=args.model)
+
+    elif args.mode == "train":
+        estimator = LearnedTurnEstimator().fit(load_history(args.history))
+        estimator.save(args.model or "turn_estimator.npz")
+        calibration = estimator.calibration()
+        print(f"学習件数: {calibration['samples']}")
+        print(f"キャリブレーション誤差: {calibration['calibration_error']:.1%} (平均誤差 {calibration['mean_abs_error']:.1f}ターン)")
+        print(f"保存しました: {args.model or 'turn_estimator.npz'}")
+
+    elif args.mode == "evaluate":
+        records = load_history(args.history) if args.history else synthetic_history(3000)
+        evaluate_estimators(records)
+
+    elif args.mode == "bench-match":
+        benchmark_matcher(args.table_sizes, args.prompts)
+
+    elif args.mode == "bench-continue":
+        await benchmark_continuation(args)
+
+    elif args.mode == "bench-checkpoint":
+        await benchmark_checkpoint(args)
+
+    elif args.mode == "evaluate-completion":
+        evaluate_completion(load_history(args.corpus) if args.corpus else synthetic_sessions())
+
+    elif args.mode == "bench-completion":
+        await benchmark_completion(args)
 
     elif args.mode == "continue":
         result = await continue_if_needed(
             args.prompt,
             initial_turns=args.initial_turns,
-            max_total_turns=args.max_turns
+            max_total_turns=args.max_turns,
+            fresh=args.fresh,
+            early_stop=not args.no_early_stop,
+            threshold=args.threshold
         )
         print("\n" + "=" * 50)
         print("📊 最終結果")
@@ -361,13 +2052,17 @@ async def main():
         result = await progressive_execution(
             args.prompt,
             initial_turns=args.initial_turns,
-            max_turns=args.max_turns
+            max_turns=args.max_turns,
+            fresh=args.fresh,
+            checkpoint=args.checkpoint
         )
         print("\n" + "=" * 50)
         print("📊 最終結果")
         print(f"  使用ターン: {result['turns_used']}")
         print(f"  試行回数: {result['iterations']}")
         print(f"  合計コスト: ${result['total_cost']:.4f}")
+        if "attempts" in result:
+            print(f"  繰り返さずに済んだターン: {result['saved_turns']}")
 
 
 if __name__ == "__main__":
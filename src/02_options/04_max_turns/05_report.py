@@ -0,0 +1,494 @@
+"""
+実行履歴のレポート - NumPy による集計
+
+BudgetManager.print_history や TurnMonitor.print_summary は1回の実行を
+Python のループで集計して表示します。
+このスクリプトは保存済みの実行履歴（JSONL）を列ごとの NumPy 配列に読み込み、
+パーセンタイル、モード/ペルソナ/タスク別の集計、日ごとの推移、ツールの構成比を
+まとめて計算します。
+
+Usage:
+    python 05_report.py
+    python 05_report.py demo --group-by persona --trend day
+    python 05_report.py report runs.jsonl
+    python 05_report.py report runs.jsonl --group-by mode --trend day
+    python 05_report.py report runs/*.jsonl --group-by task --filter mode=automation
+    python 05_report.py generate runs.jsonl --runs 10000
+    python 05_report.py benchmark --runs 100000
+
+実行履歴の形式 (1行1実行):
+    {"run_id": "...", "started_at": 1760000000.0, "mode": "automation", "persona": "reviewer",
+     "task": "analysis", "num_turns": 12, "max_turns": 100, "cost_usd": 0.034,
+     "duration_ms": 8123.0, "subtype": "success", "tools": {"Read": 5, "Grep": 3}}
+
+02_monitoring.py の --archive オプションで、実行ごとに1行追記できます。
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+LABELS = ("mode", "persona", "task")
+PERCENTILES = (50, 90, 99)
+TRENDS = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+
+
+def record_run(
+    path: str,
+    num_turns: int,
+    cost_usd: float,
+    duration_ms: float,
+    tools: dict,
+    subtype: str = "success",
+    max_turns: Optional[int] = None,
+    prompt: Optional[str] = None,
+    allowed_tools: Optional[list[str]] = None,
+    cwd_files: Optional[int] = None,
+    system_prompt: Optional[str] = None,
+    **labels
+):
+    """
+    1回の実行を実行履歴に追記
+
+    prompt / allowed_tools / cwd_files は 04_adaptive.py のターン数推定の学習に使います。
+    system_prompt は長さだけを記録し、06_forecast.py のコスト予測に使います。
+    """
+    record = {
+        "run_id": uuid.uuid4().hex,
+        "started_at": time.time() - duration_ms / 1000,
+        "num_turns": num_turns,
+        "max_turns": max_turns,
+        "cost_usd": cost_usd,
+        "duration_ms": duration_ms,
+        "subtype": subtype,
+        "tools": dict(tools),
+        **{label: labels.get(label, "") for label in LABELS},
+    }
+    if prompt is not None:
+        record.update(prompt=prompt, allowed_tools=allowed_tools, cwd_files=cwd_files)
+    if system_prompt is not None:
+        record["system_prompt_chars"] = len(system_prompt)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+# =============================================================================
+# 列形式のテーブル
+# =============================================================================
+
+@dataclass
+class RunTable:
+    """実行履歴を列ごとの配列で保持する"""
+    started_at: np.ndarray
+    num_turns: np.ndarray
+    max_turns: np.ndarray
+    cost_usd: np.ndarray
+    duration_ms: np.ndarray
+    is_error: np.ndarray
+    tool_names: list[str]
+    tool_counts: np.ndarray  # (実行数, ツール数)
+    label_codes: dict[str, np.ndarray] = field(default_factory=dict)
+    label_values: dict[str, list[str]] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.cost_usd)
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> "RunTable":
+        started, turns, max_turns, cost, duration, error = [], [], [], [], [], []
+        tool_index: dict[str, int] = {}
+        tool_rows, tool_cols, tool_vals = [], [], []
+        codes: dict[str, list[int]] = {label: [] for label in LABELS}
+        values: dict[str, dict[str, int]] = {label: {} for label in LABELS}
+
+        for i, record in enumerate(records):
+            started.append(record.get("started_at") or 0.0)
+            turns.append(record.get("num_turns") or 0)
+            max_turns.append(record.get("max_turns") or 0)
+            cost.append(record.get("cost_usd") or 0.0)
+            duration.append(record.get("duration_ms") or 0.0)
+            error.append(record.get("subtype", "success") != "success")
+            for name, count in (record.get("tools") or {}).items():
+                tool_rows.append(i)
+                tool_cols.append(tool_index.setdefault(name, len(tool_index)))
+                tool_vals.append(count)
+            for label in LABELS:
+                value = record.get(label) or ""
+                codes[label].append(values[label].setdefault(value, len(values[label])))
+
+        tool_counts = np.zeros((len(cost), len(tool_index)), dtype=np.int32)
+        np.add.at(tool_counts, (np.array(tool_rows, dtype=np.intp), np.array(tool_cols, dtype=np.intp)), tool_vals)
+
+        return cls(
+            started_at=np.array(started, dtype=np.float64),
+            num_turns=np.array(turns, dtype=np.int32),
+            max_turns=np.array(max_turns, dtype=np.int32),
+            cost_usd=np.array(cost, dtype=np.float64),
+            duration_ms=np.array(duration, dtype=np.float64),
+            is_error=np.array(error, dtype=bool),
+            tool_names=list(tool_index),
+            tool_counts=tool_counts,
+            label_codes={label: np.array(codes[label], dtype=np.int32) for label in LABELS},
+            label_values={label: list(values[label]) for label in LABELS},
+        )
+
+    @classmethod
+    def load(cls, paths: Iterable[str]) -> "RunTable":
+        """JSONL の実行履歴を読み込む"""
+        def records():
+            for path in paths:
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+        return cls.from_records(records())
+
+    def column(self, name: str) -> np.ndarray:
+        if name == "tool_calls":
+            return self.tool_counts.sum(axis=1)
+        return getattr(self, name)
+
+    def where(self, mask: np.ndarray) -> "RunTable":
+        """条件に合う実行だけのテーブル"""
+        return RunTable(
+            started_at=self.started_at[mask],
+            num_turns=self.num_turns[mask],
+            max_turns=self.max_turns[mask],
+            cost_usd=self.cost_usd[mask],
+            duration_ms=self.duration_ms[mask],
+            is_error=self.is_error[mask],
+            tool_names=self.tool_names,
+            tool_counts=self.tool_counts[mask],
+            label_codes={label: codes[mask] for label, codes in self.label_codes.items()},
+            label_values=self.label_values,
+        )
+
+    def filter(self, label: str, value: str) -> "RunTable":
+        if label not in self.label_values:
+            raise ValueError(f"不明なラベル: {label} (利用可能: {', '.join(LABELS)})")
+        if value not in self.label_values[label]:
+            return self.where(np.zeros(len(self), dtype=bool))
+        return self.where(self.label_codes[label] == self.label_values[label].index(value))
+
+
+# =============================================================================
+# 集計
+# =============================================================================
+
+def grouped_percentiles(codes: np.ndarray, values: np.ndarray, groups: int, pcts: Iterable[float]) -> np.ndarray:
+    """
+    グループごとのパーセンタイルを一度のソートで計算
+
+    Returns:
+        (グループ数, パーセンタイル数) の配列（空のグループは NaN）
+    """
+    pcts = tuple(pcts)
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    counts = np.bincount(codes, minlength=groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    result = np.full((groups, len(pcts)), np.nan)
+    present = counts > 0
+    for j, pct in enumerate(pcts):
+        offsets = np.floor((counts[present] - 1) * pct / 100).astype(np.intp)
+        result[present, j] = sorted_values[starts[present] + offsets]
+    return result
+
+
+def summarize(table: RunTable) -> dict:
+    """全体のサマリー"""
+    summary = {"runs": len(table), "error_rate": float(table.is_error.mean()) if len(table) else 0.0}
+    for name in ("num_turns", "cost_usd", "duration_ms", "tool_calls"):
+        column = table.column(name)
+        summary[name] = {
+            "total": float(column.sum()),
+            "mean": float(column.mean()) if len(table) else 0.0,
+            **{f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(column, PERCENTILES) if len(table) else [0.0] * 3)},
+        }
+    # ターン上限に対する使用率（上限が記録されている実行のみ）
+    limited = table.max_turns > 0
+    if limited.any():
+        summary["turn_utilization_p50"] = float(np.median(table.num_turns[limited] / table.max_turns[limited]))
+    return summary
+
+
+def group_by(table: RunTable, label: str) -> list[dict]:
+    """ラベル別の集計"""
+    codes = table.label_codes[label]
+    groups = len(table.label_values[label])
+    counts = np.bincount(codes, minlength=groups)
+    cost = np.bincount(codes, weights=table.cost_usd, minlength=groups)
+    errors = np.bincount(codes, weights=table.is_error, minlength=groups)
+    turn_pcts = grouped_percentiles(codes, table.num_turns, groups, PERCENTILES)
+    cost_pcts = grouped_percentiles(codes, table.cost_usd, groups, PERCENTILES)
+
+    rows = []
+    for g, value in enumerate(table.label_values[label]):
+        if counts[g] == 0:
+            continue
+        rows.append({
+            label: value or "(なし)",
+            "runs": int(counts[g]),
+            "total_cost": float(cost[g]),
+            "error_rate": float(errors[g] / counts[g]),
+            "turns": dict(zip((f"p{p}" for p in PERCENTILES), turn_pcts[g].tolist())),
+            "cost": dict(zip((f"p{p}" for p in PERCENTILES), cost_pcts[g].tolist())),
+        })
+    return sorted(rows, key=lambda row: -row["total_cost"])
+
+
+def trend(table: RunTable, period: str) -> list[dict]:
+    """期間ごとの推移"""
+    if len(table) == 0:
+        return []
+    seconds = TRENDS[period]
+    buckets = (table.started_at // seconds).astype(np.int64)
+    first = buckets.min()
+    codes = (buckets - first).astype(np.intp)
+    groups = int(codes.max()) + 1
+    counts = np.bincount(codes, minlength=groups)
+    cost = np.bincount(codes, weights=table.cost_usd, minlength=groups)
+    turns_p50 = grouped_percentiles(codes, table.num_turns, groups, (50,))[:, 0]
+
+    rows = []
+    for g in np.flatnonzero(counts):
+        rows.append({
+            "start": time.strftime("%Y-%m-%d %H:%M", time.localtime((first + g) * seconds)),
+            "runs": int(counts[g]),
+            "total_cost": float(cost[g]),
+            "turns_p50": float(turns_p50[g]),
+        })
+    return rows
+
+
+def tool_mix(table: RunTable) -> list[tuple[str, int, float, float]]:
+    """ツールごとの (名前, 呼び出し回数, 構成比, 使用した実行の割合)"""
+    totals = table.tool_counts.sum(axis=0)
+    used = (table.tool_counts > 0).mean(axis=0) if len(table) else np.zeros(len(totals))
+    share = totals / max(totals.sum(), 1)
+    order = np.argsort(-totals)
+    return [(table.tool_names[i], int(totals[i]), float(share[i]), float(used[i])) for i in order]
+
+
+# =============================================================================
+# 表示
+# =============================================================================
+
+def print_report(table: RunTable, group: Optional[str], period: Optional[str]):
+    summary = summarize(table)
+
+    print("=" * 70)
+    print("📊 実行履歴レポート")
+    print("=" * 70)
+    print(f"実行数: {summary['runs']}, エラー率: {summary['error_rate']:.1%}")
+    if "turn_utilization_p50" in summary:
+        print(f"ターン上限の使用率 (p50): {summary['turn_utilization_p50']:.0%}")
+
+    print(f"\n{'':<14} {'合計':>12} {'平均':>10} {'p50':>10} {'p90':>10} {'p99':>10}")
+    print("-" * 70)
+    for name, title in [("num_turns", "ターン数"), ("cost_usd", "コスト($)"), ("duration_ms", "時間(ms)"), ("tool_calls", "ツール呼出")]:
+        s = summary[name]
+        print(f"{title:<14} {s['total']:>12.2f} {s['mean']:>10.3f} {s['p50']:>10.3f} {s['p90']:>10.3f} {s['p99']:>10.3f}")
+
+    mix = tool_mix(table)
+    if mix:
+        print("\n【ツール構成】")
+        for name, total, share, used in mix:
+            print(f"  {name:<12} {total:>8}回 ({share:5.1%})  使用した実行: {used:5.1%}")
+
+    if group:
+        print(f"\n【{group} 別】")
+        print(f"  {group:<16} {'実行':>7} {'合計($)':>10} {'エラー':>7} {'ターン p50/p90':>15} {'コスト p50/p90':>17}")
+        for row in group_by(table, group):
+            print(
+                f"  {row[group]:<16} {row['runs']:>7} {row['total_cost']:>10.2f} {row['error_rate']:>7.1%}"
+                f" {row['turns']['p50']:>7.0f}/{row['turns']['p90']:<7.0f} {row['cost']['p50']:>8.4f}/{row['cost']['p90']:<8.4f}"
+            )
+
+    if period:
+        print(f"\n【推移 ({period})】")
+        for row in trend(table, period):
+            print(f"  {row['start']}  {row['runs']:>7}実行  ${row['total_cost']:>9.2f}  ターン p50 {row['turns_p50']:.0f}")
+
+
+# =============================================================================
+# サンプルデータとベンチマーク
+# =============================================================================
+
+def synthetic_records(runs: int, days: int = 14, seed: int = 0) -> list[dict]:
+    """モード・ペルソナ・タスクごとに傾向の異なる実行履歴"""
+    rng = random.Random(seed)
+    modes = {"qa": (3, 5), "development": (20, 50), "automation": (40, 100), "analysis": (15, 30)}
+    personas = ["reviewer", "developer", "operator"]
+    tasks = ["analysis", "refactor", "bugfix", "docs", "test"]
+    tools = ["Read", "Grep", "Glob", "Edit", "Write", "Bash"]
+    now = time.time()
+
+    records = []
+    for _ in range(runs):
+        mode = rng.choice(list(modes))
+        typical, max_turns = modes[mode]
+        turns = max(1, min(max_turns, int(rng.lognormvariate(0, 0.5) * typical)))
+        used_tools = rng.sample(tools, rng.randint(1, 4))
+        records.append({
+            "run_id": uuid.uuid4().hex,
+            "started_at": now - rng.random() * days * 86400,
+            "mode": mode,
+            "persona": rng.choice(personas),
+            "task": rng.choice(tasks),
+            "num_turns": turns,
+            "max_turns": max_turns,
+            "cost_usd": round(turns * rng.uniform(0.002, 0.006), 6),
+            "duration_ms": turns * rng.uniform(800, 3000),
+            "subtype": "error_max_turns" if turns == max_turns else "success",
+            "tools": {name: rng.randint(1, max(1, turns // 2)) for name in used_tools},
+        })
+    return records
+
+
+def python_group_by(records: list[dict], label: str) -> dict:
+    """Python のループによる集計（比較用）"""
+    groups: dict[str, list[dict]] = {}
+    for record in records:
+        groups.setdefault(record[label], []).append(record)
+    result = {}
+    for value, rows in groups.items():
+        turns = sorted(r["num_turns"] for r in rows)
+        costs = sorted(r["cost_usd"] for r in rows)
+        result[value] = {
+            "runs": len(rows),
+            "total_cost": sum(costs),
+            "turns_p90": turns[int((len(turns) - 1) * 0.9)],
+            "cost_p90": costs[int((len(costs) - 1) * 0.9)],
+        }
+    return result
+
+
+def benchmark(args: argparse.Namespace):
+    print("=" * 60)
+    print("実行履歴レポート ベンチマーク")
+    print("=" * 60)
+    print(f"実行数: {args.runs}")
+    print("=" * 60)
+
+    records = synthetic_records(args.runs)
+
+    def timed(func, *func_args) -> float:
+        start = time.perf_counter()
+        func(*func_args)
+        return (time.perf_counter() - start) * 1000
+
+    build_ms = timed(RunTable.from_records, records)
+    table = RunTable.from_records(records)
+
+    rows = [
+        ("配列の構築", build_ms),
+        ("サマリー", timed(summarize, table)),
+        ("mode 別", timed(group_by, table, "mode")),
+        ("task 別", timed(group_by, table, "task")),
+        ("日ごとの推移", timed(trend, table, "day")),
+        ("ツール構成", timed(tool_mix, table)),
+        ("task 別 (Python)", timed(python_group_by, records, "task")),
+    ]
+    print(f"\n{'処理':<20} {'時間(ms)':>10}")
+    print("-" * 32)
+    for name, elapsed in rows:
+        print(f"{name:<20} {elapsed:>10.1f}")
+    print("-" * 32)
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="実行履歴のレポート"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    report = subparsers.add_parser("report", help="実行履歴を集計して表示")
+    report.add_argument("paths", nargs="+", help="実行履歴 (JSONL) のパス")
+
+    demo = subparsers.add_parser("demo", help="サンプルの実行履歴を集計して表示 (引数なしのときの動作)")
+    demo.add_argument("--runs", type=int, default=2000, help="実行数 (default: 2000)")
+
+    for sub in (report, demo):
+        sub.add_argument(
+            "-g", "--group-by",
+            choices=LABELS,
+            help="ラベル別に集計"
+        )
+        sub.add_argument(
+            "--trend",
+            choices=list(TRENDS),
+            help="期間ごとの推移を表示"
+        )
+        sub.add_argument(
+            "--filter",
+            action="append",
+            default=[],
+            metavar="LABEL=VALUE",
+            help="ラベルで絞り込み (例: mode=automation)"
+        )
+        sub.add_argument(
+            "--json",
+            action="store_true",
+            help="JSON で出力"
+        )
+
+    generate = subparsers.add_parser("generate", help="サンプルの実行履歴を作成")
+    generate.add_argument("path", help="書き込む JSONL のパス")
+    generate.add_argument("--runs", type=int, default=5000, help="実行数 (default: 5000)")
+
+    bench = subparsers.add_parser("benchmark", help="集計の処理時間を計測")
+    bench.add_argument("--runs", type=int, default=100000, help="実行数 (default: 100000)")
+
+    args = parser.parse_args()
+    if args.command is None:
+        args = parser.parse_args(["demo", "--group-by", "mode"])
+    for condition in getattr(args, "filter", []):
+        label, sep, value = condition.partition("=")
+        if not sep or label not in LABELS:
+            parser.error(f"--filter は LABEL=VALUE の形式で、LABEL は {', '.join(LABELS)} のいずれかです: {condition}")
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "generate":
+        with open(args.path, "w", encoding="utf-8") as f:
+            for record in synthetic_records(args.runs):
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"{args.runs}件の実行履歴を作成しました: {args.path}")
+
+    elif args.command == "benchmark":
+        benchmark(args)
+
+    else:
+        if args.command == "demo":
+            table = RunTable.from_records(synthetic_records(args.runs))
+        else:
+            table = RunTable.load(Path(p) for p in args.paths)
+        for condition in args.filter:
+            label, _, value = condition.partition("=")
+            table = table.filter(label, value)
+
+        if args.json:
+            output = {"summary": summarize(table), "tools": tool_mix(table)}
+            if args.group_by:
+                output["groups"] = group_by(table, args.group_by)
+            if args.trend:
+                output["trend"] = trend(table, args.trend)
+            print(json.dumps(output, ensure_ascii=False, indent=2))
+        else:
+            print_report(table, args.group_by, args.trend)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,488 @@
+"""
+実行前のコスト・所要時間の予測
+
+ジョブを実行する前に、コストと所要時間の p50/p90 を予測します。
+予測は次の要素を組み合わせます。
+
+- TurnEstimator によるターン数の推定と、モードごとの「実際 / 推定」の比の分布
+- モード (01_basic.py の MODE_OPTIONS) ごとの1ターンあたりのコスト・所要時間の分布
+- ツール数とシステムプロンプトの長さ（毎ターン送られるため1ターンのコストに効く）
+
+予測を BudgetManager の残り予算と比べて、実行・延期・却下を判定できます。
+予測と実績の誤差をログに残し、errors で p90 の的中率や偏りを確認して調整します。
+
+Usage:
+    python 06_forecast.py forecast -m analysis -p "src/を分析して" --history runs.jsonl
+    python 06_forecast.py forecast -m refactor -p "全ファイルをリファクタリングして" --budget 0.50
+    python 06_forecast.py run -m file-read -p "README.mdを読んで" --history runs.jsonl --log forecasts.jsonl
+    python 06_forecast.py errors --log forecasts.jsonl
+    python 06_forecast.py evaluate
+    python 06_forecast.py            (引数なしは evaluate と同じ)
+
+実行履歴は 05_report.py と同じ JSONL 形式です（mode, prompt, allowed_tools,
+system_prompt_chars, num_turns, cost_usd, duration_ms を使います）。
+evaluate で --history を省略すると合成した実行履歴を使います。forecast / run で
+履歴がなければ、既定値 (prior) で予測します。
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import random
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import numpy as np
+from claude_agent_sdk import ClaudeAgentOptions, query, ResultMessage, ToolUseBlock, AssistantMessage
+
+basic = importlib.import_module("01_basic")
+budget_control = importlib.import_module("03_budget_control")
+adaptive = importlib.import_module("04_adaptive")
+report = importlib.import_module("05_report")
+
+QUANTILES = (50, 90)
+
+
+@dataclass
+class Forecast:
+    """1つのジョブの予測"""
+    mode: str
+    estimated_turns: int
+    turns_p50: float
+    turns_p90: float
+    cost_p50: float
+    cost_p90: float
+    seconds_p50: float
+    seconds_p90: float
+    samples: int
+    source: str  # mode: モードの履歴, pooled: 全モードの履歴, prior: 履歴なし
+
+
+def features(allowed_tools: Optional[list], system_prompt_chars: int) -> np.ndarray:
+    """1ターンあたりのコスト・所要時間の説明変数"""
+    return np.array([1.0, len(allowed_tools or []), system_prompt_chars / 1000])
+
+
+def system_prompt_chars(options: ClaudeAgentOptions) -> int:
+    prompt = options.system_prompt
+    return len(prompt) if isinstance(prompt, str) else 0
+
+
+class CostForecaster:
+    """
+    実行履歴からコストと所要時間の分布を予測する
+
+    履歴の各実行から (実際のターン数 / 推定ターン数, 1ターンのコスト, 1ターンの所要時間)
+    を取り出し、モードごとにブートストラップで組み合わせて分布を作ります。
+    ツール数やシステムプロンプトの長さが違う実行の値は、全履歴で当てはめた
+    線形モデルの比で補正してから使います。モードの履歴が min_samples 件未満なら
+    全モードの履歴を使い、履歴がなければ prior_cost_per_turn / prior_seconds_per_turn を使います。
+    """
+
+    def __init__(
+        self,
+        estimator: Optional["adaptive.TurnEstimator"] = None,
+        min_samples: int = 20,
+        draws: int = 2000,
+        prior_cost_per_turn: float = 0.01,
+        prior_seconds_per_turn: float = 5.0,
+        seed: int = 0
+    ):
+        self.estimator = estimator or adaptive.TurnEstimator()
+        self.min_samples = min_samples
+        self.draws = draws
+        self.prior_cost_per_turn = prior_cost_per_turn
+        self.prior_seconds_per_turn = prior_seconds_per_turn
+        self.rng = np.random.default_rng(seed)
+        self.modes = np.array([], dtype=object)
+        self.estimated = np.array([])
+        self.ratios = np.array([])
+        self.cost_per_turn = np.array([])
+        self.seconds_per_turn = np.array([])
+        self.x = np.zeros((0, 3))
+        self.cost_coef = np.zeros(3)
+        self.seconds_coef = np.zeros(3)
+
+    def fit(self, records: list[dict]) -> "CostForecaster":
+        """実行履歴から分布と補正用の線形モデルを作る"""
+        records = [r for r in records if r.get("num_turns") and r.get("prompt")]
+        if not records:
+            return self
+        estimates = self.estimator.estimate_batch([r["prompt"] for r in records])
+        estimated = np.array([e["estimated_turns"] for e in estimates], dtype=float)
+        turns = np.array([r["num_turns"] for r in records], dtype=float)
+
+        self.modes = np.array([r.get("mode") or "" for r in records], dtype=object)
+        self.estimated = estimated
+        self.ratios = turns / np.maximum(estimated, 1)
+        self.cost_per_turn = np.array([r.get("cost_usd") or 0.0 for r in records]) / turns
+        self.seconds_per_turn = np.array([r.get("duration_ms") or 0.0 for r in records]) / 1000 / turns
+        self.x = np.array([
+            features(r.get("allowed_tools"), r.get("system_prompt_chars") or 0) for r in records
+        ])
+        self.cost_coef = np.linalg.lstsq(self.x, self.cost_per_turn, rcond=None)[0]
+        self.seconds_coef = np.linalg.lstsq(self.x, self.seconds_per_turn, rcond=None)[0]
+        return self
+
+    def _adjusted(self, values: np.ndarray, coef: np.ndarray, rows: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """履歴の値を、予測するジョブのツール数・システムプロンプト長に合わせて補正"""
+        fitted = self.x[rows] @ coef
+        target = x @ coef
+        if target <= 0 or np.any(fitted <= 0):
+            return values[rows]
+        return values[rows] * (target / fitted)
+
+    def forecast(
+        self,
+        prompt: str,
+        mode: str = "file-read",
+        options: Optional[ClaudeAgentOptions] = None
+    ) -> Forecast:
+        """prompt を mode で実行した場合のターン数・コスト・所要時間を予測"""
+        options = options or basic.MODE_OPTIONS[mode]
+        estimated = self.estimator.estimate(prompt)
+        max_turns = options.max_turns or 100
+        x = features(options.allowed_tools, system_prompt_chars(options))
+
+        rows = np.flatnonzero(self.modes == mode)
+        source = "mode"
+        if len(rows) < self.min_samples:
+            rows = np.arange(len(self.modes))
+            source = "pooled"
+        if len(rows) == 0:
+            turns = np.full(1, float(min(estimated, max_turns)))
+            cost = turns * self.prior_cost_per_turn
+            seconds = turns * self.prior_seconds_per_turn
+            source = "prior"
+        else:
+            # 推定が近い履歴ほど外れ方も似ているので、ターン数の比は推定値が同程度の履歴から引く
+            near = rows[np.abs(np.log(self.estimated[rows] / estimated)) <= math.log(1.5)]
+            ratio_rows = self.rng.choice(near if len(near) >= self.min_samples else rows, self.draws)
+            unit_rows = self.rng.choice(rows, self.draws)
+            turns = np.clip(np.round(estimated * self.ratios[ratio_rows]), 1, max_turns)
+            cost = turns * self._adjusted(self.cost_per_turn, self.cost_coef, unit_rows, x)
+            seconds = turns * self._adjusted(self.seconds_per_turn, self.seconds_coef, unit_rows, x)
+
+        t50, t90 = np.percentile(turns, QUANTILES)
+        c50, c90 = np.percentile(cost, QUANTILES)
+        s50, s90 = np.percentile(seconds, QUANTILES)
+        return Forecast(
+            mode=mode,
+            estimated_turns=estimated,
+            turns_p50=float(t50), turns_p90=float(t90),
+            cost_p50=float(c50), cost_p90=float(c90),
+            seconds_p50=float(s50), seconds_p90=float(s90),
+            samples=len(rows),
+            source=source,
+        )
+
+
+def admit(forecast: Forecast, budget: "budget_control.BudgetManager") -> tuple[str, str]:
+    """
+    予測と残り予算から実行の可否を判定
+
+    Returns:
+        (decision, reason)  decision は admit / reschedule / reject
+    """
+    remaining = budget.get_remaining()["remaining_cost"]
+    if forecast.cost_p90 <= remaining:
+        return "admit", f"p90 ${forecast.cost_p90:.4f} ≤ 残り ${remaining:.4f}"
+    if forecast.cost_p50 <= remaining:
+        return "reschedule", f"p50 ${forecast.cost_p50:.4f} ≤ 残り ${remaining:.4f} < p90 ${forecast.cost_p90:.4f}"
+    return "reject", f"p50 ${forecast.cost_p50:.4f} > 残り ${remaining:.4f}"
+
+
+# =============================================================================
+# 予測と実績のログ
+# =============================================================================
+
+def log_forecast(path: str, forecast: Forecast, prompt: str, actual: dict):
+    """予測と実績を1行追記（actual: num_turns, cost_usd, duration_ms）"""
+    entry = {
+        "forecast_id": uuid.uuid4().hex,
+        "logged_at": time.time(),
+        "prompt": prompt,
+        **asdict(forecast),
+        "actual_turns": actual["num_turns"],
+        "actual_cost": actual["cost_usd"],
+        "actual_seconds": actual["duration_ms"] / 1000,
+    }
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def forecast_errors(entries: list[dict]) -> dict:
+    """
+    予測の誤差を指標ごとにまとめる
+
+    coverage : 実績が p90 以下だった割合（0.9 前後が目安。低ければ分布が狭すぎる）
+    bias     : log(実績 / p50) の中央値（正なら過小予測）
+    mape     : |実績 - p50| / 実績 の中央値
+    """
+    result = {}
+    for metric in ["turns", "cost", "seconds"]:
+        actual = np.array([e[f"actual_{metric}"] for e in entries], dtype=float)
+        p50 = np.array([e[f"{metric}_p50"] for e in entries], dtype=float)
+        p90 = np.array([e[f"{metric}_p90"] for e in entries], dtype=float)
+        valid = (actual > 0) & (p50 > 0)
+        result[metric] = {
+            "coverage": float(np.mean(actual <= p90)) if len(actual) else float("nan"),
+            "bias": float(np.median(np.log(actual[valid] / p50[valid]))) if valid.any() else float("nan"),
+            "mape": float(np.median(np.abs(actual[valid] - p50[valid]) / actual[valid])) if valid.any() else float("nan"),
+        }
+    return result
+
+
+def print_errors(entries: list[dict], title: str = "予測誤差"):
+    print(f"\n{title} ({len(entries)}件)")
+    print(f"{'指標':<10} {'p90 的中率':>11} {'偏り':>8} {'誤差(中央値)':>14}")
+    print("-" * 48)
+    for metric, e in forecast_errors(entries).items():
+        print(f"{metric:<10} {e['coverage']:>11.1%} {e['bias']:>+8.2f} {e['mape']:>14.1%}")
+    print("-" * 48)
+
+
+# =============================================================================
+# 合成データでの評価
+# =============================================================================
+
+def synthetic_runs(count: int, seed: int = 0) -> list[dict]:
+    """
+    モードごとの実行履歴を合成
+
+    ターン数は 04_adaptive.synthetic_history と同じ傾向で、モードの max_turns で打ち切ります。
+    1ターンのコストと所要時間はツール数とシステムプロンプトの長さで増え、
+    モードごとに異なるばらつきを持たせます。
+    """
+    rng = random.Random(seed)
+    history = adaptive.synthetic_history(count, seed)
+    modes = list(basic.MODE_OPTIONS)
+    noise = {mode: 0.2 + 0.4 * i / len(modes) for i, mode in enumerate(modes)}
+
+    runs = []
+    for record in history:
+        mode = rng.choice(modes)
+        options = basic.MODE_OPTIONS[mode]
+        tools = options.allowed_tools or []
+        chars = system_prompt_chars(options)
+        turns = min(record["num_turns"], options.max_turns)
+        cost_per_turn = (0.004 + 0.0015 * len(tools) + 0.01 * chars / 1000) * rng.lognormvariate(0, noise[mode])
+        seconds_per_turn = (2.0 + 0.4 * len(tools) + 1.5 * chars / 1000) * rng.lognormvariate(0, noise[mode])
+        runs.append({
+            "mode": mode,
+            "prompt": record["prompt"],
+            "allowed_tools": tools,
+            "system_prompt_chars": chars,
+            "num_turns": turns,
+            "max_turns": options.max_turns,
+            "cost_usd": turns * cost_per_turn,
+            "duration_ms": turns * seconds_per_turn * 1000,
+        })
+    return runs
+
+
+def evaluate(records: list[dict], log_path: Optional[str] = None):
+    """前半で学習し、後半の実行の予測誤差を従来の見積もりと比較"""
+    split = len(records) * 2 // 3
+    train, test = records[:split], records[split:]
+    forecaster = CostForecaster().fit(train)
+
+    # 従来: TurnEstimator の推定ターン数 × BudgetManager の1ターンあたりの単価
+    cost_per_turn = budget_control.BudgetManager(max_cost_usd=1.0, max_turns=1).cost_per_turn
+
+    entries, baseline = [], []
+    for record in test:
+        forecast = forecaster.forecast(record["prompt"], record["mode"])
+        actual = {k: record[k] for k in ("num_turns", "cost_usd", "duration_ms")}
+        entry = {
+            **asdict(forecast),
+            "actual_turns": record["num_turns"],
+            "actual_cost": record["cost_usd"],
+            "actual_seconds": record["duration_ms"] / 1000,
+        }
+        entries.append(entry)
+        point = forecast.estimated_turns * cost_per_turn
+        baseline.append({
+            **entry,
+            "turns_p50": forecast.estimated_turns, "turns_p90": forecast.estimated_turns,
+            "cost_p50": point, "cost_p90": point,
+            "seconds_p50": float("nan"), "seconds_p90": float("nan"),
+        })
+        if log_path:
+            log_forecast(log_path, forecast, record["prompt"], actual)
+
+    print("=" * 60)
+    print(f"予測の評価: 学習 {len(train)}件, 評価 {len(test)}件")
+    print("=" * 60)
+    print_errors(baseline, "従来 (推定ターン数 × $0.01)")
+    print_errors(entries, "CostForecaster")
+
+    print(f"\n{'モード':<12} {'件数':>5} {'コスト p90 的中率':>16} {'コスト誤差':>10} {'時間 p90 的中率':>15}")
+    print("-" * 64)
+    modes = np.array([e["mode"] for e in entries])
+    for mode in basic.MODE_OPTIONS:
+        rows = [e for e, m in zip(entries, modes) if m == mode]
+        if not rows:
+            continue
+        errors = forecast_errors(rows)
+        print(
+            f"{mode:<12} {len(rows):>5} {errors['cost']['coverage']:>16.1%}"
+            f" {errors['cost']['mape']:>10.1%} {errors['seconds']['coverage']:>15.1%}"
+        )
+    print("-" * 64)
+
+
+# =============================================================================
+# 予測してから実行
+# =============================================================================
+
+async def run_with_forecast(args: argparse.Namespace):
+    """予測 → 判定 → 実行 → 実績を実行履歴と予測ログに記録"""
+    forecaster = load_forecaster(args.history)
+    forecast = forecaster.forecast(args.prompt, args.mode)
+    print_forecast(forecast)
+
+    budget = budget_control.BudgetManager(max_cost_usd=args.budget, max_turns=10000)
+    decision, reason = admit(forecast, budget)
+    print(f"\n判定: {decision} ({reason})")
+    if decision != "admit" and not args.force:
+        return
+
+    options = basic.MODE_OPTIONS[args.mode]
+    tools: dict[str, int] = {}
+    result = None
+    async for message in query(prompt=args.prompt, options=options):
+        if isinstance(message, AssistantMessage):
+            for block in message.content:
+                if isinstance(block, ToolUseBlock):
+                    tools[block.name] = tools.get(block.name, 0) + 1
+        elif isinstance(message, ResultMessage):
+            result = message
+    if result is None:
+        return
+
+    actual = {
+        "num_turns": result.num_turns,
+        "cost_usd": result.total_cost_usd or 0.0,
+        "duration_ms": result.duration_ms,
+    }
+    print(f"\n実績: {actual['num_turns']}ターン, ${actual['cost_usd']:.4f}, {actual['duration_ms'] / 1000:.1f}秒")
+    if args.log:
+        log_forecast(args.log, forecast, args.prompt, actual)
+    if args.history:
+        report.record_run(
+            args.history[0],
+            tools=tools,
+            subtype=result.subtype,
+            max_turns=options.max_turns,
+            prompt=args.prompt,
+            allowed_tools=options.allowed_tools,
+            system_prompt=options.system_prompt if isinstance(options.system_prompt, str) else None,
+            mode=args.mode,
+            **actual
+        )
+
+
+def load_records(paths: list[str]) -> list[dict]:
+    """実行履歴を読み込む（存在しないファイルは空として扱う）"""
+    records = []
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+        except FileNotFoundError:
+            pass
+    return records
+
+
+def load_forecaster(paths: list[str]) -> CostForecaster:
+    """
+    実行履歴から予測器を作る
+
+    履歴がなければ合成データは使わず、既定値 (prior) で予測することを表示します。
+    """
+    records = load_records(paths)
+    if not records:
+        where = ", ".join(paths) if paths else "--history 未指定"
+        print(f"⚠️ 実行履歴がありません ({where})。既定値 (prior) で予測します")
+    return CostForecaster().fit(records)
+
+
+def print_forecast(forecast: Forecast):
+    print("=" * 60)
+    print(f"予測: {forecast.mode} (推定 {forecast.estimated_turns}ターン, 履歴 {forecast.samples}件, {forecast.source})")
+    print("=" * 60)
+    print(f"{'':<10} {'p50':>10} {'p90':>10}")
+    print(f"{'ターン':<10} {forecast.turns_p50:>10.0f} {forecast.turns_p90:>10.0f}")
+    print(f"{'コスト($)':<10} {forecast.cost_p50:>10.4f} {forecast.cost_p90:>10.4f}")
+    print(f"{'時間(秒)':<10} {forecast.seconds_p50:>10.1f} {forecast.seconds_p90:>10.1f}")
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(description="実行前のコスト・所要時間の予測")
+    sub = parser.add_subparsers(dest="command")
+
+    def add_job_args(p: argparse.ArgumentParser):
+        p.add_argument("-m", "--mode", choices=list(basic.MODE_OPTIONS), default="file-read",
+                       help="01_basic.py のモード (default: file-read)")
+        p.add_argument("-p", "--prompt", default="このディレクトリの Python ファイルを探して内容を確認してください",
+                       help="予測するプロンプト")
+        p.add_argument("--history", nargs="*", default=[],
+                       help="実行履歴 (JSONL)。履歴がなければ既定値 (prior) で予測")
+        p.add_argument("--budget", type=float, default=1.0,
+                       help="残り予算 (USD)。予測と比べて実行の可否を判定 (default: 1.0)")
+
+    p = sub.add_parser("forecast", help="コスト・所要時間を予測")
+    add_job_args(p)
+
+    p = sub.add_parser("run", help="予測してから実行し、実績を記録")
+    add_job_args(p)
+    p.add_argument("--log", help="予測と実績を追記するファイル (JSONL)")
+    p.add_argument("--force", action="store_true", help="判定が admit でなくても実行")
+
+    p = sub.add_parser("errors", help="予測ログの誤差を集計")
+    p.add_argument("--log", required=True, help="予測ログ (JSONL)")
+
+    p = sub.add_parser("evaluate", help="実行履歴を学習・評価に分けて予測誤差を計測")
+    p.add_argument("--history", nargs="*", default=[], help="実行履歴 (JSONL)。省略すると合成データを使用")
+    p.add_argument("--runs", type=int, default=3000, help="合成データの件数 (default: 3000)")
+    p.add_argument("--log", help="評価した予測と実績を追記するファイル (JSONL)")
+    args = parser.parse_args()
+    if args.command is None:
+        # 引数なしでは合成データで評価する
+        args = parser.parse_args(["evaluate"])
+    return args
+
+
+async def main():
+    args = parse_args()
+
+    if args.command == "forecast":
+        forecaster = load_forecaster(args.history)
+        forecast = forecaster.forecast(args.prompt, args.mode)
+        print_forecast(forecast)
+        budget = budget_control.BudgetManager(max_cost_usd=args.budget, max_turns=10000)
+        decision, reason = admit(forecast, budget)
+        print(f"\n判定: {decision} ({reason})")
+
+    elif args.command == "run":
+        await run_with_forecast(args)
+
+    elif args.command == "errors":
+        with open(args.log, encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        print_errors(entries)
+
+    elif args.command == "evaluate":
+        records = load_records(args.history) if args.history else synthetic_runs(args.runs)
+        if not records:
+            raise SystemExit(f"実行履歴がありません: {', '.join(args.history)}")
+        evaluate(records, args.log)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
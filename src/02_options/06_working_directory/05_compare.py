@@ -0,0 +1,354 @@
+"""
+オプションの並列比較 (分離した作業ディレクトリ)
+
+Usage:
+    python 05_compare.py -s src/02_options/03_permission_mode/01_basic.py -p "README.mdを更新して"
+    python 05_compare.py -s src/02_options/04_max_turns/01_basic.py --modes file-read analysis --runs 3
+    python 05_compare.py -s src/02_options/03_permission_mode/02_accept_edits.py --attr TASK_OPTIONS
+    python 05_compare.py --bench
+
+Options:
+    -s, --script      : MODE_OPTIONS を定義しているスクリプト (02_options 以下)
+    --attr            : 比較するオプション辞書の名前 (default: MODE_OPTIONS)
+    --modes           : 比較するモード (default: すべて)
+    --runs            : モードごとの繰り返し回数 (default: 1)
+    --concurrency     : 同時に実行する数 (default: すべて同時)
+    --source          : コピーする作業ディレクトリ (default: カレントディレクトリ)
+    --bench           : スタンドイン CLI で、同じディレクトリでの逐次実行と比較
+
+各実行は作業ディレクトリを一時ディレクトリにコピーし、cwd をそのコピーに
+差し替えて実行します。ほかのモードの編集が見えることはなく、元の
+作業ディレクトリも変更されません。
+"""
+import argparse
+import asyncio
+import dataclasses
+import hashlib
+import importlib.util
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from claude_agent_sdk import ClaudeAgentOptions, query, AssistantMessage, ResultMessage, ToolUseBlock
+
+# コピーしないディレクトリ
+COPY_IGNORE = [".git", "__pycache__", ".venv", "node_modules"]
+
+# ベンチマーク用のスタンドイン CLI (test/fake_claude_cli.py)
+FAKE_CLI_PATH = Path(__file__).resolve().parents[3] / "test" / "fake_claude_cli.py"
+
+# ベンチマークで比較するスクリプト
+BENCH_SCRIPT = Path(__file__).resolve().parents[1] / "03_permission_mode" / "01_basic.py"
+
+
+# =============================================================================
+# オプションの読み込み
+# =============================================================================
+
+def load_options(script: str | Path, attr: str = "MODE_OPTIONS") -> dict[str, ClaudeAgentOptions]:
+    """スクリプトからモード名 → ClaudeAgentOptions の辞書を読み込む"""
+    script = Path(script).resolve()
+    # スクリプト内の importlib.import_module("01_basic") などが解決できるように
+    sys.path.insert(0, str(script.parent))
+    try:
+        spec = importlib.util.spec_from_file_location(script.stem, script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(script.parent))
+
+    variants = getattr(module, attr, None)
+    if not isinstance(variants, dict):
+        raise ValueError(f"{script.name} に {attr} (dict) がありません")
+    return variants
+
+
+# =============================================================================
+# 分離した作業ディレクトリでの実行
+# =============================================================================
+
+def snapshot(root: Path) -> dict[str, str]:
+    """作業ディレクトリの各ファイルのハッシュ"""
+    hashes = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in COPY_IGNORE]
+        for name in filenames:
+            path = Path(dirpath) / name
+            if path.is_file():
+                hashes[path.relative_to(root).as_posix()] = hashlib.sha256(path.read_bytes()).hexdigest()
+    return hashes
+
+
+def count_changes(before: dict[str, str], after: dict[str, str]) -> int:
+    """追加・変更・削除されたファイル数"""
+    return sum(1 for path in before.keys() | after.keys() if before.get(path) != after.get(path))
+
+
+@dataclass
+class RunResult:
+    """1回の実行結果"""
+    variant: str
+    run: int
+    turns: int = 0
+    cost: float = 0.0
+    tools: list[str] = field(default_factory=list)
+    latency: float = 0.0
+    changed: int = 0
+    error: Optional[str] = None
+
+
+async def run_isolated(
+    variant: str,
+    options: ClaudeAgentOptions,
+    prompt: str,
+    source: Path,
+    run: int = 0,
+) -> RunResult:
+    """作業ディレクトリのコピーで1回実行"""
+    result = RunResult(variant=variant, run=run)
+    with tempfile.TemporaryDirectory(prefix=f"compare-{variant}-") as tmp_dir:
+        sandbox = Path(tmp_dir) / source.name
+        await asyncio.to_thread(
+            shutil.copytree, source, sandbox, symlinks=True,
+            ignore=shutil.ignore_patterns(*COPY_IGNORE),
+        )
+        before = await asyncio.to_thread(snapshot, sandbox)
+        options = dataclasses.replace(options, cwd=str(sandbox))
+
+        start = time.perf_counter()
+        try:
+            async for message in query(prompt=prompt, options=options):
+                if isinstance(message, AssistantMessage):
+                    for block in message.content:
+                        if isinstance(block, ToolUseBlock):
+                            result.tools.append(block.name)
+                elif isinstance(message, ResultMessage):
+                    result.turns = message.num_turns
+                    result.cost = message.total_cost_usd or 0.0
+                    if message.is_error:
+                        result.error = message.subtype
+        except Exception as e:
+            # 1つのモードが失敗しても、ほかのモードの比較は続ける
+            result.error = f"{type(e).__name__}: {e}"
+        result.latency = time.perf_counter() - start
+        result.changed = count_changes(before, await asyncio.to_thread(snapshot, sandbox))
+    return result
+
+
+async def compare_variants(
+    variants: dict[str, ClaudeAgentOptions],
+    prompt: str,
+    runs: int = 1,
+    source: Optional[str | Path] = None,
+    concurrency: Optional[int] = None,
+) -> dict[str, list[RunResult]]:
+    """各モードを runs 回ずつ、それぞれ別のコピーで並列に実行"""
+    source = Path(source or os.getcwd()).resolve()
+    semaphore = asyncio.Semaphore(concurrency or len(variants) * runs)
+
+    async def bounded(name: str, options: ClaudeAgentOptions, run: int) -> RunResult:
+        async with semaphore:
+            return await run_isolated(name, options, prompt, source, run)
+
+    results = await asyncio.gather(*(
+        bounded(name, options, run)
+        for run in range(runs)
+        for name, options in variants.items()
+    ))
+
+    grouped: dict[str, list[RunResult]] = {name: [] for name in variants}
+    for result in results:
+        grouped[result.variant].append(result)
+    return grouped
+
+
+# =============================================================================
+# 集計
+# =============================================================================
+
+def spread(values: list[float], fmt: str) -> str:
+    """平均 ± 標準偏差"""
+    mean = statistics.mean(values)
+    if len(values) < 2:
+        return format(mean, fmt)
+    return f"{format(mean, fmt)} ± {format(statistics.stdev(values), fmt)}"
+
+
+def print_comparison(grouped: dict[str, list[RunResult]]):
+    """モードごとの平均 ± 標準偏差を1つの表にまとめる"""
+    runs = max(len(results) for results in grouped.values())
+    print(f"\n{'モード':<20} {'ターン':>12} {'コスト($)':>18} {'ツール呼び出し':>12} {'時間(s)':>14} {'変更':>6} {'失敗':>4}")
+    print("-" * 96)
+    for name, results in grouped.items():
+        ok = [r for r in results if r.error is None] or results
+        print(
+            f"{name:<20} {spread([r.turns for r in ok], '.1f'):>12}"
+            f" {spread([r.cost for r in ok], '.4f'):>18}"
+            f" {spread([len(r.tools) for r in ok], '.1f'):>12}"
+            f" {spread([r.latency for r in ok], '.2f'):>14}"
+            f" {spread([r.changed for r in ok], '.0f'):>6}"
+            f" {sum(r.error is not None for r in results):>4}"
+        )
+    print("-" * 96)
+    if runs > 1:
+        print(f"各モード {runs}回の平均 ± 標準偏差 (失敗した実行は除く)")
+    print("変更: コピーした作業ディレクトリで追加・変更・削除されたファイル数")
+
+    for name, results in grouped.items():
+        for result in results:
+            if result.error:
+                print(f"  ✗ {name} #{result.run + 1}: {result.error}")
+
+
+# =============================================================================
+# ベンチマーク
+# =============================================================================
+
+async def run_in_place(variants: dict[str, ClaudeAgentOptions], prompt: str, runs: int, source: Path):
+    """従来の比較: 同じディレクトリで1つずつ実行"""
+    for _ in range(runs):
+        for options in variants.values():
+            async for _message in query(prompt=prompt, options=dataclasses.replace(options, cwd=str(source))):
+                pass
+
+
+async def benchmark_compare(args: argparse.Namespace):
+    """スタンドイン CLI で、逐次実行と並列・分離実行を比較"""
+    env = {
+        "FAKE_CLI_STARTUP_MS": str(args.startup_ms),
+        "FAKE_CLI_TURN_MS": str(args.turn_ms),
+        "FAKE_CLI_TURNS": str(args.task_turns),
+        "FAKE_CLI_EDIT_STEPS": str(args.edit_steps),
+        "FAKE_CLI_EDIT_FILE": "app.py",
+        # 一部の応答を遅らせて、繰り返しのばらつきを出す
+        "FAKE_CLI_STALL_RATE": "0.2",
+        "FAKE_CLI_STALL_MS": "300",
+    }
+    variants = {
+        name: dataclasses.replace(options, cli_path=str(args.cli_path), env={**options.env, **env})
+        for name, options in load_options(BENCH_SCRIPT).items()
+    }
+    total = len(variants) * args.runs
+
+    print("=" * 96)
+    print(f"スタンドイン CLI: {BENCH_SCRIPT.parent.name}/{BENCH_SCRIPT.name} の {len(variants)}モード × {args.runs}回,"
+          f" 1回 {args.task_turns}ターン (plan は編集の手前で終了), 1ターン {args.turn_ms:.0f}ms")
+    print("=" * 96)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = Path(tmp_dir) / "project"
+        source.mkdir()
+        (source / "app.py").write_text("def main():\n    pass\n", encoding="utf-8")
+
+        before = snapshot(source)
+        start = time.perf_counter()
+        await run_in_place(variants, "parse のバグを修正して", args.runs, source)
+        sequential = time.perf_counter() - start
+        sequential_changed = count_changes(before, snapshot(source))
+        edits = (source / "app.py").read_text(encoding="utf-8").count("step-")
+
+        (source / "app.py").write_text("def main():\n    pass\n", encoding="utf-8")
+        before = snapshot(source)
+        start = time.perf_counter()
+        grouped = await compare_variants(variants, "parse のバグを修正して", runs=args.runs, source=source)
+        parallel = time.perf_counter() - start
+        parallel_changed = count_changes(before, snapshot(source))
+
+    print(f"\n{'方式':<28} {'実行数':>6} {'合計時間(s)':>12} {'元のディレクトリ':>16}")
+    print("-" * 68)
+    print(f"{'同じディレクトリで逐次 (従来)':<28} {total:>6} {sequential:>12.2f} {f'{sequential_changed}ファイル変更 ({edits}行)':>16}")
+    print(f"{'コピーで並列':<28} {total:>6} {parallel:>12.2f} {f'{parallel_changed}ファイル変更':>16}")
+    print("-" * 68)
+
+    print_comparison(grouped)
+
+
+def parse_args() -> argparse.Namespace:
+    """コマンドライン引数をパース"""
+    parser = argparse.ArgumentParser(
+        description="オプションの並列比較 (分離した作業ディレクトリ)"
+    )
+    parser.add_argument(
+        "-s", "--script",
+        help="MODE_OPTIONS を定義しているスクリプト"
+    )
+    parser.add_argument(
+        "--attr",
+        default="MODE_OPTIONS",
+        help="比較するオプション辞書の名前 (default: MODE_OPTIONS)"
+    )
+    parser.add_argument(
+        "-p", "--prompt",
+        default="このプロジェクトを分析して改善点を提案してください",
+        help="実行するプロンプト"
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        help="比較するモード (default: すべて)"
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=1,
+        help="モードごとの繰り返し回数 (default: 1)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="同時に実行する数 (default: すべて同時)"
+    )
+    parser.add_argument(
+        "--source",
+        help="コピーする作業ディレクトリ (default: カレントディレクトリ)"
+    )
+    parser.add_argument(
+        "--bench",
+        action="store_true",
+        help="スタンドイン CLI で、同じディレクトリでの逐次実行と比較"
+    )
+    parser.add_argument("--task-turns", type=int, default=8, help="ベンチマークの1回あたりのターン数 (default: 8)")
+    parser.add_argument("--edit-steps", type=int, default=3, help="ベンチマークの編集ターン数 (default: 3)")
+    parser.add_argument("--turn-ms", type=float, default=100, help="ベンチマークの1ターンの応答時間 (default: 100)")
+    parser.add_argument("--startup-ms", type=float, default=300, help="ベンチマークの CLI 起動時間 (default: 300)")
+    parser.add_argument("--cli-path", type=Path, default=FAKE_CLI_PATH, help="ベンチマークに使う CLI")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    if args.bench:
+        await benchmark_compare(args)
+        return
+
+    if not args.script:
+        print("--script か --bench を指定してください")
+        return
+
+    variants = load_options(args.script, args.attr)
+    if args.modes:
+        unknown = [m for m in args.modes if m not in variants]
+        if unknown:
+            print(f"不明なモード: {', '.join(unknown)} (利用可能: {', '.join(variants)})")
+            return
+        variants = {m: variants[m] for m in args.modes}
+
+    print("=" * 96)
+    print(f"{Path(args.script).name} の {args.attr}: {len(variants)}モード × {args.runs}回")
+    print(f"プロンプト: {args.prompt}")
+    print("=" * 96)
+
+    grouped = await compare_variants(
+        variants, args.prompt, runs=args.runs, source=args.source, concurrency=args.concurrency
+    )
+    print_comparison(grouped)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用の Claude Code CLI スタンドイン
+
+Claude Code CLI と同じ stream-json プロトコル（stdin/stdout）を話す
+ローカルの代替 CLI です。API を呼び出さないため、料金をかけずに
+SDK の接続・再利用・リトライなどの挙動を計測できます。
+
+Usage:
+    ClaudeAgentOptions(
+        cli_path="test/fake_claude_cli.py",
+        env={"FAKE_CLI_STARTUP_MS": "300", "FAKE_CLI_TURN_MS": "20"},
+    )
+
+環境変数:
+    FAKE_CLI_STARTUP_MS    : 起動時の待ち時間 (CLI 起動・ハンドシェイクの模擬) (default: 300)
+    FAKE_CLI_TURN_MS       : 1ターンあたりの応答時間 (default: 20)
+    FAKE_CLI_TURNS         : 1プロンプトあたりのターン数 (default: 1)
+    FAKE_CLI_TOOLS         : ツール呼び出しに使うツール名 (カンマ区切り, default: Read,Grep,Glob)
+    FAKE_CLI_COST_PER_TURN : 1ターンあたりのコスト USD (default: 0.002)
+    FAKE_CLI_CRASH_RATE    : 各ターンでプロセスが異常終了する確率 (default: 0)
+    FAKE_CLI_STALL_RATE    : 最初の応答が遅延する確率 (default: 0)
+    FAKE_CLI_STALL_MS      : 遅延したときの待ち時間 (default: 3000)
+    FAKE_CLI_STATE_DIR     : セッションの進捗を保存するディレクトリ
+                             (指定すると --resume で中断したターンから再開する)
+    FAKE_CLI_TOOL_MS       : 1回のツール実行にかかる時間 (default: 0)
+    FAKE_CLI_CONTEXT_GROWTH: 1ターンごとに増える入力トークン数 (default: 0)
+                             (出力の単価を入力の5倍として、ターンのコストも増える)
+    FAKE_CLI_TTFT_MS       : 1ターンのうち最初のトークンまでの時間 (default: FAKE_CLI_TURN_MS の半分)
+                             (--include-partial-messages 指定時は、このときに stream_event を送る)
+    FAKE_CLI_LOOP_AFTER    : N ターン目以降、N ターン目と同じツール呼び出しを繰り返す (default: 0 = 繰り返さない)
+                             (ループしたエージェントの模擬。max_turns か中断まで終わらない)
+    FAKE_CLI_LOOP_RECOVER  : 1 なら、繰り返しが PreToolUse フックで deny された時点でループを抜ける (default: 0)
+    FAKE_CLI_TEXTS         : ターン番号からテキストへの JSON (例: {"8": "作業は完了しました。"})
+                             (そのターンのツール呼び出しの前にテキストを送る。最後のターンなら最終応答を置き換える)
+    FAKE_CLI_EDIT_STEPS    : 最後の N 回のツール呼び出しを Edit にする (default: 0)
+                             (plan モードでは Edit の手前で計画を返して終わり、完了済みの調査は進捗に残る)
+    FAKE_CLI_EDIT_STEPS_MAX: 指定すると、編集のターン数を FAKE_CLI_EDIT_STEPS〜この値からプロセスごとにランダムに選ぶ
+                             (増えた分だけ FAKE_CLI_TURNS も増やし、調査のターン数は変えない)
+    FAKE_CLI_EDIT_FILE     : 指定すると、Edit のたびに作業ディレクトリのこのファイルへ1行追記する
+
+ツール呼び出しの入力は {"pattern": "step-N"} です。
+プロンプトに step-N が含まれる場合は、その結果を既知として扱い呼び出しを繰り返しません。
+PreToolUse フックが登録されていれば呼び出し前に実行し、deny された場合は
+ツールを実行せずに理由をツール結果として返します。
+"""
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+VERSION = "2.1.0 (Claude Code)"
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+class FakeCLI:
+    """stream-json プロトコルを模擬する CLI"""
+
+    def __init__(self, argv: list[str]):
+        self.args = self.parse_argv(argv)
+        self.startup_ms = env_float("FAKE_CLI_STARTUP_MS", 300)
+        self.turn_ms = env_float("FAKE_CLI_TURN_MS", 20)
+        self.turns = env_int("FAKE_CLI_TURNS", 1)
+        self.tools = os.environ.get("FAKE_CLI_TOOLS", "Read,Grep,Glob").split(",")
+        self.cost_per_turn = env_float("FAKE_CLI_COST_PER_TURN", 0.002)
+        self.crash_rate = env_float("FAKE_CLI_CRASH_RATE", 0)
+        self.stall_rate = env_float("FAKE_CLI_STALL_RATE", 0)
+        self.stall_ms = env_float("FAKE_CLI_STALL_MS", 3000)
+        self.state_dir = os.environ.get("FAKE_CLI_STATE_DIR")
+        self.tool_ms = env_float("FAKE_CLI_TOOL_MS", 0)
+        self.context_growth = env_int("FAKE_CLI_CONTEXT_GROWTH", 0)
+        self.ttft_ms = min(env_float("FAKE_CLI_TTFT_MS", self.turn_ms / 2), self.turn_ms)
+        self.loop_after = env_int("FAKE_CLI_LOOP_AFTER", 0)
+        self.loop_recover = env_int("FAKE_CLI_LOOP_RECOVER", 0) == 1
+        self.edit_steps = env_int("FAKE_CLI_EDIT_STEPS", 0)
+        extra_edits = max(env_int("FAKE_CLI_EDIT_STEPS_MAX", self.edit_steps) - self.edit_steps, 0)
+        if extra_edits:
+            # 同じプロンプトでも、セッションごとに計画の大きさが変わる
+            extra_edits = random.randint(0, extra_edits)
+            self.edit_steps += extra_edits
+            self.turns += extra_edits
+        self.edit_file = os.environ.get("FAKE_CLI_EDIT_FILE")
+        self.texts = {int(k): v for k, v in json.loads(os.environ.get("FAKE_CLI_TEXTS", "{}")).items()}
+
+        self.max_turns = int(self.args.get("--max-turns", 0)) or None
+        self.permission_mode = self.args.get("--permission-mode", "default")
+        self.model = self.args.get("--model", "claude-fake")
+        self.partial = "--include-partial-messages" in self.args
+        self.session_id = (
+            self.args.get("--resume")
+            or self.args.get("--session-id")
+            or str(uuid.uuid4())
+        )
+
+        self.write_lock = threading.Lock()
+        self.prompts: "queue.Queue[str | None]" = queue.Queue()
+        self.interrupted = threading.Event()
+        self.pre_tool_hooks: list[dict] = []
+        self.pending: dict[str, list] = {}
+
+    @staticmethod
+    def parse_argv(argv: list[str]) -> dict:
+        """--key value / --key=value 形式の引数を辞書にする"""
+        args = {}
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            if arg.startswith("--"):
+                if "=" in arg:
+                    key, value = arg.split("=", 1)
+                    args[key] = value
+                elif i + 1 < len(argv) and not argv[i + 1].startswith("--"):
+                    args[arg] = argv[i + 1]
+                    i += 1
+                else:
+                    args[arg] = True
+            i += 1
+        return args
+
+    def emit(self, payload: dict):
+        with self.write_lock:
+            sys.stdout.write(json.dumps(payload, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+
+    def control_success(self, request_id: str, response: dict = None):
+        self.emit({
+            "type": "control_response",
+            "response": {
+                "subtype": "success",
+                "request_id": request_id,
+                "response": response or {},
+            },
+        })
+
+    # ------------------------------------------------------------------
+    # stdin の読み取り
+    # ------------------------------------------------------------------
+
+    def read_stdin(self):
+        """stdin を読み、制御リクエストは即座に応答、プロンプトはキューへ"""
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            msg_type = data.get("type")
+
+            if msg_type == "control_request":
+                self.handle_control(data)
+            elif msg_type == "user":
+                content = data["message"]["content"]
+                if isinstance(content, list):
+                    content = " ".join(
+                        block.get("text", "") for block in content if isinstance(block, dict)
+                    )
+                self.prompts.put(content)
+            elif msg_type == "control_response":
+                response = data["response"]
+                waiter = self.pending.get(response.get("request_id"))
+                if waiter:
+                    waiter[1] = response.get("response") or {}
+                    waiter[0].set()
+
+        self.prompts.put(None)
+
+    def handle_control(self, data: dict):
+        request_id = data["request_id"]
+        request = data["request"]
+        subtype = request.get("subtype")
+
+        if subtype == "initialize":
+            self.pre_tool_hooks = (request.get("hooks") or {}).get("PreToolUse", [])
+            self.control_success(request_id, {"commands": [], "models": []})
+        elif subtype == "interrupt":
+            self.interrupted.set()
+            self.control_success(request_id)
+        elif subtype == "set_permission_mode":
+            self.permission_mode = request.get("mode", self.permission_mode)
+            self.control_success(request_id)
+        elif subtype == "set_model":
+            self.model = request.get("model") or self.model
+            self.control_success(request_id)
+        else:
+            self.control_success(request_id)
+
+    # ------------------------------------------------------------------
+    # 応答の生成
+    # ------------------------------------------------------------------
+
+    def request_sdk(self, request: dict) -> dict:
+        """SDK に制御リクエストを送り、応答を待つ"""
+        request_id = f"req_{uuid.uuid4().hex[:12]}"
+        waiter = [threading.Event(), None]
+        self.pending[request_id] = waiter
+        self.emit({"type": "control_request", "request_id": request_id, "request": request})
+        waiter[0].wait(timeout=30)
+        return self.pending.pop(request_id)[1] or {}
+
+    def run_pre_tool_hooks(self, tool_name: str, tool_input: dict, tool_use_id: str):
+        """PreToolUse フックを実行し、deny された場合は理由を返す"""
+        for matcher in self.pre_tool_hooks:
+            pattern = matcher.get("matcher")
+            if pattern and not re.fullmatch(pattern, tool_name):
+                continue
+            for callback_id in matcher.get("hookCallbackIds", []):
+                response = self.request_sdk({
+                    "subtype": "hook_callback",
+                    "callback_id": callback_id,
+                    "input": {
+                        "hook_event_name": "PreToolUse",
+                        "session_id": self.session_id,
+                        "permission_mode": self.permission_mode,
+                        "tool_name": tool_name,
+                        "tool_input": tool_input,
+                        "tool_use_id": tool_use_id,
+                    },
+                    "tool_use_id": tool_use_id,
+                })
+                output = response.get("hookSpecificOutput") or {}
+                if output.get("permissionDecision") == "deny":
+                    return output.get("permissionDecisionReason", "")
+        return None
+
+    BASE_INPUT_TOKENS = 1200
+    OUTPUT_TOKENS = 150
+    # 出力トークンは入力の5倍の単価として、増えた入力トークン分のコストを加える
+    OUTPUT_PRICE_RATIO = 5
+
+    def usage(self, turn: int = 1) -> dict:
+        """turn ターン目の usage（入力はターンごとに context_growth ずつ増える）"""
+        return {
+            "input_tokens": self.BASE_INPUT_TOKENS + self.context_growth * (turn - 1),
+            "output_tokens": self.OUTPUT_TOKENS,
+        }
+
+    def total_cost(self, num_turns: int) -> float:
+        """num_turns ターン分のコスト（1ターン目が cost_per_turn）"""
+        base_tokens = self.BASE_INPUT_TOKENS + self.OUTPUT_PRICE_RATIO * self.OUTPUT_TOKENS
+        extra = self.context_growth * num_turns * (num_turns - 1) / 2 / base_tokens
+        return self.cost_per_turn * (num_turns + extra)
+
+    def assistant(self, content: list[dict], turn: int = 1, message_id: str = None):
+        self.emit({
+            "type": "assistant",
+            "message": {
+                "id": message_id or f"msg_{uuid.uuid4().hex[:12]}",
+                "model": self.model,
+                "content": content,
+                "usage": self.usage(turn),
+            },
+            "parent_tool_use_id": None,
+            "session_id": self.session_id,
+        })
+
+    def stream_event(self, event: dict):
+        self.emit({
+            "type": "stream_event",
+            "uuid": uuid.uuid4().hex,
+            "session_id": self.session_id,
+            "event": event,
+            "parent_tool_use_id": None,
+        })
+
+    def think(self):
+        """モデルの応答を待つ（partial なら最初のトークンの時点でストリームイベントを送る）"""
+        if not self.partial:
+            time.sleep(self.turn_ms / 1000)
+            return
+        time.sleep(self.ttft_ms / 1000)
+        self.stream_event({"type": "message_start", "message": {"model": self.model}})
+        self.stream_event({
+            "type": "content_block_delta",
+            "index": 0,
+            "delta": {"type": "text_delta", "text": "[fake]"},
+        })
+        time.sleep((self.turn_ms - self.ttft_ms) / 1000)
+        self.stream_event({"type": "message_stop"})
+
+    def tool_result(self, tool_use_id: str, text: str, is_error: bool = False):
+        self.emit({
+            "type": "user",
+            "message": {
+                "role": "user",
+                "content": [{
+                    "type": "tool_result",
+                    "tool_use_id": tool_use_id,
+                    "content": text,
+                    "is_error": is_error,
+                }],
+            },
+            "parent_tool_use_id": None,
+            "session_id": self.session_id,
+        })
+
+    def result(self, subtype: str, num_turns: int, started: float, text: str = ""):
+        duration_ms = int((time.monotonic() - started) * 1000)
+        self.emit({
+            "type": "result",
+            "subtype": subtype,
+            "duration_ms": duration_ms,
+            "duration_api_ms": duration_ms,
+            "is_error": subtype != "success",
+            "num_turns": num_turns,
+            "session_id": self.session_id,
+            "total_cost_usd": round(self.total_cost(num_turns), 6),
+            "usage": self.usage(num_turns),
+            "result": text,
+        })
+
+    # ------------------------------------------------------------------
+    # セッションの進捗 (FAKE_CLI_STATE_DIR 指定時のみ)
+    # ------------------------------------------------------------------
+
+    def state_path(self) -> str:
+        return os.path.join(self.state_dir, f"{self.session_id}.json")
+
+    def load_progress(self) -> int:
+        if not self.state_dir or not os.path.exists(self.state_path()):
+            return 0
+        with open(self.state_path()) as f:
+            return json.load(f)["turns_done"]
+
+    def save_progress(self, turns_done: int):
+        if not self.state_dir:
+            return
+        with open(self.state_path(), "w") as f:
+            json.dump({"turns_done": turns_done}, f)
+
+    def respond(self, prompt: str):
+        """1つのプロンプトに対する応答を生成"""
+        started = time.monotonic()
+        self.interrupted.clear()
+        self.emit({
+            "type": "system",
+            "subtype": "init",
+            "session_id": self.session_id,
+            "model": self.model,
+            "permissionMode": self.permission_mode,
+        })
+
+        # スラッシュコマンドはモデルを呼び出さずに即座に完了する
+        if prompt.startswith("/"):
+            self.result("success", 0, started)
+            return
+
+        # まれに最初の応答が大きく遅れる（テールレイテンシの模擬）
+        if random.random() < self.stall_rate:
+            # interrupt() が届いたら待つのをやめる
+            self.interrupted.wait(self.stall_ms / 1000)
+
+        # 再開したセッションは完了済みのターンを繰り返さない
+        turn = self.load_progress()
+        consumed = 0
+        looping = bool(self.loop_after)
+
+        while True:
+            turn += 1
+            # プロンプトに結果が含まれるツール呼び出しは繰り返さない
+            if turn < self.turns and re.search(rf"step-{turn}\b", prompt):
+                continue
+            if self.max_turns is not None and consumed >= self.max_turns:
+                self.result("error_max_turns", consumed, started)
+                return
+
+            consumed += 1
+            self.think()
+            if self.interrupted.is_set():
+                self.result("error_during_execution", consumed - 1, started)
+                return
+            if random.random() < self.crash_rate:
+                os._exit(1)
+
+            step = turn
+            if looping and turn > self.loop_after:
+                # 同じ呼び出しを繰り返し、先へ進まない
+                step = self.loop_after
+                turn -= 1
+
+            edit_from = self.turns - self.edit_steps
+            if self.edit_steps and edit_from <= step < self.turns and self.permission_mode == "plan":
+                # plan モードでは編集を実行せず、計画を返して終わる
+                text = self.texts.get(step, "\n".join([
+                    f"[fake] 計画: 調査をもとに {self.edit_steps} か所を編集します。",
+                    *(f"{i}. pkg/module_{i}.py を修正" for i in range(1, self.edit_steps + 1)),
+                ]))
+                self.assistant([{"type": "text", "text": text}], consumed)
+                self.result("success", consumed, started, text)
+                return
+
+            if step < self.turns:
+                if self.edit_steps and step >= edit_from:
+                    tool_name = "Edit"
+                else:
+                    tool_name = self.tools[(step - 1) % len(self.tools)]
+                tool_use_id = f"toolu_{uuid.uuid4().hex[:12]}"
+                tool_input = {"pattern": f"step-{step}"}
+                # 1つの応答のテキストとツール呼び出しは、同じ id の別々のメッセージとして届く
+                message_id = f"msg_{uuid.uuid4().hex[:12]}"
+                if step in self.texts:
+                    self.assistant([{"type": "text", "text": self.texts[step]}], consumed, message_id)
+                self.assistant([{
+                    "type": "tool_use",
+                    "id": tool_use_id,
+                    "name": tool_name,
+                    "input": tool_input,
+                }], consumed, message_id)
+                denied = self.run_pre_tool_hooks(tool_name, tool_input, tool_use_id)
+                if denied is not None:
+                    self.tool_result(tool_use_id, denied, is_error=True)
+                    if self.loop_recover:
+                        looping = False
+                else:
+                    time.sleep(self.tool_ms / 1000)
+                    if tool_name == "Edit" and self.edit_file:
+                        with open(self.edit_file, "a", encoding="utf-8") as f:
+                            f.write(f"step-{step}\n")
+                    self.tool_result(tool_use_id, f"{tool_name} result {step}")
+                self.save_progress(turn)
+            else:
+                text = self.texts.get(step, f"[fake] {prompt[:40]} への応答です。完了しました。")
+                self.assistant([{"type": "text", "text": text}], consumed)
+                self.save_progress(turn)
+                self.result("success", consumed, started, text)
+                return
+
+    def run(self):
+        time.sleep(self.startup_ms / 1000)
+        reader = threading.Thread(target=self.read_stdin, daemon=True)
+        reader.start()
+
+        while True:
+            prompt = self.prompts.get()
+            if prompt is None:
+                break
+            self.respond(prompt)
+
+
+def main():
+    if "-v" in sys.argv[1:] or "--version" in sys.argv[1:]:
+        print(VERSION)
+        return
+    FakeCLI(sys.argv[1:]).run()
+
+
+if __name__ == "__main__":
+    main()